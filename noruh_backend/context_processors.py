@@ -0,0 +1,20 @@
+from noruh_backend.settings import (
+    PUSHER_KEY,
+    REALTIME_BACKEND,
+    REALTIME_GATEWAY_HOST,
+    REALTIME_GATEWAY_PORT,
+    REALTIME_GATEWAY_TLS,
+)
+
+
+def realtime(request):
+    '''
+    Options for the pusher-js client of the templates.
+    '''
+    return {'realtime': {
+        'backend': REALTIME_BACKEND,
+        'key': PUSHER_KEY,
+        'host': REALTIME_GATEWAY_HOST,
+        'port': REALTIME_GATEWAY_PORT,
+        'tls': REALTIME_GATEWAY_TLS,
+    }}
@@ -3,21 +3,80 @@ from noruh_backend.settings import (
     PUSHER_KEY,
     PUSHER_SECRET,
     PUSHER_CLUSTER,
-    PUSHER_SSL
+    PUSHER_SSL,
+    REALTIME_BACKEND,
 )
+import re
+
 import pusher
 
+from noruh_backend.realtime import GatewayClient
+
+# Limits of the Pusher HTTP API
+MAX_CHANNELS_PER_TRIGGER = 100
+MAX_EVENTS_PER_BATCH = 10
+
+# Private channel shared by the employees of an establishment with one role,
+# e.g. `private-kitchen-est-12`
+STAFF_CHANNEL = re.compile(r'^private-(?P<role>\w+?)-est-(?P<establishment_id>\d+)$')
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
 
 class PusherNotification():
-    pusher_client = pusher.Pusher(
-        app_id=PUSHER_APP_ID,
-        key=PUSHER_KEY,
-        secret=PUSHER_SECRET,
-        cluster=PUSHER_CLUSTER,
-        ssl=PUSHER_SSL,
-    )
+    if REALTIME_BACKEND == 'gateway':
+        pusher_client = GatewayClient()
+    else:
+        # The client keeps one HTTP session, so every trigger reuses the
+        # connection to Pusher
+        pusher_client = pusher.Pusher(
+            app_id=PUSHER_APP_ID,
+            key=PUSHER_KEY,
+            secret=PUSHER_SECRET,
+            cluster=PUSHER_CLUSTER,
+            ssl=PUSHER_SSL,
+        )
+
+    @staticmethod
+    def staff_channel(role):
+        '''
+        Channel prefix for `role`; with an establishment id as the id it
+        reaches every employee of that role subscribed to the establishment.
+        '''
+        return f'private-{role}-est'
 
     @classmethod
     def send_notifications(self, ids, channel, event, data):
-        for id in ids:
-            self.pusher_client.trigger(f'{channel}-{id}', event, data)
+        '''
+        Trigger `event` on the channel of each id, up to 100 channels per
+        request.
+        '''
+        self.send_batch([(ids, channel, event, data)])
+
+    @classmethod
+    def send_batch(self, notifications):
+        '''
+        Send several `(ids, channel, event, data)` notifications with as few
+        requests as possible: an event going to many channels is one
+        multi-channel trigger, events going to a single channel are grouped
+        in batch triggers.
+        '''
+        single_channel_events = []
+        for ids, channel, event, data in notifications:
+            channels = [f'{channel}-{id}' for id in ids]
+            if len(channels) == 1:
+                single_channel_events.append(
+                    {'channel': channels[0], 'name': event, 'data': data})
+                continue
+            for channels_chunk in chunks(channels, MAX_CHANNELS_PER_TRIGGER):
+                self.pusher_client.trigger(channels_chunk, event, data)
+
+        for batch in chunks(single_channel_events, MAX_EVENTS_PER_BATCH):
+            if len(batch) == 1:
+                self.pusher_client.trigger(
+                    batch[0]['channel'], batch[0]['name'], batch[0]['data'])
+            else:
+                self.pusher_client.trigger_batch(batch)
@@ -0,0 +1,318 @@
+'''
+Self-hosted realtime gateway speaking the Pusher channel/event protocol.
+
+`GatewayClient` publishes events like `pusher.Pusher` does, and
+`application` is an ASGI app that pusher-js connects to over WebSocket
+(run it with `uvicorn noruh_backend.realtime:application --port 6001`).
+Both sides meet on a broker: in memory, for a single process and tests, or
+redis pub/sub, to publish from Django and Celery to any number of gateways.
+'''
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import random
+import re
+import threading
+import time
+
+from noruh_backend.settings import (
+    PUSHER_KEY,
+    PUSHER_SECRET,
+    REALTIME_BROKER_URL,
+)
+
+ACTIVITY_TIMEOUT = 120
+
+# Seconds between reconnections to the broker, doubled up to the maximum
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 30
+
+APP_PATH = re.compile(r'^/app/(?P<key>[^/]+)$')
+
+logger = logging.getLogger(__name__)
+
+
+def sign(secret, value):
+    return hmac.new(secret.encode(), value.encode(), hashlib.sha256).hexdigest()
+
+
+class MemoryBroker():
+    '''
+    Delivers messages to the subscribers of the current process.
+    '''
+
+    def __init__(self):
+        self.subscribers = []
+
+    def publish(self, message):
+        for callback in list(self.subscribers):
+            callback(message)
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+
+class RedisBroker():
+    '''
+    Delivers messages through a redis pub/sub topic, read by a background
+    thread of each subscribed process. The thread reconnects when redis
+    goes away; messages published meanwhile are lost.
+    '''
+    topic = 'realtime'
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+        self.errors = redis.RedisError
+        self.subscribers = []
+        self.listener = None
+
+    def publish(self, message):
+        self.redis.publish(self.topic, json.dumps(message))
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+        if self.listener is None:
+            self.listener = threading.Thread(target=self.listen, daemon=True)
+            self.listener.start()
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def listen(self):
+        delay = RETRY_DELAY
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.topic)
+                delay = RETRY_DELAY
+                for item in pubsub.listen():
+                    self.dispatch(item['data'])
+            except self.errors as exc:
+                logger.warning('Realtime broker unavailable, retrying in %ss: %s',
+                               delay, exc)
+            finally:
+                pubsub.close()
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    def dispatch(self, data):
+        try:
+            message = json.loads(data)
+        except ValueError:
+            logger.warning('Invalid realtime message: %r', data)
+            return
+        for callback in list(self.subscribers):
+            try:
+                callback(message)
+            except Exception:
+                logger.exception('Realtime subscriber failed')
+
+
+_brokers = {}
+
+
+def get_broker(url=None):
+    '''
+    Broker for `url` (`memory://` or a redis URL), one per process.
+    '''
+    url = url or REALTIME_BROKER_URL
+    if url not in _brokers:
+        if url.startswith('memory://'):
+            _brokers[url] = MemoryBroker()
+        else:
+            _brokers[url] = RedisBroker(url)
+    return _brokers[url]
+
+
+class GatewayClient():
+    '''
+    Publishing side of the gateway, with the methods of `pusher.Pusher`
+    used by `PusherNotification` and the channel auth view.
+    '''
+
+    def __init__(self, key=PUSHER_KEY, secret=PUSHER_SECRET, broker=None):
+        self.key = key
+        self.secret = secret
+        self.broker = broker or get_broker()
+
+    def trigger(self, channels, event_name, data):
+        if isinstance(channels, str):
+            channels = [channels]
+        if not isinstance(data, str):
+            data = json.dumps(data)
+        for channel in channels:
+            self.broker.publish(
+                {'channel': channel, 'event': event_name, 'data': data})
+        return {}
+
+    def trigger_batch(self, batch):
+        for event in batch:
+            self.trigger(event['channel'], event['name'], event['data'])
+        return {}
+
+    def authenticate(self, channel, socket_id):
+        if not re.match(r'^\d+\.\d+$', socket_id):
+            raise ValueError('Invalid socket ID %s' % socket_id)
+        signature = sign(self.secret, '%s:%s' % (socket_id, channel))
+        return {'auth': '%s:%s' % (self.key, signature)}
+
+
+class Connection():
+    def __init__(self, send):
+        self.socket_id = '%d.%d' % (random.randint(1, 10 ** 9),
+                                    random.randint(1, 10 ** 9))
+        self.channels = set()
+        self.queue = asyncio.Queue()
+        self.send = send
+
+    def push(self, event, channel=None, data=None):
+        frame = {'event': event, 'data': data if isinstance(data, str)
+                 else json.dumps(data or {})}
+        if channel is not None:
+            frame['channel'] = channel
+        self.queue.put_nowait(frame)
+
+    async def write(self):
+        while True:
+            frame = await self.queue.get()
+            await self.send({'type': 'websocket.send',
+                             'text': json.dumps(frame)})
+
+
+class Gateway():
+    '''
+    ASGI WebSocket server for pusher-js clients: it keeps the channels each
+    connection subscribed to and forwards the broker messages to them.
+    Private channels need the signature given by the auth endpoint.
+    '''
+
+    def __init__(self, key=PUSHER_KEY, secret=PUSHER_SECRET, broker=None):
+        self.key = key
+        self.secret = secret
+        self.broker = broker
+        self.loop = None
+        self.channels = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'websocket':
+            await self.websocket(scope, receive, send)
+        else:
+            await send({'type': 'http.response.start', 'status': 404,
+                        'headers': [(b'content-type', b'text/plain')]})
+            await send({'type': 'http.response.body', 'body': b'Not Found'})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def start(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+            self.broker = self.broker or get_broker()
+            self.broker.subscribe(self.receive_threadsafe)
+
+    def stop(self):
+        if self.loop is not None:
+            self.broker.unsubscribe(self.receive_threadsafe)
+            self.loop = None
+
+    def receive_threadsafe(self, message):
+        # Brokers call back from the publishing or listening thread, which
+        # may still run after the gateway stopped
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        loop.call_soon_threadsafe(self.deliver, message)
+
+    def deliver(self, message):
+        for connection in self.channels.get(message['channel'], ()):
+            connection.push(message['event'], message['channel'],
+                            message['data'])
+
+    async def websocket(self, scope, receive, send):
+        self.start()
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        match = APP_PATH.match(scope['path'])
+        if match is None or match.group('key') != self.key:
+            await send({'type': 'websocket.close', 'code': 4001})
+            return
+
+        await send({'type': 'websocket.accept'})
+        connection = Connection(send)
+        writer = asyncio.ensure_future(connection.write())
+        connection.push('pusher:connection_established', data={
+            'socket_id': connection.socket_id,
+            'activity_timeout': ACTIVITY_TIMEOUT})
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+                if message.get('text'):
+                    try:
+                        self.handle(connection, json.loads(message['text']))
+                    except ValueError:
+                        connection.push('pusher:error', data={
+                            'code': None, 'message': 'Invalid message'})
+        finally:
+            for channel in list(connection.channels):
+                self.leave(connection, channel)
+            writer.cancel()
+
+    def handle(self, connection, frame):
+        if not isinstance(frame, dict):
+            raise ValueError('Frame must be an object')
+        event = frame.get('event')
+        data = frame.get('data') or {}
+        if isinstance(data, str):
+            data = json.loads(data)
+        if not isinstance(data, dict):
+            raise ValueError('Frame data must be an object')
+
+        if event == 'pusher:ping':
+            connection.push('pusher:pong')
+        elif event == 'pusher:subscribe':
+            channel = data.get('channel', '')
+            if not self.authorized(connection, channel, data.get('auth', '')):
+                connection.push('pusher:subscription_error', channel,
+                                {'type': 'AuthError', 'status': 401})
+                return
+            connection.channels.add(channel)
+            self.channels.setdefault(channel, set()).add(connection)
+            connection.push('pusher_internal:subscription_succeeded', channel)
+        elif event == 'pusher:unsubscribe':
+            self.leave(connection, data.get('channel', ''))
+
+    def leave(self, connection, channel):
+        connection.channels.discard(channel)
+        subscribers = self.channels.get(channel, set())
+        subscribers.discard(connection)
+        if not subscribers:
+            self.channels.pop(channel, None)
+
+    def authorized(self, connection, channel, auth):
+        if not channel.startswith('private-'):
+            return True
+        expected = '%s:%s' % (self.key, sign(
+            self.secret, '%s:%s' % (connection.socket_id, channel)))
+        return hmac.compare_digest(expected, auth)
+
+
+application = Gateway()
@@ -121,6 +121,7 @@ TEMPLATES = [
                 'django.contrib.messages.context_processors.messages',
                 'social_django.context_processors.backends',
                 'social_django.context_processors.login_redirect',
+                f'{PROJECT_NAME}.context_processors.realtime',
             ],
         },
     },
@@ -194,6 +195,20 @@ DATABASES = {
     )
 }
 
+# Cache
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+# Set CACHE_BACKEND='django_redis.cache.RedisCache' and CACHE_LOCATION to a
+# redis URL in production; local memory is used otherwise.
+
+CACHES = {
+    'default': {
+        'BACKEND': config(
+            'CACHE_BACKEND',
+            default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default='noruh'),
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
 
@@ -295,6 +310,23 @@ CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
+CELERY_BEAT_SCHEDULE = {
+    # Dispatch again outbox messages whose delivery task was lost
+    'drain-outbox': {
+        'task': 'drain_outbox',
+        'schedule': 60.0,
+    },
+    # Take the latest changes into the dashboards daily stats
+    'refresh-daily-stats': {
+        'task': 'refresh_daily_stats',
+        'schedule': 300.0,
+    },
+    # Snapshot the closed months of the offline compensations ledger
+    'close-offline-months': {
+        'task': 'close_offline_months',
+        'schedule': 300.0,
+    },
+}
 
 # PUSHER STUFF
 PUSHER_APP_ID = config('PUSHER_APP_ID', default=None)
@@ -302,6 +334,15 @@ PUSHER_KEY = config('PUSHER_KEY', default=None)
 PUSHER_SECRET = config('PUSHER_SECRET', default=None)
 PUSHER_CLUSTER = config('PUSHER_CLUSTER', default=None)
 PUSHER_SSL = config('PUSHER_SSL', default=True, cast=bool)
+
+# REALTIME STUFF
+# 'pusher' publishes on Pusher's service, 'gateway' on the self-hosted
+# gateway of noruh_backend.realtime, through a 'memory://' or redis broker
+REALTIME_BACKEND = config('REALTIME_BACKEND', default='pusher')
+REALTIME_BROKER_URL = config('REALTIME_BROKER_URL', default='memory://')
+REALTIME_GATEWAY_HOST = config('REALTIME_GATEWAY_HOST', default='')
+REALTIME_GATEWAY_PORT = config('REALTIME_GATEWAY_PORT', default=6001, cast=int)
+REALTIME_GATEWAY_TLS = config('REALTIME_GATEWAY_TLS', default=False, cast=bool)
 CELERY_TIMEZONE = 'UTC'
 
 # Thumbnail config
@@ -106,6 +106,12 @@ class BillAdmin(admin.ModelAdmin):
         'establishment',
         'payment_date',
         'opening_date',
+        'value_paid',
+        'orders_subtotal',
+        'members_count',
+        'offers_made_count',
+        'offers_used_count',
+        'last_offer_used',
     )
     list_display = (
         'table',
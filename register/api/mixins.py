@@ -0,0 +1,101 @@
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def make_etag(*parts):
+    '''
+    Strong ETag from the values that identify a version of a payload.
+    '''
+    return hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+
+
+def get_or_build(key, build, timeout=None, lock_timeout=10, wait=0.05):
+    '''
+    Return the cached value for `key`, calling `build` on a miss.
+
+    Only the caller that wins the `cache.add` lock rebuilds; the others poll
+    the cache for up to `lock_timeout` seconds and only build themselves if
+    the winner never stores a value.
+    '''
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = '%s:lock' % key
+    if cache.add(lock_key, True, lock_timeout):
+        try:
+            value = build()
+            cache.set(key, value, timeout)
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    deadline = time.time() + lock_timeout
+    while time.time() < deadline:
+        time.sleep(wait)
+        value = cache.get(key)
+        if value is not None:
+            return value
+    return build()
+
+
+class ConditionalGetMixin:
+    '''
+    Answer GET with 304 when If-None-Match matches `get_etag`, before any
+    queryset or serializer work, and send the ETag on full responses.
+    Views using it must define `get_etag(request, *args, **kwargs)`.
+    '''
+    cache_control = {'max_age': 0, 'must_revalidate': True}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if not callable(getattr(cls, 'get_etag', None)):
+            raise ImproperlyConfigured(
+                '%s must define get_etag().' % cls.__name__)
+
+    def get(self, request, *args, **kwargs):
+        self.etag = self.get_etag(request, *args, **kwargs)
+        etag = quote_etag(self.etag)
+        if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+
+        if etag in if_none_match or '*' in if_none_match:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = super().get(request, *args, **kwargs)
+
+        if response.status_code in (status.HTTP_200_OK,
+                                    status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = etag
+            patch_cache_control(response, **self.cache_control)
+        return response
+
+
+class CachedResponseMixin:
+    '''
+    Keep the rendered list payload in the cache under the current ETag, so a
+    write that changes the ETag makes the next request rebuild it. Must come
+    after `ConditionalGetMixin`, which sets `self.etag`.
+    '''
+    cache_prefix = None
+    cache_timeout = 60 * 60
+
+    def get_cache_key(self, request):
+        return 'response:%s:%s:%s' % (
+            self.cache_prefix or self.__class__.__name__,
+            request.get_host(), self.etag)
+
+    def list(self, request, *args, **kwargs):
+        data = get_or_build(
+            self.get_cache_key(request),
+            lambda: super(CachedResponseMixin, self).list(
+                request, *args, **kwargs).data,
+            self.cache_timeout)
+        return Response(data)
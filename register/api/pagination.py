@@ -1,4 +1,19 @@
-from rest_framework.pagination import LimitOffsetPagination, PageNumberPagination
+from rest_framework.pagination import (
+    CursorPagination,
+    LimitOffsetPagination,
+    PageNumberPagination,
+)
 
 class EstablishmentSetPagination(PageNumberPagination):
     page_size = 4
+
+
+class EstablishmentCursorPagination(CursorPagination):
+    '''
+    Keyset pagination, each page filters by `id > last id` instead of
+    scanning OFFSET rows.
+    '''
+    page_size = 50
+    max_page_size = 100
+    page_size_query_param = 'limit'
+    ordering = 'id'
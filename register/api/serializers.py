@@ -1,7 +1,7 @@
 import datetime
 import json
 
-from django.db.models import Avg
+from django.db import transaction
 from django.utils import timezone
 from django.shortcuts import get_object_or_404
 from django.contrib.auth.password_validation import validate_password
@@ -9,7 +9,6 @@ from django.contrib.auth.password_validation import validate_password
 from register.convert_json import objects_to_json
 
 from noruh_backend.settings import ORDER_REMOTE
-from noruh_backend.pusher import PusherNotification
 
 from fcm_django.models import FCMDevice
 from rest_framework import serializers
@@ -36,7 +35,7 @@ from register.models import Amenity, CuisineType
 from register.models import Establishment
 from register.models import Menu, MenuItem, MenuOffer, ItemCategory
 from register.models import Bill, BillMember, BillPayment, Order
-from register.models import Request
+from register.models import Request, OutboxMessage
 from register.models import UserRating
 from register.models import Profile, Employee
 from register.models import EstablishmentOperatingHours
@@ -247,7 +246,7 @@ class EstablishmentPromotionsSerializer(ModelSerializer):
                   'value', 'description', 'enabled']
 
     def get_establishment_id(self, obj):
-        return obj.establishment.id
+        return obj.establishment_id
 
 
 class VerifyIfPromocodeExistsSerializer(serializers.Serializer):
@@ -279,6 +278,34 @@ class TableSerializer(ModelSerializer):
         fields = ['id']
 
 
+def get_requested_fields(request, known=None):
+    '''
+    Field names from the `?fields=id,name` query param, None if absent or,
+    given the `known` field names, when none of the requested is known.
+    '''
+    if request is None or not request.query_params.get('fields'):
+        return None
+    fields = {field.strip() for field in request.query_params['fields'].split(',')
+              if field.strip()}
+    if known is not None and not fields.intersection(known):
+        return None
+    return fields
+
+
+class SparseFieldsetMixin:
+    '''
+    Render only the fields requested on `?fields=`, unknown names are ignored
+    and all fields are rendered when none of them is known.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = get_requested_fields(self.context.get('request'), self.fields)
+        if fields:
+            for name in set(self.fields) - fields:
+                self.fields.pop(name)
+
+
 class EstablishmentLocation(ModelSerializer):
     lat = SerializerMethodField()
     lng = SerializerMethodField()
@@ -294,7 +321,7 @@ class EstablishmentLocation(ModelSerializer):
         return obj.x
 
 
-class EstablishmentSerializer(ModelSerializer):
+class EstablishmentSerializer(SparseFieldsetMixin, ModelSerializer):
     amenities = AmenitySerializer(many=True, read_only=True)
     cuisine_type = CuisineTypeSerializer()
     photos = EstablishmentPhotosSerializer(many=True, read_only=True)
@@ -312,6 +339,7 @@ class EstablishmentSerializer(ModelSerializer):
     operating_hours = EstablishmentOperatingHoursSerializer(
         many=True, read_only=True)
     table_order_remote_id = SerializerMethodField()
+    distance = SerializerMethodField()
 
     class Meta:
         model = Establishment
@@ -324,52 +352,53 @@ class EstablishmentSerializer(ModelSerializer):
                   'average_avg', 'average_environment',
                   'average_food', 'average_service',
                   'number_of_evaluations', 'excellent_evaluations',
-                  'good_evaluations', 'bad_evaluations', ]
+                  'good_evaluations', 'bad_evaluations', 'distance']
 
     def get_cuisine_type(self, obj):
         return obj.cuisine_type.name
 
     def get_table_order_remote_id(self, obj):
-        query = Table.objects.get(name=ORDER_REMOTE, establishment__id=obj.id)
-        if query is not None:
-            return query.id
+        if hasattr(obj, 'table_order_remote_id'):
+            table_id = obj.table_order_remote_id
+        else:
+            table_id = Table.objects.filter(
+                name=ORDER_REMOTE, establishment__id=obj.id).values_list(
+                    'id', flat=True).first()
+        if table_id is not None:
+            return table_id
         raise TableDoesNotExistsAPIException()
 
+    def get_distance(self, obj):
+        '''
+        Distance in km from the point searched, None without geo_loc.
+        '''
+        if getattr(obj, 'distance', None) is None:
+            return None
+        return round(obj.distance.km, 2)
+
     def get_average_avg(self, obj):
-        average = UserRating.objects.filter(
-            bill__establishment__id=obj.id).aggregate(Avg('average'))
-        return average['average__avg']
+        return obj.rating_summary()['average_avg']
 
     def get_average_environment(self, obj):
-        enviroment = UserRating.objects.filter(
-            bill__establishment__id=obj.id).aggregate(Avg('environment'))
-        return enviroment['environment__avg']
+        return obj.rating_summary()['average_environment']
 
     def get_average_food(self, obj):
-        food = UserRating.objects.filter(
-            bill__establishment__id=obj.id).aggregate(Avg('food'))
-        return food['food__avg']
+        return obj.rating_summary()['average_food']
 
     def get_average_service(self, obj):
-        service = UserRating.objects.filter(
-            bill__establishment__id=obj.id).aggregate(Avg('service'))
-        return service['service__avg']
+        return obj.rating_summary()['average_service']
 
     def get_number_of_evaluations(self, obj):
-        number = obj.calculate_evaluations()
-        return number['number']
+        return obj.rating_summary()['number']
 
     def get_excellent_evaluations(self, obj):
-        excellent = obj.calculate_evaluations()
-        return excellent['excellent']
+        return obj.rating_summary()['excellent']
 
     def get_good_evaluations(self, obj):
-        good = obj.calculate_evaluations()
-        return good['good']
+        return obj.rating_summary()['good']
 
     def get_bad_evaluations(self, obj):
-        bad = obj.calculate_evaluations()
-        return bad['bad']
+        return obj.rating_summary()['bad']
 
 
 class MenuOfferSerializerList(ModelSerializer):
@@ -406,10 +435,9 @@ class MenuItemSerializer(ModelSerializer):
                   'preparation_time', 'observations']
 
     def get_observations(self, obj):
-        observations_list = []
-        all_observations = obj.observations.get_queryset()
-        list(map(lambda observation: observations_list.append(observation.observation), all_observations))
-        return observations_list
+        # .all() reads the prefetched observations from Menu.objects.with_items()
+        return [observation.observation
+                for observation in obj.observations.all()]
 
     def get_preparation_time(self, obj):
         return obj.preparation_time.minute
@@ -426,23 +454,14 @@ class MenuSerializer(ModelSerializer):
         fields = ['name', 'establishment', 'enabled', 'items']
 
 
-class OrderSerializerPost(ModelSerializer):
-
-    class Meta:
-        model = Order
-        fields = ['bill', 'item', 'quantity', 'observation']
-
-    def validate(self, data):
-        if data.get('bill').payment_date:
-            raise BillAlreadyBeenPaidException()
-        if MenuItem.objects.filter(id=data.get('item').id,
-                                   menu__establishment=data.get('bill').establishment).exists() is False:
-            raise serializers.ValidationError('This item does not belong to this Establishment')
-
-        user = self.context.get('request').user
-        if not user.billmember_set.filter(bill=data.get('bill')).exists():
-            raise NotPartOfThisBillException()
-        return data
+class OrderSerializerPost(serializers.Serializer):
+    # Bills and items are looked up for the whole cart by
+    # MultipleOrderSerializer, not one by one
+    bill = serializers.IntegerField()
+    item = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=0)
+    observation = serializers.CharField(
+        required=False, allow_null=True, allow_blank=True)
 
 
 class OrderSerializerDiscountPost(serializers.Serializer):
@@ -491,24 +510,10 @@ class OrderSerializerList(ModelSerializer):
                   'kitchen_finished_at', 'canceled_at']
 
     def get_offer(self, obj):
-        if obj.item.offer:
-            '''
-            getting all orders from that bill, and dont filter if has been accept,
-            in the future, this will change for orders only accept for the kitchen,
-            and then, change `value_from_orders` to `bill.orders_total()`
-            '''
-            orders = Order.objects.filter(bill=obj.bill)
-            value_from_orders = sum(order.total_price() for order in orders)
-
-            if (value_from_orders - obj.bill.establishment.offer_range_value) >= obj.bill.last_offer_used:
-                if obj.bill.offers_made_count <= obj.bill.establishment.offer_count_limit:
-                    obj.bill.last_offer_used = int(value_from_orders / obj.bill.establishment.offer_range_value) * obj.bill.establishment.offer_range_value
-                    obj.bill.offers_made_count += 1
-                    obj.bill.save()
-                    return MenuOfferSerializerList(obj.item.offer).data
-                return None
+        # Granted by `Bill.grant_offer` when the order was placed
+        if obj.granted_offer_id is None:
             return None
-        return None
+        return MenuOfferSerializerList(obj.granted_offer).data
 
     def get_name(self, obj):
         first_name = obj.user.first_name
@@ -523,6 +528,40 @@ class MultipleOrderSerializer(ModelSerializer):
         model = Order
         fields = ['items']
 
+    def validate_items(self, items):
+        '''
+        Check the bills and items of the whole cart with one query each and
+        replace their ids with the instances.
+        '''
+        if not items:
+            raise serializers.ValidationError('At least one item is required.')
+
+        user = self.context.get('request').user
+        bills = Bill.objects.select_related('establishment').in_bulk(
+            {item['bill'] for item in items})
+        menu_items = MenuItem.objects.with_relations().select_related(
+            'menu').in_bulk({item['item'] for item in items})
+        member_of = set(user.billmember_set.filter(
+            bill__in=list(bills)).values_list('bill_id', flat=True))
+
+        for item in items:
+            bill = bills.get(item['bill'])
+            menu_item = menu_items.get(item['item'])
+            if bill is None:
+                raise serializers.ValidationError(
+                    'Invalid bill "%s" - object does not exist.' % item['bill'])
+            if menu_item is None:
+                raise serializers.ValidationError(
+                    'Invalid item "%s" - object does not exist.' % item['item'])
+            if bill.payment_date:
+                raise BillAlreadyBeenPaidException()
+            if menu_item.menu.establishment_id != bill.establishment_id:
+                raise serializers.ValidationError('This item does not belong to this Establishment')
+            if bill.id not in member_of:
+                raise NotPartOfThisBillException()
+            item['bill'], item['item'] = bill, menu_item
+        return items
+
 
 class OrderSerializerUpdateStatus(ModelSerializer):
 
@@ -548,8 +587,9 @@ class OrderSerializerUpdateStatus(ModelSerializer):
 
     def update(self, instance, validated_data):
         instance.status = validated_data.get('status')
-        instance.send_pusher_notification()
-        instance.save()
+        with transaction.atomic():
+            instance.save()
+            instance.send_pusher_notification()
         return instance
 
 
@@ -608,9 +648,10 @@ class BillMemberSerializerPost(serializers.Serializer):
         user_join = self.context.get('request').user
         bill = validated_data['bill']
         couvert_value = bill.establishment.taxe_couvert
-        bill_member = BillMember.objects.create(
-            bill=bill, customer=user_join, couvert_value=couvert_value)
-        bill_member.send_fcm_notification_to_owner(user_join)
+        with transaction.atomic():
+            bill_member = BillMember.objects.create(
+                bill=bill, customer=user_join, couvert_value=couvert_value)
+            bill_member.send_fcm_notification_to_owner(user_join)
         return bill_member
 
     def to_representation(self, instance):
@@ -763,19 +804,19 @@ class BillSerializerPost(ModelSerializer):
 
     def save(self):
         user = self.context.get('request').user
-        bill = super().save()
-        auto_now = datetime.datetime.now()
-        couvert_value = bill.establishment.taxe_couvert
-        BillMember.objects.create(bill=bill, customer=user, joined_at=auto_now,
-                                  bill_owner=True, couvert_value=couvert_value)
-        waiters = User.objects.filter(id__in=Employee.objects.filter(establishment=bill.establishment,
-                                      user_type=Employee.USER_WAITER).values('user'))
-        list_waiters = [waiter.id for waiter in waiters]
-        data = {'establishment': bill.establishment.name,
-                'table': bill.table.name,
-                'opening_date': bill.opening_date}
-        data_json = json.dumps(data, default=objects_to_json)
-        PusherNotification.send_notifications(list_waiters, 'waiter', 'new_bill_waiter', data_json)
+        with transaction.atomic():
+            bill = super().save()
+            auto_now = datetime.datetime.now()
+            couvert_value = bill.establishment.taxe_couvert
+            BillMember.objects.create(bill=bill, customer=user, joined_at=auto_now,
+                                      bill_owner=True, couvert_value=couvert_value)
+            data = {'establishment': bill.establishment.name,
+                    'table': bill.table.name,
+                    'opening_date': bill.opening_date}
+            data_json = json.dumps(data, default=objects_to_json)
+            OutboxMessage.send_to_staff(bill.establishment_id, Employee.USER_WAITER,
+                                        'new_bill_waiter', data_json)
+        return bill
 
 
 class UserBillSerializer(ModelSerializer):
@@ -4,7 +4,7 @@ from .views import (
     EstablishmentDetailAPIView,
     VerifyIfPromocodeIsEnabledView,
 )
-from .views import CuisineTypeListAPIView, MenuListAPIView
+from .views import CuisineTypeListAPIView, MenuListAPIView, MenuChangesAPIView
 from .views import (
     BillAPIPost,
     BillHistoryAPIList,
@@ -73,6 +73,9 @@ urlpatterns = [
     # List all items from menu use the `establishment_id` to path
     path('menu/list/<int:establishment_id>', MenuListAPIView.as_view(),
          name='api_menu_list'),
+    # Items changed and deleted since `?since=<version>`, for incremental sync
+    path('menu/changes/<int:establishment_id>', MenuChangesAPIView.as_view(),
+         name='api_menu_changes'),
 
     # All endpoints for Bill and BillMemebers
     path('bill/history/', BillHistoryAPIList.as_view(),
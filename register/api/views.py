@@ -1,8 +1,10 @@
 import json
+import math
 
+from django.db import transaction
+from django.db.models import Count, Max
 from django.utils import timezone
 from django.contrib.gis.geos import Point
-from django.contrib.gis.measure import Distance
 from django.shortcuts import get_object_or_404, reverse
 from django.contrib.auth.models import User
 from django.template.loader import get_template
@@ -10,6 +12,7 @@ from django.template.loader import get_template
 from rest_framework import permissions
 from rest_framework import status
 from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import ValidationError
 
 from django_filters import rest_framework as filters
 from rest_framework.response import Response
@@ -37,25 +40,31 @@ from allauth.socialaccount.providers.google.views import GoogleOAuth2Adapter
 from rest_auth.registration.views import SocialLoginView
 
 from noruh_backend.settings import STATIC_URL, BASE_URL
-from noruh_backend.pusher import PusherNotification
 
 from register.convert_json import objects_to_json
 from register.models import Profile
 from register.models import Employee
 from register.models import CuisineType
 from register.models import Establishment, EstablishmentPromotions
-from register.models import Menu, MenuItem, MenuOffer
+from register.models import Menu, MenuItem, MenuOffer, MenuTombstone
 from register.models import Bill, BillMember, BillPayment
 from register.models import Order
 from register.models import Request
+from register.models import OutboxMessage
 from register.models import UserRating
 from register.models import Table
 from register.models import TokenRecoverPassword
-from register.api.exceptions import EstablishmentDoesNotAvaibleAPIException
+from register.utils import from_version, sync_version
+from register.api.exceptions import (
+    EstablishmentDoesNotAvaibleAPIException,
+    LimitDiscountAmoutIsOverAPIException,
+)
 from .filters import (
     EstablishmentFilter,
     BillMemberFilter
 )
+from .mixins import CachedResponseMixin, ConditionalGetMixin, make_etag
+from .pagination import EstablishmentCursorPagination
 from .serializers import (
     ForgotMyPasswordSerializer,
     ProfileSerializerList,
@@ -68,6 +77,7 @@ from .serializers import (
     EstablishmentPromotionsSerializer,
     CuisineTypeSerializer,
     MenuSerializer,
+    MenuItemSerializer,
     BillSerializerPost,
     BillMemberSerializerList,
     BillMemberSerializerPost,
@@ -83,7 +93,8 @@ from .serializers import (
     EvaluationSerializerPost,
     EvaluationSerializerList,
     EvaluationInfoSerializer,
-    VerifyIfPromocodeExistsSerializer
+    VerifyIfPromocodeExistsSerializer,
+    get_requested_fields
 )
 
 
@@ -240,42 +251,130 @@ class ProfileAPIUpdate(RetrieveUpdateAPIView):
 
 
 # Views for Establishments, Bills, Orders, Requests, Menu, and Evaluations
-class EstablishmentListAPIView(ListAPIView):
+class EstablishmentListAPIView(ConditionalGetMixin, ListAPIView):
     """
-    This view list all establishments with geo_loc in radius from 20km.
-    Without geo_loc, list all establishments when enabled=True
+    This view list all establishments with geo_loc in radius from 20km,
+    nearest first. The radius can be changed with `radius`(km) and
+    `nearest=N` returns only the N establishments closest to geo_loc.
+    Without geo_loc, list all establishments when enabled=True.
+    Use `fields=id,name,...` to receive only some fields and `cursor`
+    to paginate by keyset, which orders by id and so is refused with
+    lat/lng unless `nearest` is given.
     """
     permission_classes = (permissions.AllowAny, )
     serializer_class = EstablishmentSerializer
     filter_backends = (filters.DjangoFilterBackend,)
     filterset_class = EstablishmentFilter
+    default_radius = 20   # 20km Radius
+    max_radius = 100
+    max_nearest = 100
 
-    def get_queryset(self):
+    def get_point(self):
         lat = self.request.query_params.get('lat')
         lng = self.request.query_params.get('lng')
 
         if lat and lng is not None:
-            lat = float(lat)
-            lng = float(lng)
-            radius = 20   # 20km Radius
-            point = Point(lng, lat)
-            return Establishment.objects.filter(
-                enabled=True, geo_loc__distance_lt=(
-                    point, Distance(km=radius)))
+            lat = self.parse_number('lat', lat)
+            lng = self.parse_number('lng', lng)
+            if not -90 <= lat <= 90:
+                raise ValidationError({'lat': 'Must be between -90 and 90.'})
+            if not -180 <= lng <= 180:
+                raise ValidationError({'lng': 'Must be between -180 and 180.'})
+            return Point(lng, lat, srid=4326)
+        return None
+
+    @staticmethod
+    def parse_number(name, value):
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValidationError({name: 'A valid number is required.'})
+        if not math.isfinite(value):
+            raise ValidationError({name: 'A valid number is required.'})
+        return value
+
+    def get_query_param_number(self, name, default, maximum):
+        value = self.request.query_params.get(name)
+        value = self.parse_number(name, value) if value is not None else default
+        if value is not None and value <= 0:
+            raise ValidationError({name: 'Must be greater than zero.'})
+        return min(value, maximum) if value is not None else None
+
+    def wants_cursor(self):
+        """
+        `?cursor=` (or `?pagination=cursor`) switches to keyset pagination,
+        the nearest mode is already bounded and keeps the default one.
+        """
+        params = self.request.query_params
+        return params.get('nearest') is None and (
+            'cursor' in params or params.get('pagination') == 'cursor')
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if self.wants_cursor():
+                self._paginator = EstablishmentCursorPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def get_queryset(self):
+        fields = get_requested_fields(
+            self.request, EstablishmentSerializer.Meta.fields)
+        queryset = Establishment.objects.with_api_relations(fields).filter(
+            enabled=True)
+        point = self.get_point()
+
+        if point is None:
+            return queryset
+
+        if self.request.query_params.get('nearest') is not None:
+            return queryset.nearest(point)
+
+        if self.wants_cursor():
+            # the keyset is the id, it would replace the distance ordering
+            raise ValidationError(
+                {'cursor': 'Not available with lat/lng, use nearest instead.'})
 
-        return Establishment.objects.filter(enabled=True)
+        radius = self.get_query_param_number(
+            'radius', self.default_radius, self.max_radius)
+        return queryset.within_radius(point, radius)
 
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        nearest = self.get_query_param_number(
+            'nearest', None, self.max_nearest)
 
-class EstablishmentDetailAPIView(RetrieveAPIView):
+        if nearest is not None and self.get_point() is not None:
+            return queryset[:max(int(nearest), 1)]
+        return queryset
+
+    def get_etag(self, request, *args, **kwargs):
+        version = self.filter_queryset(self.get_queryset()).aggregate(
+            Max('updated_at'), Count('id'))
+        return make_etag(request.get_full_path(), version['updated_at__max'],
+                         version['id__count'])
+
+
+class EstablishmentDetailAPIView(ConditionalGetMixin, RetrieveAPIView):
     """
     Using the id from establishment on path, get the details from Establishment
     """
     permission_classes = (permissions.AllowAny, )
     serializer_class = EstablishmentSerializer
-    queryset = Establishment.objects.all()
+
+    def get_queryset(self):
+        fields = get_requested_fields(
+            self.request, EstablishmentSerializer.Meta.fields)
+        return Establishment.objects.with_api_relations(fields)
+
+    def get_etag(self, request, *args, **kwargs):
+        updated_at = Establishment.objects.filter(
+            pk=self.kwargs['pk']).values_list('updated_at', flat=True).first()
+        return make_etag(request.get_full_path(), updated_at)
 
 
-class CuisineTypeListAPIView(ListAPIView):
+class CuisineTypeListAPIView(ConditionalGetMixin, ListAPIView):
     """
     List all cuisine types from backend
     """
@@ -285,17 +384,94 @@ class CuisineTypeListAPIView(ListAPIView):
     def get_queryset(self):
         return CuisineType.objects.all()
 
+    def get_etag(self, request, *args, **kwargs):
+        cuisine_types = CuisineType.objects.values_list('id', 'name')
+        return make_etag(request.get_full_path(), list(cuisine_types))
 
-class MenuListAPIView(ListAPIView):
+
+class MenuListAPIView(ConditionalGetMixin, CachedResponseMixin, ListAPIView):
     """
     List Menu from establishment with all menu_items inside
+
+    The rendered payload is cached per ETag; saving or deleting a Menu,
+    MenuItem, ItemCategory, ItemObservations or MenuOffer bumps
+    Menu.updated_at and so retires the cached copy.
     """
     permission_classes = (permissions.IsAuthenticated, )
     serializer_class = MenuSerializer
+    cache_control = {'private': True, 'max_age': 0, 'must_revalidate': True}
+    cache_prefix = 'menu'
 
     def get_queryset(self):
         id = self.kwargs['establishment_id']
-        return Menu.objects.filter(establishment__id=id)
+        return Menu.objects.filter(establishment__id=id).with_items()
+
+    def get_etag(self, request, *args, **kwargs):
+        version = Menu.objects.filter(
+            establishment__id=self.kwargs['establishment_id']).aggregate(
+                Max('updated_at'), Count('id'))
+        return make_etag(request.get_full_path(), version['updated_at__max'],
+                         version['id__count'])
+
+
+class MenuChangesAPIView(APIView):
+    """
+    Menu items of the establishment changed after `since`, and the ids of
+    items and observations deleted after it. `version` in the response is
+    the `since` for the next sync; without `since` every item is returned.
+    `version` stays SYNC_OVERLAP behind now, so rows of the last seconds
+    come again in the next sync and are upserted by id.
+    """
+    permission_classes = (permissions.IsAuthenticated, )
+
+    def get_since(self):
+        since = self.request.query_params.get('since')
+        if since is None:
+            return None
+        try:
+            since = int(since)
+            from_version(since)
+        except (ValueError, OverflowError):
+            raise ValidationError({'since': 'A valid version is required.'})
+        if since < 0:
+            raise ValidationError({'since': 'Must not be negative.'})
+        return since
+
+    def get(self, request, establishment_id, format=None):
+        since = self.get_since()
+        items = MenuItem.objects.filter(
+            menu__establishment_id=establishment_id).with_relations()
+        deleted = {MenuTombstone.ITEM: [], MenuTombstone.OBSERVATION: []}
+        moments = []
+
+        if since is not None:
+            items = items.filter(updated_at__gt=from_version(since))
+            tombstones = MenuTombstone.objects.filter(
+                establishment_id=establishment_id,
+                deleted_at__gt=from_version(since)).values_list(
+                    'kind', 'object_id', 'deleted_at')
+            for kind, object_id, deleted_at in tombstones:
+                deleted[kind].append(object_id)
+                moments.append(deleted_at)
+
+        items = list(items.order_by('id'))
+        moments.extend(item.updated_at for item in items)
+        version = sync_version(moments, since)
+
+        serializer = MenuItemSerializer(
+            items, many=True, context=self.get_serializer_context())
+        return Response({
+            'version': version,
+            'items': serializer.data,
+            'deleted': {
+                'items': deleted[MenuTombstone.ITEM],
+                'observations': deleted[MenuTombstone.OBSERVATION],
+            },
+        })
+
+    def get_serializer_context(self):
+        return {'request': self.request, 'format': self.format_kwarg,
+                'view': self}
 
 
 class BillAPIPost(CreateAPIView):
@@ -438,52 +614,42 @@ class OrderAPIPost(CreateAPIView):
         write_serializer = MultipleOrderSerializer(
             data=request.data, context=context)
         write_serializer.is_valid(raise_exception=True)
-        orders = write_serializer.data.get('items')
-        orders = list(map(lambda order: Order.create_order(
-            order, self.request.user), orders))
-        read_serializer = list(map(
-            lambda order: OrderSerializerList(order).data, orders))
-
-        items = request.data.get('items')
-        bill = Bill.objects.get(id=items[0].get('bill'))
-        kitchens = User.objects.filter(
-            id__in=Employee.objects.filter(
-                establishment=bill.establishment,
-                user_type=Employee.USER_KITCHEN).values('user'))
-        list_kitchens = kitchens.values_list('id', flat=True)
-        waiters = User.objects.filter(
-            id__in=Employee.objects.filter(
-                establishment=bill.establishment,
-                user_type=Employee.USER_WAITER).values('user'))
-        list_waiters = waiters.values_list('id', flat=True)
-        devices = FCMDevice.objects.filter(
-            user_id__in=BillMember.objects.filter(
-                bill=bill).values('customer'))
-        for order in orders:
-            user_full_name = '{} {}'.format(order.user.first_name, order.user.last_name)
-            order_dict = {'id': order.id, 'user': order.user.id,
-                          'name': user_full_name,
-                          'bill': order.bill.id, 'item_id': order.item.id,
-                          'item_name': order.item.name,
-                          'total_price': order.value_order,
-                          'quantity': order.quantity, 
-                          'created_at': order.created_at,
-                          'canceled_at': order.canceled_at,
-                          'kitchen_accepted_at': order.kitchen_accepted_at,
-                          'kitchen_finished_at': order.kitchen_finished_at,
-                          'status': order.status}
-            order_dict = json.dumps(order_dict, default=objects_to_json)
-            dict_data = {'key': 'new_order', 'data': order_dict}
-
-            PusherNotification.send_notifications(
-                list_kitchens, 'kitchen', 'makes_new_order', order_dict)
-            PusherNotification.send_notifications(
-                list_waiters, 'waiter', 'makes_new_order', order_dict)
-            devices.send_message("Novo Pedido",
-                                 "Foi Feito um novo Pedido na sua Conta",
-                                 data=dict_data)
+        with transaction.atomic():
+            orders = Order.create_orders(
+                write_serializer.validated_data['items'], self.request.user)
+            read_serializer = OrderSerializerList(orders, many=True).data
+            self.notify_new_orders(request, orders)
         return Response(read_serializer, status=status.HTTP_201_CREATED)
 
+    def notify_new_orders(self, request, orders):
+        bill = orders[0].bill
+        customers = list(BillMember.objects.filter(
+            bill=bill).values_list('customer', flat=True))
+        pusher_notifications = []
+        orders_data = []
+        for order in orders:
+            order_dict = order.notification_data()
+            orders_data.append(order_dict)
+            pusher_notifications.append(Employee.staff_notification(
+                bill.establishment_id, Employee.USER_KITCHEN,
+                'makes_new_order', order_dict))
+            pusher_notifications.append(Employee.staff_notification(
+                bill.establishment_id, Employee.USER_WAITER,
+                'makes_new_order', order_dict))
+
+        # One push for the whole cart, the single order format is kept
+        # when there is only one
+        if len(orders_data) == 1:
+            dict_data = {'key': 'new_order', 'data': orders_data[0]}
+        else:
+            dict_data = {'key': 'new_orders', 'data': json.dumps(
+                [json.loads(order_dict) for order_dict in orders_data])}
+        OutboxMessage.send_fcm(customers, "Novo Pedido",
+                               "Foi Feito um novo Pedido na sua Conta",
+                               data=dict_data)
+        # One outbox message, delivered with the fewest Pusher requests
+        OutboxMessage.send_pusher_batch(pusher_notifications)
+
 
 class OrderAPIDiscountPost(CreateAPIView):
     """
@@ -507,47 +673,45 @@ class OrderAPIDiscountPost(CreateAPIView):
                 'menu_offer_id'))
             observation = serializer.data.get('observation')
             value_discount = menu_offer_id.calculate_discount(menu_item)
-            order = Order.objects.create(
-                user=user, bill=bill,
-                item=menu_item, quantity=1, observation=observation,
-                status=Order.STATUS_PENDING, value_order=value_discount)
-
-            bill.offers_used_count += 1
-            bill.save()
-
-            # Send fcm notifications and pusher web notifications
-            kitchens = User.objects.filter(
-                id__in=Employee.objects.filter(
-                    establishment=bill.establishment,
-                    user_type=Employee.USER_KITCHEN).values('user'))
-            list_kitchens = kitchens.values_list('id', flat=True)
-            devices = FCMDevice.objects.filter(
-                user_id__in=BillMember.objects.filter(
-                    bill=bill).values('customer'))
-            order_dict = {'id': order.id, 'user_id': order.user.id,
-                          'bill_id': order.bill.id, 'item_id': order.item.id,
-                          'item_name': order.item.name,
-                          'quantity': order.quantity,
-                          'observation': order.observation,
-                          'created_at': order.created_at,
-                          'canceled_at': order.canceled_at,
-                          'kitchen_accepted_at': order.kitchen_accepted_at,
-                          'kitchen_finished_at': order.kitchen_finished_at,
-                          'status': order.status}
-            order_dict = json.dumps(order_dict, default=objects_to_json)
-            dict_data = {'key': 'new_order', 'data': order_dict}
-
-            PusherNotification.send_notifications(
-                list_kitchens, 'kitchen', 'makes_new_order', order_dict)
-            devices.send_message("Novo Pedido",
-                                 "Foi Feito um novo Pedido na sua Conta",
-                                 dict_data)
+            with transaction.atomic():
+                if not bill.use_offer():
+                    raise LimitDiscountAmoutIsOverAPIException()
+                order = Order.objects.create(
+                    user=user, bill=bill,
+                    item=menu_item, quantity=1, observation=observation,
+                    status=Order.STATUS_PENDING, value_order=value_discount)
+                self.notify_new_order(bill, order)
 
             return Response('Order with Discount Created',
                             status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def notify_new_order(self, bill, order):
+
+        # Send fcm notifications and pusher web notifications
+        customers = BillMember.objects.filter(
+            bill=bill).values_list('customer', flat=True)
+        order_dict = {'id': order.id, 'user_id': order.user.id,
+                      'bill_id': order.bill.id, 'item_id': order.item.id,
+                      'item_name': order.item.name,
+                      'quantity': order.quantity,
+                      'observation': order.observation,
+                      'created_at': order.created_at,
+                      'canceled_at': order.canceled_at,
+                      'kitchen_accepted_at': order.kitchen_accepted_at,
+                      'kitchen_finished_at': order.kitchen_finished_at,
+                      'status': order.status}
+        order_dict = json.dumps(order_dict, default=objects_to_json)
+        dict_data = {'key': 'new_order', 'data': order_dict}
+
+        OutboxMessage.send_to_staff(
+            bill.establishment_id, Employee.USER_KITCHEN,
+            'makes_new_order', order_dict)
+        OutboxMessage.send_fcm(customers, "Novo Pedido",
+                               "Foi Feito um novo Pedido na sua Conta",
+                               data=dict_data)
+
 
 class OrderAPIUpdate(RetrieveUpdateAPIView):
     """
@@ -572,17 +736,15 @@ class RequestAPIView(CreateAPIView):
         table = Table.objects.get(id=serializer.validated_data.get('table').id)
         if table.establishment.enabled is False:
             raise EstablishmentDoesNotAvaibleAPIException()
-        waiters = User.objects.filter(id__in=Employee.objects.filter(
-            establishment=table.establishment,
-            user_type=Employee.USER_WAITER).values('user'))
-        list_waiters = [waiter.id for waiter in waiters]
         data = {'table_name': table.name,
                 'username': self.request.user.first_name,
                 'table_zone_name': table.table_zone.name}
-        PusherNotification.send_notifications(
-            list_waiters, 'waiter', 'request_for_waiter', data)
-        serializer.save(user=self.request.user)
-        serializer.save(status=Request.STATUS_PENDING)
+        with transaction.atomic():
+            serializer.save(user=self.request.user)
+            serializer.save(status=Request.STATUS_PENDING)
+            OutboxMessage.send_to_staff(
+                table.establishment_id, Employee.USER_WAITER,
+                'request_for_waiter', data)
 
 
 class EvaluationAPIPost(CreateAPIView):
@@ -0,0 +1,211 @@
+'''
+Streaming report exports: rows are encoded as CSV or XLSX while they are
+read from the database, so the download starts at once and the memory used
+does not grow with the number of rows.
+'''
+import csv
+import datetime
+import decimal
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+from django.db.models import Count
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from .models import BillPayment
+
+# Rows fetched per round trip by the server side cursor
+EXPORT_CHUNK_SIZE = 2000
+
+XLSX_PARTS = (
+    ('[Content_Types].xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+     '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+     '<Default Extension="xml" ContentType="application/xml"/>'
+     '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+     '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+     '</Types>'),
+    ('_rels/.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+     '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+     '</Relationships>'),
+    ('xl/workbook.xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+     'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+     '<sheets><sheet name="Relatorio" sheetId="1" r:id="rId1"/></sheets>'
+     '</workbook>'),
+    ('xl/_rels/workbook.xml.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+     '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+     '</Relationships>'),
+)
+SHEET_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<sheetData>')
+SHEET_END = '</sheetData></worksheet>'
+# Characters XML 1.0 does not allow, not even escaped
+INVALID_XML_CHARS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+class Echo():
+    '''
+    File-like object handing back what the csv writer writes.
+    '''
+
+    def write(self, value):
+        return value
+
+
+class StreamBuffer():
+    '''
+    Unseekable file the zip archive writes to, emptied after each chunk.
+    '''
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class CSVExport():
+    content_type = 'text/csv'
+    extension = 'csv'
+
+    def stream(self, rows):
+        writer = csv.writer(Echo())
+        for row in rows:
+            yield writer.writerow(row)
+
+
+class XLSXExport():
+    '''
+    Single sheet workbook with inline strings, written straight into a
+    zip stream.
+    '''
+    content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    extension = 'xlsx'
+
+    @staticmethod
+    def cell(value):
+        if value is None:
+            return '<c/>'
+        if isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool):
+            return f'<c><v>{value}</v></c>'
+        text = escape(INVALID_XML_CHARS.sub('', str(value)))
+        return f'<c t="inlineStr"><is><t>{text}</t></is></c>'
+
+    def stream(self, rows):
+        buffer = StreamBuffer()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, content in XLSX_PARTS:
+                archive.writestr(name, content)
+            # The sheet size is not known up front, so allow it over 2GB
+            with archive.open('xl/worksheets/sheet1.xml', 'w',
+                              force_zip64=True) as sheet:
+                sheet.write(SHEET_START.encode())
+                for number, row in enumerate(rows, 1):
+                    sheet.write('<row>{}</row>'.format(
+                        ''.join(self.cell(value) for value in row)).encode())
+                    if number % EXPORT_CHUNK_SIZE == 0:
+                        yield buffer.drain()
+                sheet.write(SHEET_END.encode())
+        yield buffer.drain()
+
+
+EXPORT_FORMATS = {
+    CSVExport.extension: CSVExport,
+    XLSXExport.extension: XLSXExport,
+}
+
+
+def export_response(filename, rows, export_format=None):
+    '''
+    Download of `rows` as `filename` in `export_format` (csv by default),
+    encoded while the client reads it.
+    '''
+    exporter = EXPORT_FORMATS.get(export_format, CSVExport)()
+    response = StreamingHttpResponse(exporter.stream(rows),
+                                     content_type=exporter.content_type)
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(
+        filename, exporter.extension)
+    return response
+
+
+def payments_for_export(**filters):
+    '''
+    Payments with their establishment, table and member count loaded in
+    the same query, read in chunks.
+    '''
+    return BillPayment.objects.filter(**filters).select_related(
+        'establishment', 'bill__table').annotate(
+            member_count=Count('bill__customers')).order_by(
+                'id').iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def format_moment(moment):
+    if moment is None:
+        return ''
+    moment = timezone.localtime(moment)
+    return '{} {}:{}'.format(moment.date(), moment.hour, moment.minute)
+
+
+def table_name(payment):
+    table = payment.bill.table
+    return table.name if table is not None else ''
+
+
+def compensation_rows(establishment, month_year, payments, report):
+    '''
+    Offline payments of a month with their compensation, then the month
+    total from the compensations ledger.
+    '''
+    yield [establishment.name, month_year]
+    yield ['']
+    yield ['Conta', 'Mesa', 'Membros', 'Data Pagamento', 'Valor', 'Repasse']
+    for payment in payments:
+        value_compensation = payment.value * establishment.offline_percentage
+        yield ['#{}'.format(payment.id), table_name(payment),
+               payment.member_count, format_moment(payment.status_updated),
+               payment.value, "%.2f" % value_compensation]
+    if report is not None:
+        yield ['TOTAL', '', '', '', report['total'],
+               "%.2f" % report['compensation_value']]
+
+
+def payment_rows(payments):
+    yield ['Pagamento', 'Estabelecimento', 'Conta', 'Mesa', 'Membros', 'Data',
+           'Status', 'Valor', 'Taxa Noruh', 'Taxa Moip']
+    for payment in payments:
+        yield ['#{}'.format(payment.id), payment.establishment.name,
+               '#{}'.format(payment.bill_id), table_name(payment),
+               payment.member_count, format_moment(payment.date),
+               payment.get_status_payment_display() or '', payment.value,
+               payment.noruh_fee, payment.moip_fee]
+
+
+def start_of_day(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def parse_day(value, default):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return default
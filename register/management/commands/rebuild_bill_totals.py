@@ -0,0 +1,12 @@
+from django.core.management import BaseCommand
+from register.models import Bill
+
+
+class Command(BaseCommand):
+
+    help = "Rebuild the running totals from all bills"
+
+    def handle(self, *args, **options):
+        print("Rebuild Bills Running Totals")
+        count = Bill.rebuild_totals()
+        print(f"{count} bills totals rebuilt")
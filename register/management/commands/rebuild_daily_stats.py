@@ -0,0 +1,20 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from register.models import EstablishmentDailyStats, StatsWatermark
+
+
+class Command(BaseCommand):
+
+    help = "Rebuild the daily stats from all establishments"
+
+    def handle(self, *args, **options):
+        print("Rebuild Establishments Daily Stats")
+        with transaction.atomic():
+            now = timezone.now()
+            count = EstablishmentDailyStats.rebuild()
+            StatsWatermark.objects.update_or_create(
+                name=EstablishmentDailyStats.WATERMARK,
+                defaults={'processed_until': now})
+        print(f"{count} establishments daily stats rebuilt")
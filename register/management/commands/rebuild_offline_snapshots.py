@@ -0,0 +1,13 @@
+from django.core.management import BaseCommand
+
+from register.models import OfflineMonthSnapshot
+
+
+class Command(BaseCommand):
+
+    help = "Rebuild the offline payments snapshots of the closed months"
+
+    def handle(self, *args, **options):
+        print("Rebuild Offline Month Snapshots")
+        count = OfflineMonthSnapshot.rebuild()
+        print(f"{count} offline month snapshots rebuilt")
@@ -0,0 +1,12 @@
+from django.core.management import BaseCommand
+from register.models import EstablishmentRatingStats
+
+
+class Command(BaseCommand):
+
+    help = "Rebuild the rating stats from all establishments"
+
+    def handle(self, *args, **options):
+        print("Rebuild Establishments Rating Stats")
+        count = EstablishmentRatingStats.rebuild()
+        print(f"{count} establishments rating stats rebuilt")
@@ -0,0 +1,61 @@
+# Generated by Django 2.1.4 on 2019-06-03 14:12
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import Count, F, Q, Sum
+import django.db.models.deletion
+
+
+def populate_rating_stats(apps, schema_editor):
+    UserRating = apps.get_model('register', 'UserRating')
+    EstablishmentRatingStats = apps.get_model('register', 'EstablishmentRatingStats')
+
+    ratings = UserRating.objects.filter(
+        environment__isnull=False, food__isnull=False,
+        service__isnull=False).annotate(
+            score=F('environment') + F('food') + F('service')).values(
+                'bill__establishment').annotate(
+                    number=Count('id'),
+                    average_sum=Sum('average'),
+                    environment_sum=Sum('environment'),
+                    food_sum=Sum('food'),
+                    service_sum=Sum('service'),
+                    excellent=Count('id', filter=Q(score__gte=27)),
+                    good=Count('id', filter=Q(score__gte=18, score__lt=27)),
+                    bad=Count('id', filter=Q(score__lt=18))).order_by()
+
+    EstablishmentRatingStats.objects.bulk_create(
+        EstablishmentRatingStats(
+            establishment_id=rating.pop('bill__establishment'),
+            **dict(rating, average_sum=rating['average_sum'] or 0))
+        for rating in ratings)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('register', '0025_auto_20190529_1945'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EstablishmentRatingStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField(default=0)),
+                ('average_sum', models.DecimalField(decimal_places=1, default=Decimal('0.0'), max_digits=12)),
+                ('environment_sum', models.PositiveIntegerField(default=0)),
+                ('food_sum', models.PositiveIntegerField(default=0)),
+                ('service_sum', models.PositiveIntegerField(default=0)),
+                ('excellent', models.PositiveIntegerField(default=0)),
+                ('good', models.PositiveIntegerField(default=0)),
+                ('bad', models.PositiveIntegerField(default=0)),
+                ('establishment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='rating_stats', to='register.Establishment')),
+            ],
+            options={
+                'verbose_name': 'Establishment rating stats',
+                'verbose_name_plural': 'Establishments rating stats',
+            },
+        ),
+        migrations.RunPython(populate_rating_stats, migrations.RunPython.noop),
+    ]
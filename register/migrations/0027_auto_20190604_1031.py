@@ -0,0 +1,23 @@
+# Generated by Django 2.1.4 on 2019-06-04 13:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('register', '0026_establishmentratingstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='establishment',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='menu',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.1.4 on 2019-06-10 12:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('register', '0027_auto_20190604_1031'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='menuitem',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.CreateModel(
+            name='MenuTombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('item', 'Menu item'), ('observation', 'Item Observation')], max_length=16)),
+                ('object_id', models.PositiveIntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('establishment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='menu_tombstones', to='register.Establishment')),
+            ],
+            options={
+                'verbose_name': 'Menu tombstone',
+                'verbose_name_plural': 'Menu tombstones',
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 2.1.4 on 2019-06-11 10:04
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+BILLED_STATUSES = ('STATUS_PENDING', 'STATUS_PREPARING', 'STATUS_DONE')
+
+
+def populate_bill_totals(apps, schema_editor):
+    Bill = apps.get_model('register', 'Bill')
+    BillMember = apps.get_model('register', 'BillMember')
+    Order = apps.get_model('register', 'Order')
+
+    orders = Order.objects.filter(
+        bill=OuterRef('pk'), status__in=BILLED_STATUSES).order_by().values(
+            'bill').annotate(total=Sum('value_order')).values('total')
+    members = BillMember.objects.filter(bill=OuterRef('pk')).order_by().values(
+        'bill').annotate(total=Count('id')).values('total')
+    Bill.objects.update(
+        orders_subtotal=Coalesce(Subquery(orders), 0),
+        members_count=Coalesce(Subquery(members), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('register', '0028_auto_20190610_0915'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bill',
+            name='members_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='bill',
+            name='orders_subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.RunPython(populate_bill_totals, migrations.RunPython.noop),
+    ]
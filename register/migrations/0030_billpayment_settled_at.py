@@ -0,0 +1,29 @@
+# Generated by Django 2.1.4 on 2019-06-12 16:40
+
+from django.db import migrations, models
+from django.db.models import F
+from django.db.models.functions import Coalesce
+
+APPROVED_STATUSES = ('AUTHORIZED', 'OFFLINE_APPROVED')
+
+
+def mark_approved_payments_settled(apps, schema_editor):
+    BillPayment = apps.get_model('register', 'BillPayment')
+    BillPayment.objects.filter(status_payment__in=APPROVED_STATUSES).update(
+        settled_at=Coalesce(F('status_updated'), F('date')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('register', '0029_bill_running_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='billpayment',
+            name='settled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(mark_approved_payments_settled, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 2.1.4 on 2019-06-25 10:12
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def fill_rating_created_at(apps, schema_editor):
+    Bill = apps.get_model('register', 'Bill')
+    UserRating = apps.get_model('register', 'UserRating')
+    bills = Bill.objects.filter(id=OuterRef('bill_id'))
+    UserRating.objects.filter(created_at__isnull=True).update(
+        created_at=Subquery(bills.values(
+            date=Coalesce('payment_date', 'opening_date'))[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('register', '0033_order_granted_offer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='billpayment',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='userrating',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(fill_rating_created_at, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='StatsWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('processed_until', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='EstablishmentDailyStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(db_index=True)),
+                ('bills_opened', models.PositiveIntegerField(default=0)),
+                ('orders_placed', models.PositiveIntegerField(default=0)),
+                ('orders_cancelled', models.PositiveIntegerField(default=0)),
+                ('items_sold', models.PositiveIntegerField(default=0)),
+                ('payments_approved', models.PositiveIntegerField(default=0)),
+                ('revenue_online', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('revenue_offline', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('moip_fees', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('noruh_fees', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('rating_sum', models.DecimalField(decimal_places=1, default=Decimal('0.0'), max_digits=12)),
+                ('rating_count', models.PositiveIntegerField(default=0)),
+                ('establishment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='register.Establishment')),
+            ],
+            options={
+                'verbose_name': 'Establishment daily stats',
+                'verbose_name_plural': 'Establishments daily stats',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='establishmentdailystats',
+            unique_together={('establishment', 'day')},
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.1.4 on 2019-06-27 09:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('register', '0034_establishment_daily_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OfflineMonthSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('month', models.IntegerField()),
+                ('total', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('compensation_value', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('establishment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='offline_months', to='register.Establishment')),
+            ],
+            options={
+                'verbose_name': 'Offline month snapshot',
+                'verbose_name_plural': 'Offline month snapshots',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='offlinemonthsnapshot',
+            unique_together={('establishment', 'year', 'month')},
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.1.4 on 2019-07-01 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('register', '0035_offlinemonthsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStatsChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('establishment_id', models.IntegerField(null=True)),
+                ('bill_id', models.IntegerField(db_index=True, null=True)),
+                ('day', models.DateField()),
+            ],
+        ),
+    ]
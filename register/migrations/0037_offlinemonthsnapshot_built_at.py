@@ -0,0 +1,19 @@
+# Generated by Django 2.1.4 on 2019-07-02 10:05
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('register', '0036_dailystatschange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='offlinemonthsnapshot',
+            name='built_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,6 +1,8 @@
 import calendar
+import math
 import os
 import json
+import threading
 import datetime
 import uuid
 
@@ -8,20 +10,26 @@ from unipath import Path
 from decimal import Decimal
 
 from django.conf import settings
-from django.db import models
-from django.db.models import Func, Avg, Count, Sum
+from django.db import models, transaction
+from django.db.models import (
+    F, Func, Q, Avg, Count, Max, Sum, OuterRef, Prefetch, Subquery)
+from django.db.models.functions import Coalesce, TruncDate, TruncMonth
 from django.contrib.gis.db import models as gis_models
+from django.contrib.gis.db.models.functions import Distance
+from django.contrib.gis.measure import D
 from django.utils.translation import gettext as _
 from django.contrib.auth.models import User, Group
-from django.db.models.signals import pre_save, post_save, post_delete
-from django.shortcuts import get_object_or_404
+from django.db.models.signals import (
+    pre_save, post_save, pre_delete, post_delete, m2m_changed)
 from django.dispatch import receiver
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.urls import reverse
 from django.core.validators import FileExtensionValidator
 
 from fcm_django.models import FCMDevice
-from noruh_backend.pusher import PusherNotification
+from noruh_backend.celery import app as celery_app
+from noruh_backend.pusher import PusherNotification, STAFF_CHANNEL
 from noruh_backend.settings import ORDER_REMOTE, ORDER_REMOTE_TABLE_ZONE
 from noruh_backend.firestore_connect import NoruhFireStore
 
@@ -32,6 +40,10 @@ from register.exceptions import (
 )
 from register.convert_json import objects_to_json
 
+# Ids of the establishments whose delete is cascading in this thread, see
+# `Establishment.deleting`
+_deleting = threading.local()
+
 DAYS_OF_WEEK = (
     (calendar.SUNDAY, _('Sunday')),
     (calendar.MONDAY, _('Monday')),
@@ -43,6 +55,14 @@ DAYS_OF_WEEK = (
 )
 
 
+def month_days(date):
+    '''
+    First and last day of the month of `date`.
+    '''
+    last = calendar.monthrange(date.year, date.month)[1]
+    return date.replace(day=1), date.replace(day=last)
+
+
 def upload_to(instance, filename):
     """
     Set path to Profile Image
@@ -79,16 +99,19 @@ class TokenRecoverPassword(models.Model):
         return self.token.hex
 
 
-class Month(Func):
-    function = 'EXTRACT'
-    template = '%(function)s(MONTH from %(expressions)s)'
-    output_field = models.IntegerField()
+class KNNDistance(Func):
+    '''
+    PostGIS `<->` operator, ordering by it walks the spatial index and
+    returns the nearest rows first without computing every distance.
+    '''
+    template = '%(expressions)s'
+    arg_joiner = ' <-> '
+    output_field = models.FloatField()
 
 
-class Year(Func):
-    function = 'EXTRACT'
-    template = '%(function)s(YEAR from %(expressions)s)'
-    output_field = models.IntegerField()
+# A degree of latitude is 110.57km at the equator and longer elsewhere,
+# rounding down keeps the degree bounding of a radius search on the wide side
+KM_PER_DEGREE = 110.5
 
 
 class Profile(models.Model):
@@ -228,6 +251,70 @@ class MoipWirecardAPP(models.Model):
         verbose_name_plural = _('APP Moip Wirecards')
 
 
+class EstablishmentQuerySet(models.QuerySet):
+
+    RATING_FIELDS = (
+        'average_avg', 'average_environment', 'average_food',
+        'average_service', 'number_of_evaluations', 'excellent_evaluations',
+        'good_evaluations', 'bad_evaluations')
+    PREFETCH_FIELDS = (
+        'amenities', 'photos', 'promotions', 'events', 'operating_hours')
+
+    def with_api_relations(self, fields=None):
+        '''
+        Load everything EstablishmentSerializer reads, so a page of
+        establishments costs the same number of queries for any page size.
+        With `fields`(the sparse fieldset requested) only the relations
+        needed by those fields are loaded.
+        '''
+        def wanted(*names):
+            return fields is None or any(name in fields for name in names)
+
+        queryset = self
+        if wanted('cuisine_type'):
+            queryset = queryset.select_related('cuisine_type')
+        if wanted(*self.RATING_FIELDS):
+            queryset = queryset.select_related('rating_stats')
+
+        prefetches = [name for name in self.PREFETCH_FIELDS if wanted(name)]
+        if prefetches:
+            queryset = queryset.prefetch_related(*prefetches)
+
+        if wanted('table_order_remote_id'):
+            table_order_remote = Table.objects.filter(
+                establishment=OuterRef('pk'), name=ORDER_REMOTE).values('id')[:1]
+            queryset = queryset.annotate(
+                table_order_remote_id=Subquery(table_order_remote))
+        return queryset
+
+    def within_radius(self, point, radius_km):
+        '''
+        Establishments up to `radius_km` from `point`, nearest first. The
+        ST_DWithin in degrees is answered by the spatial index and discards
+        the far rows before the exact distance is checked. The degrees are
+        taken at the edge of the radius closest to a pole, where a degree of
+        longitude is shortest, so no row inside the radius is discarded.
+        '''
+        edge_latitude = min(abs(point.y) + radius_km / KM_PER_DEGREE, 90)
+        latitude_factor = max(math.cos(math.radians(edge_latitude)), 0.01)
+        degrees = radius_km / (KM_PER_DEGREE * latitude_factor)
+
+        return self.filter(
+            geo_loc__dwithin=(point, degrees),
+            geo_loc__distance_lte=(point, D(km=radius_km))).annotate(
+                distance=Distance('geo_loc', point)).order_by('distance')
+
+    def nearest(self, point):
+        '''
+        Establishments ordered by the KNN operator, slice the result to get
+        the nearest N.
+        '''
+        geo_point = models.Value(point, output_field=gis_models.PointField())
+        return self.annotate(
+            knn_distance=KNNDistance('geo_loc', geo_point),
+            distance=Distance('geo_loc', point)).order_by('knn_distance')
+
+
 class Establishment(models.Model):
     '''
     Based on RF002
@@ -267,6 +354,11 @@ class Establishment(models.Model):
     taxe_couvert = models.DecimalField(
         max_digits=4, decimal_places=2, default=Decimal("00.00"))
 
+    # Changed on every update of the data sent by the establishment API
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = EstablishmentQuerySet.as_manager()
+
     class Meta:
         verbose_name = _('Establishment')
         verbose_name_plural = _('Establishments')
@@ -293,52 +385,52 @@ class Establishment(models.Model):
     def get_absolute_url(self):
         return reverse("register:establishment_base", kwargs={"pk": self.pk})
 
-    def calculate_evaluations(self):
-        all_evaluations = UserRating.objects.filter(
-            bill__establishment__id=self.id)
-        obj_count = all_evaluations.count()
-        evaluation_excellent = 0
-        evaluation_good = 0
-        evaluation_bad = 0
-
-        for evaluation in all_evaluations:
-            media = (evaluation.environment +
-                     evaluation.food + evaluation.service) / 3
-            if media >= 9 <= 10:
-                evaluation_excellent = evaluation_excellent + 1
-            elif media >= 6 < 9:
-                evaluation_good = evaluation_good + 1
-            elif media >= 0 < 6:
-                evaluation_bad = evaluation_bad + 1
-
-        evaluations = {"number": obj_count,
-                       "excellent": evaluation_excellent,
-                       "good": evaluation_good,
-                       "bad": evaluation_bad}
-        return evaluations
+    def delete(self, *args, **kwargs):
+        try:
+            return super().delete(*args, **kwargs)
+        finally:
+            Establishment.deleting().discard(self.id)
 
-    def average_bills(self, current_month=None):
-        if current_month:
-            bills_for_average_ticket = BillPayment.objects.filter(
-                establishment=self,
-                date__month=current_month.month,
-                date__year=current_month.year,
-                status_payment__in=[
-                    BillPayment.STATUS_OFFLINE_APPROVED,
-                    BillPayment.STATUS_AUTHORIZED])
-        else:
-            bills_for_average_ticket = BillPayment.objects.filter(
-                establishment=self)
+    @staticmethod
+    def deleting():
+        '''
+        Ids of the establishments being deleted in this thread: set by the
+        pre_delete signal so the receivers of their cascaded rows don't
+        write rows pointing at them.
+        '''
+        if not hasattr(_deleting, 'ids'):
+            _deleting.ids = set()
+        return _deleting.ids
 
-        bills_average_value = bills_for_average_ticket.aggregate(
-            Sum('value'))
-        bills_average_value = bills_average_value.get('value__sum')
+    @staticmethod
+    def touch(**filters):
+        '''
+        Mark the establishments changed without saving the whole row.
+        '''
+        Establishment.objects.filter(**filters).update(updated_at=timezone.now())
 
-        if bills_average_value is None:
-            return 0
-        value = "{0:.2f}".format(bills_average_value / bills_for_average_ticket.count())
+    def rating_summary(self):
+        '''
+        Averages and evaluation buckets from this establishment, read from
+        the stats row maintained by the UserRating signals.
+        '''
+        try:
+            return self.rating_stats.summary()
+        except EstablishmentRatingStats.DoesNotExist:
+            return UserRating.EMPTY_SUMMARY
 
-        return Decimal(value)
+    def calculate_evaluations(self):
+        summary = self.rating_summary()
+        evaluations = {"number": summary['number'],
+                       "excellent": summary['excellent'],
+                       "good": summary['good'],
+                       "bad": summary['bad']}
+        return evaluations
+
+    def average_bills(self, current_month=None):
+        window = month_days(current_month) if current_month else (None, None)
+        return EstablishmentDailyStats.average_ticket(
+            EstablishmentDailyStats.totals(*window, establishment=self))
 
     def number_of_orders(self):
         orders = Order.objects.filter(bill__establishment=self,
@@ -346,66 +438,27 @@ class Establishment(models.Model):
         return orders.count()
 
     def noruh_tax_to_super_admin(self):
-        payments = BillPayment.objects.filter(
-            establishment=self, status_payment__in=[
-                BillPayment.STATUS_AUTHORIZED, BillPayment.STATUS_OFFLINE_APPROVED])
-        return payments.count() * self.noruh_fee
+        totals = EstablishmentDailyStats.totals(establishment=self)
+        return totals['payments_approved'] * self.noruh_fee
 
     def report_offline_payment(self):
-        bill_payments = BillPayment.objects.filter(
-            establishment=self,
-            status_payment=BillPayment.STATUS_OFFLINE_APPROVED).annotate(
-                m=Month('date'), y=Year(
-                    'date'),).values('m', 'y').annotate(total=Sum(
-                        'value')).order_by('-y', '-m')
-
-        for payment in bill_payments:
-            payment['compensation_value'] = payment.get('total') * self.offline_percentage
-            payment['establishment_id'] = self.id
-            payment['date'] = datetime.datetime(payment.get('y'), payment.get('m'), datetime.datetime.today().day)
-            compensation = OfflineCompensations.objects.filter(
-                establishment=self, month=payment.get('m'), year=payment.get('y'))
-            if compensation.exists():
-                obj = compensation.first()
-                payment['compensation'] = obj.date_compensation
-            else:
-                payment['compensation'] = False
-
-        return bill_payments
+        return OfflineMonthSnapshot.ledger(self)
 
     def report_offline_payment_with_month(self, current_month):
-        bill_payments = BillPayment.objects.filter(
-            establishment=self,
-            status_payment=BillPayment.STATUS_OFFLINE_APPROVED,
-            date__month=current_month.month,
-            date__year=current_month.year).aggregate(
-                Sum('value'))
-
-        value_payment = bill_payments.get('value__sum')
-
-        if not value_payment:
-            value_payment = Decimal(0.0)
+        value_payment = EstablishmentDailyStats.totals(
+            *month_days(current_month), establishment=self)['revenue_offline']
 
         payment_compensation = "%.2f" % (value_payment * self.offline_percentage)
         return Decimal(payment_compensation)
 
     def report_offline_all_establishments(current_month):
-        establishments = Establishment.objects.all()
+        rows = EstablishmentDailyStats.window(*month_days(current_month)).values(
+            'establishment', 'establishment__offline_percentage').annotate(
+                value_payment=Sum('revenue_offline')).order_by()
         all_compensation = 0
-        for establishment in establishments:
-            bill_payments = BillPayment.objects.filter(
-                establishment=establishment,
-                status_payment=BillPayment.STATUS_OFFLINE_APPROVED,
-                date__month=current_month.month,
-                date__year=current_month.year).aggregate(
-                    Sum('value'))
-
-            value_payment = bill_payments.get('value__sum')
-
-            if not value_payment:
-                value_payment = Decimal(0.0)
-
-            payment_compensation = "%.2f" % (value_payment * establishment.offline_percentage)
+        for row in rows:
+            payment_compensation = "%.2f" % (
+                row['value_payment'] * row['establishment__offline_percentage'])
             all_compensation = all_compensation + Decimal(payment_compensation)
 
         return Decimal(all_compensation)
@@ -424,6 +477,13 @@ class Employee(models.Model):
         (USER_DOOR_MAN, 'Atendente'),
     )
 
+    # Role used in the establishment staff Pusher channels
+    PUSHER_ROLES = {
+        USER_WAITER: 'waiter',
+        USER_KITCHEN: 'kitchen',
+        USER_DOOR_MAN: 'door_man',
+    }
+
     user = models.OneToOneField(
         User, on_delete=models.CASCADE, related_name='employee',
         verbose_name='Usuário')
@@ -449,6 +509,25 @@ class Employee(models.Model):
     def __str__(self) -> str:
         return str(self.user)
 
+    @classmethod
+    def staff_notification(cls, establishment_id, user_type, event, data):
+        '''
+        `(ids, channel, event, data)` notification reaching every employee
+        of `user_type` of the establishment through one channel.
+        '''
+        channel = PusherNotification.staff_channel(cls.PUSHER_ROLES[user_type])
+        return ([establishment_id], channel, event, data)
+
+    def can_subscribe(self, channel_name):
+        '''
+        Whether this employee may join a private staff channel: only the one
+        of their own establishment and role.
+        '''
+        match = STAFF_CHANNEL.match(channel_name)
+        return (match is not None and
+                int(match.group('establishment_id')) == self.establishment_id and
+                match.group('role') == self.PUSHER_ROLES.get(self.user_type))
+
 
 class EstablishmentManager(models.Model):
     establishment = models.ForeignKey(
@@ -613,6 +692,17 @@ class EstablishmentPromotions(models.Model):
         return f'{self.establishment.name}({self.promocode})'
 
 
+class MenuQuerySet(models.QuerySet):
+
+    def with_items(self):
+        '''
+        Load the items with their category, offer and observations, so
+        MenuSerializer costs the same number of queries for any menu size.
+        '''
+        items = MenuItem.objects.with_relations()
+        return self.prefetch_related(Prefetch('items', queryset=items))
+
+
 class Menu(models.Model):
     establishment = models.ForeignKey(Establishment,
                                       related_name='menu',
@@ -620,6 +710,10 @@ class Menu(models.Model):
     name = models.CharField(max_length=64,
                             verbose_name=_('Name'))
     enabled = models.BooleanField(default=True)
+    # Changed on every update of the menu, its items, categories and offers
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = MenuQuerySet.as_manager()
 
     class Meta:
         verbose_name = _('Menu')
@@ -635,6 +729,13 @@ class Menu(models.Model):
     def __str__(self) -> str:
         return self.name
 
+    @staticmethod
+    def touch(**filters):
+        '''
+        Mark the menus changed without saving the whole row.
+        '''
+        Menu.objects.filter(**filters).update(updated_at=timezone.now())
+
 
 class ItemCategory(models.Model):
     name = models.CharField(max_length=64)
@@ -703,6 +804,16 @@ class MenuOffer(models.Model):
         return menu_item.price - discount
 
 
+class MenuItemQuerySet(models.QuerySet):
+
+    def with_relations(self):
+        '''
+        Load what MenuItemSerializer reads in bulk.
+        '''
+        return self.select_related(
+            'category', 'offer').prefetch_related('observations')
+
+
 class MenuItem(models.Model):
     menu = models.ForeignKey(Menu,
                              related_name='items',
@@ -727,6 +838,11 @@ class MenuItem(models.Model):
     offer = models.ForeignKey(
         MenuOffer, related_name='offer',
         on_delete=models.SET_NULL, null=True, blank=True)
+    # Changed on every update of the item, its category or observations,
+    # the menu changes endpoint syncs from it
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = MenuItemQuerySet.as_manager()
 
     class Meta:
         verbose_name = _('Menu item')
@@ -742,6 +858,40 @@ class MenuItem(models.Model):
     def __str__(self) -> str:
         return f'{self.name}({self.price})'
 
+    @staticmethod
+    def touch(**filters):
+        '''
+        Mark the items changed without saving the whole row.
+        '''
+        MenuItem.objects.filter(**filters).update(updated_at=timezone.now())
+
+
+class MenuTombstone(models.Model):
+    '''
+    Record of a deleted menu item or observation, so clients syncing menu
+    changes can drop it.
+    '''
+    ITEM = 'item'
+    OBSERVATION = 'observation'
+    KIND_CHOICES = (
+        (ITEM, _('Menu item')),
+        (OBSERVATION, _('Item Observation')),
+    )
+
+    establishment = models.ForeignKey(
+        Establishment, related_name='menu_tombstones',
+        on_delete=models.CASCADE)
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    object_id = models.PositiveIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = _('Menu tombstone')
+        verbose_name_plural = _('Menu tombstones')
+
+    def __str__(self):
+        return f'{self.kind} {self.object_id}'
+
 
 class TableZone(models.Model):
     name = models.CharField(max_length=64, verbose_name=_('Name'))
@@ -817,6 +967,16 @@ class Bill(models.Model):
     offers_made_count = models.IntegerField(default=0)
     offers_used_count = models.IntegerField(default=0)
     last_offer_used = models.IntegerField(default=0)
+    # Running totals kept by the Order and BillMember signals. Like
+    # value_paid (kept by BillPayment.settle) they only change through
+    # `add_to_totals`, so concurrent writers don't overwrite them
+    orders_subtotal = models.DecimalField(
+        max_digits=10, decimal_places=2, default=0)
+    members_count = models.IntegerField(default=0)
+
+    TOTAL_FIELDS = ('orders_subtotal', 'members_count', 'value_paid')
+    # Counters of the offer engine, only moved by F() updates
+    OFFER_FIELDS = ('offers_made_count', 'offers_used_count', 'last_offer_used')
 
     class Meta:
         verbose_name = _('Bill')
@@ -829,6 +989,75 @@ class Bill(models.Model):
     def __str__(self):
         return f'{self.table.name}({self.id})'
 
+    def save(self, *args, **kwargs):
+        # A bill loaded before an order or member changed carries stale
+        # totals and counters, so a full save leaves them out
+        if not self._state.adding and not kwargs.get('update_fields'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and
+                field.name not in self.TOTAL_FIELDS + self.OFFER_FIELDS]
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def add_to_totals(bill_id, **deltas):
+        '''
+        Add the deltas to the running totals in a single UPDATE.
+        '''
+        Bill.objects.filter(id=bill_id).update(
+            **{name: F(name) + delta for name, delta in deltas.items()})
+
+    def grant_offer(self, orders):
+        '''
+        Offer engine: when the running subtotal, already counting the new
+        `orders`, passes one more step of the establishment offer range, the
+        first of them whose item has an offer unlocks it. The counters move
+        in one conditional UPDATE, so concurrent carts cannot unlock the
+        same step twice. Returns the order granted the offer, if any.
+        '''
+        offered = [order for order in orders if order.item.offer_id is not None]
+        establishment = self.establishment
+        step = establishment.offer_range_value
+        if not offered or not step or step < 0:
+            return None
+
+        subtotal = Bill.objects.values_list(
+            'orders_subtotal', flat=True).get(id=self.id)
+        unlocked = Bill.objects.filter(
+            id=self.id, last_offer_used__lte=subtotal - step,
+            offers_made_count__lte=establishment.offer_count_limit).update(
+                last_offer_used=int(subtotal // step * step),
+                offers_made_count=F('offers_made_count') + 1)
+        if not unlocked:
+            return None
+
+        order = offered[0]
+        order.granted_offer_id = order.item.offer_id
+        Order.objects.filter(id=order.id).update(granted_offer=order.granted_offer_id)
+        return order
+
+    def use_offer(self):
+        '''
+        Spend one of the offers made to the bill, False when none is left.
+        '''
+        return bool(Bill.objects.filter(
+            id=self.id, offers_used_count__lt=F('offers_made_count')).update(
+                offers_used_count=F('offers_used_count') + 1))
+
+    @classmethod
+    def rebuild_totals(cls):
+        '''
+        Recalculate the running totals of every bill from orders and members.
+        '''
+        orders = Order.objects.filter(
+            bill=OuterRef('pk'), status__in=Order.BILLED_STATUSES).order_by(
+                ).values('bill').annotate(total=Sum('value_order')).values('total')
+        members = BillMember.objects.filter(bill=OuterRef('pk')).order_by(
+            ).values('bill').annotate(total=Count('id')).values('total')
+        return cls.objects.update(
+            orders_subtotal=Coalesce(Subquery(orders), 0),
+            members_count=Coalesce(Subquery(members), 0))
+
     @property
     def number_of_orders(self):
         orders = Order.objects.filter(
@@ -871,9 +1100,7 @@ class Bill(models.Model):
         return float(payments_noruh_fee / self.establishment.noruh_fee)
 
     def number_of_customers(self):
-        if self.customers.all().count() == 0:
-            return 0
-        return self.customers.all().count()
+        return self.members_count
 
     def couvert_value(self):
         return self.establishment.taxe_couvert
@@ -882,19 +1109,14 @@ class Bill(models.Model):
         return self.establishment.noruh_fee
 
     def couvert_for_all(self):
-        return self.establishment.taxe_couvert * self.customers.all().count()
+        return self.establishment.taxe_couvert * self.members_count
 
     def noruh_fee_for_all(self):
-        return self.establishment.noruh_fee * self.customers.all().count()
+        return self.establishment.noruh_fee * self.members_count
 
     # Only value for orders
     def orders_total(self):
-        orders = Order.objects.filter(
-            bill=self,
-            status__in=[
-                Order.STATUS_PENDING,
-                Order.STATUS_PREPARING, Order.STATUS_DONE])
-        return sum(order.total_price() for order in orders)
+        return self.orders_subtotal
 
     # Value for orders and Couvert
     def orders_with_couvert_for_all(self):
@@ -902,19 +1124,20 @@ class Bill(models.Model):
 
     # Value for orders, taxe service and couvert for all bill members
     def all_value_bill(self):
-        tax_percentage = Decimal(self.orders_total()) * self.establishment.taxe_service
-        all_value = Decimal(self.orders_total()) + Decimal(self.couvert_for_all()) + tax_percentage + self.noruh_fee_for_all()
+        orders_total = Decimal(self.orders_total())
+        tax_percentage = orders_total * self.establishment.taxe_service
+        all_value = orders_total + Decimal(self.couvert_for_all()) + tax_percentage + self.noruh_fee_for_all()
         return float("%.2f" % (all_value))
 
     # All value from bill withou taxe service
     def all_value_bill_without_taxe_service(self):
-        couvert_for_all = self.customers.count() * self.establishment.taxe_couvert
-        return Decimal(self.orders_total()) + couvert_for_all
+        return Decimal(self.orders_total()) + self.couvert_for_all()
 
     # how much still have to pay
     def still_have_to_pay(self):
-        taxe_service = self.orders_total() * self.establishment.taxe_service
-        all_value = self.orders_total() + self.couvert_for_all() + taxe_service + self.noruh_fee_for_all()
+        orders_total = self.orders_total()
+        taxe_service = orders_total * self.establishment.taxe_service
+        all_value = orders_total + self.couvert_for_all() + taxe_service + self.noruh_fee_for_all()
         still_have_to_pay = all_value - self.value_paid
 
         if still_have_to_pay <= 0:
@@ -922,6 +1145,52 @@ class Bill(models.Model):
         return still_have_to_pay
 
 
+class MemberConsumption:
+    '''
+    What one member consumed on a bill, with the charges each member pays.
+    '''
+
+    def __init__(self, subtotal, establishment):
+        self.subtotal = Decimal(subtotal or 0)
+        self.service_tax = self.subtotal * establishment.taxe_service
+        self.couvert = establishment.taxe_couvert
+        self.noruh_fee = establishment.noruh_fee
+
+    @property
+    def total(self):
+        return self.subtotal + self.couvert + self.service_tax + self.noruh_fee
+
+
+class BillSplit:
+    '''
+    Consumption of every member of a bill from one grouped query on the
+    orders, so listing the members doesn't query orders once per member.
+    '''
+
+    def __init__(self, bill, users=None):
+        self.establishment = bill.establishment
+        orders = Order.objects.filter(
+            bill=bill, status__in=Order.BILLED_STATUSES)
+        if users is not None:
+            orders = orders.filter(user__in=users)
+        self.subtotals = dict(orders.values('user').annotate(
+            subtotal=Sum('value_order')).order_by().values_list(
+                'user', 'subtotal'))
+
+    def member(self, bill_member):
+        return MemberConsumption(
+            self.subtotals.get(bill_member.customer_id), self.establishment)
+
+    def attach(self, bill_members):
+        '''
+        Set `consumption` on each member and return them as a list.
+        '''
+        bill_members = list(bill_members)
+        for bill_member in bill_members:
+            bill_member.consumption = self.member(bill_member)
+        return bill_members
+
+
 class BillMember(models.Model):
     '''
     We use this model to know when each member joined to the bill.
@@ -950,40 +1219,22 @@ class BillMember(models.Model):
         self.leave_at = timezone.now()
         self.save()
 
+    @cached_property
+    def consumption(self):
+        # BillSplit.attach sets it for every member of a list at once
+        return BillSplit(self.bill, users=[self.customer_id]).member(self)
+
     def value_consumed(self):
-        orders_bm = Order.objects.filter(
-            user=self.customer, bill=self.bill, status__in=[
-                Order.STATUS_PENDING, Order.STATUS_PREPARING,
-                Order.STATUS_DONE])
-        value_consumed = 0
-        for order in orders_bm:
-            value_consumed = value_consumed + order.total_price()
-        taxe_service = value_consumed * self.bill.establishment.taxe_service
-        all_value = value_consumed + self.bill.establishment.taxe_couvert
-        return (all_value + taxe_service + self.bill.establishment.noruh_fee)
+        return self.consumption.total
 
     def value_consumed_without_tax_percentage(self):
-        orders_bm = Order.objects.filter(
-            user=self.customer, bill=self.bill, status__in=[
-                Order.STATUS_PENDING, Order.STATUS_PREPARING,
-                Order.STATUS_DONE])
-        value_consumed = 0
-        for order in orders_bm:
-            value_consumed = value_consumed + order.total_price()
-        return (value_consumed + self.bill.establishment.taxe_couvert)
+        return self.consumption.subtotal + self.consumption.couvert
 
     def value_consumed_without_taxes(self):
-        orders_bm = Order.objects.filter(
-            user=self.customer, bill=self.bill, status__in=[
-                Order.STATUS_PENDING, Order.STATUS_PREPARING,
-                Order.STATUS_DONE])
-        value_consumed = 0
-        for order in orders_bm:
-            value_consumed = value_consumed + order.total_price()
-        return value_consumed
+        return self.consumption.subtotal
 
     def calc_service_tax(self):
-        return Decimal(self.value_consumed_without_taxes()) * self.bill.establishment.taxe_service
+        return self.consumption.service_tax
 
     def order(self):
         return Order.objects.filter(user=self.customer, bill=self.bill)
@@ -993,8 +1244,6 @@ class BillMember(models.Model):
             bill_member=self, bill=self.bill).order_by('-date').first()
 
     def answer_to_bill_member(bill_member, answer):
-        device = FCMDevice.objects.filter(user=bill_member.customer)
-
         customer_name = '{} {}'.format(
             bill_member.customer.first_name,
             bill_member.customer.last_name)
@@ -1010,24 +1259,27 @@ class BillMember(models.Model):
         if answer:
             dict_data = {'key': 'bill_join_accepted', 'data': data}
             body_msg = "Você já pode fazer pedidos no estabelecimento "f'{bill_member.bill.establishment.name}'
-            device.send_message("Pode Começar a pedir",
-                                body_msg, data=dict_data)
-            bill_member.joined_at = timezone.now()
-            bill_member.save()
+            with transaction.atomic():
+                bill_member.joined_at = timezone.now()
+                bill_member.save()
+                OutboxMessage.send_fcm([bill_member.customer_id],
+                                       "Pode Começar a pedir",
+                                       body_msg, data=dict_data)
             return True
 
         else:
             dict_data = {'key': 'bill_join_refused', 'data': data}
-            device.send_message("Solicitação Negada",
-                                "Sua entrada na conta não foi autorizada",
-                                data=dict_data)
-            BillMember.objects.get(id=bill_member.id).delete()
+            with transaction.atomic():
+                BillMember.objects.get(id=bill_member.id).delete()
+                OutboxMessage.send_fcm([bill_member.customer_id],
+                                       "Solicitação Negada",
+                                       "Sua entrada na conta não foi autorizada",
+                                       data=dict_data)
             return False
 
     def send_fcm_notification_to_owner(self, user_join):
         owner = BillMember.objects.filter(
             bill=self.bill, leave_at__isnull=True).order_by('joined_at').first()
-        device = FCMDevice.objects.filter(user=owner.customer)
 
         customer_name = '{} {}'.format(
             self.customer.first_name,
@@ -1041,8 +1293,9 @@ class BillMember(models.Model):
 
         data = json.dumps(data, default=objects_to_json)
         dict_data = {'key': 'new_bill_member', 'data': data}
-        device.send_message("Solicitação para entrar na sua conta",
-                            body_msg, data=dict_data)
+        OutboxMessage.send_fcm([owner.customer_id],
+                               "Solicitação para entrar na sua conta",
+                               body_msg, data=dict_data)
         return True
 
 
@@ -1090,6 +1343,19 @@ class Order(models.Model):
         (STATUS_PREPARING, 'STATUS_PREPARING'),
         (STATUS_DONE, 'STATUS_DONE'),
     )
+    # Orders that count in the bill total
+    BILLED_STATUSES = (STATUS_PENDING, STATUS_PREPARING, STATUS_DONE)
+
+    # Kitchen actions: statuses they apply to, new status, timestamp set
+    # and the title, key and verb of the notification to the customers
+    KITCHEN_TRANSITIONS = {
+        'accept': ((STATUS_PENDING, ), STATUS_PREPARING, 'kitchen_accepted_at',
+                   'Pedido Aceito', 'order_accepted', 'aceitou'),
+        'done': ((STATUS_PREPARING, ), STATUS_DONE, 'kitchen_finished_at',
+                 'Pedido Pronto', 'order_ready', 'finalizou'),
+        'cancel': ((STATUS_PENDING, STATUS_PREPARING), STATUS_REJECTED,
+                   'canceled_at', 'Pedido Recusado', 'order_refused', 'cancelou'),
+    }
 
     user = models.ForeignKey(
         User, on_delete=models.CASCADE, null=True, blank=True)
@@ -1102,10 +1368,16 @@ class Order(models.Model):
     canceled_at = models.DateTimeField(null=True, blank=True)
     kitchen_accepted_at = models.DateTimeField(null=True, blank=True)
     kitchen_finished_at = models.DateTimeField(null=True, blank=True)
+    # Cursor of the kitchen feed, moved by every status change
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     status = models.CharField(
         max_length=25, choices=STATUS_CHOICES, default=STATUS_PENDING)
     value_order = models.DecimalField(
         null=True, blank=True, max_digits=8, decimal_places=2)
+    # Offer unlocked when this order was placed, see `Bill.grant_offer`
+    granted_offer = models.ForeignKey(
+        MenuOffer, related_name='+', on_delete=models.SET_NULL,
+        null=True, blank=True)
 
     class Meta:
         verbose_name = _('Order')
@@ -1123,41 +1395,124 @@ class Order(models.Model):
     def total_price(self):
         return Decimal(self.value_order or 0.00)
 
+    def billed_value(self):
+        if self.status in Order.BILLED_STATUSES:
+            return self.total_price()
+        return Decimal('0.00')
+
     def cancel_order(self):
         self.status = Order.STATUS_REJECTED
         self.canceled_at = timezone.now()
         body_msg = "O restaurante " f'{self.bill.establishment.name}' " cancelou o seu pedido"
-        self.send_fcm_push_notifications(
-            'Pedido Recusado',
-            'order_refused',
-            body_msg)
-        self.save()
-
-    def create_order(item, user):
-        bill = get_object_or_404(Bill, id=item.get('bill'))
-        menu_item = get_object_or_404(MenuItem, id=item.get('item'))
-        quantity = item.get('quantity')
-        observation = item.get('observation')
+        with transaction.atomic():
+            self.save()
+            self.send_fcm_push_notifications(
+                'Pedido Recusado',
+                'order_refused',
+                body_msg)
 
-        return Order.objects.create(
-            user=user, bill=bill, item=menu_item,
-            quantity=quantity, observation=observation,
-            status=Order.STATUS_PENDING)
+    @classmethod
+    def create_orders(cls, items, user):
+        '''
+        Insert the orders of a validated cart in one query, with the
+        `value_order` the `update_value_order` signal would set.
+        '''
+        orders = cls.objects.bulk_create([
+            cls(user=user, bill=item['bill'], item=item['item'],
+                quantity=item['quantity'], observation=item.get('observation'),
+                status=cls.STATUS_PENDING,
+                value_order=item['item'].price * item['quantity'])
+            for item in items])
+
+        # bulk_create sends no post_save, so add to the bill totals here
+        subtotals = {}
+        for order in orders:
+            subtotals[order.bill_id] = subtotals.get(
+                order.bill_id, Decimal('0.00')) + order.billed_value()
+        for bill_id, subtotal in subtotals.items():
+            Bill.add_to_totals(bill_id, orders_subtotal=subtotal)
+
+        bills = {}
+        for order in orders:
+            bills.setdefault(order.bill, []).append(order)
+        for bill, bill_orders in bills.items():
+            bill.grant_offer(bill_orders)
+        return orders
+
+    @classmethod
+    def transition(cls, establishment_id, order_ids, action):
+        '''
+        Apply the kitchen `action` to the orders of the establishment in a
+        single UPDATE and notify the customers once per bill. Returns the
+        orders changed; ids missing or in a status the action does not
+        apply to are left alone.
+        '''
+        from_statuses, status, timestamp_field = cls.KITCHEN_TRANSITIONS[action][:3]
+        now = timezone.now()
+        with transaction.atomic():
+            orders = list(cls.objects.select_for_update(of=('self', )).filter(
+                id__in=order_ids, bill__establishment_id=establishment_id,
+                status__in=from_statuses).select_related(
+                    'user', 'item', 'bill__establishment'))
+            if not orders:
+                return []
+
+            cls.objects.filter(id__in=[order.id for order in orders]).update(
+                **{'status': status, timestamp_field: now, 'updated_at': now})
+
+            # The UPDATE skips the signals keeping the bill totals
+            removed = {}
+            for order in orders:
+                billed = order.billed_value()
+                order.status = status
+                order.updated_at = now
+                setattr(order, timestamp_field, now)
+                if billed != order.billed_value():
+                    removed[order.bill_id] = removed.get(
+                        order.bill_id, Decimal('0.00')) + billed
+            for bill_id, value in removed.items():
+                Bill.add_to_totals(bill_id, orders_subtotal=-value)
+
+            cls.notify_transition(orders, action)
+        return orders
+
+    @classmethod
+    def notify_transition(cls, orders, action):
+        title, key, verb = cls.KITCHEN_TRANSITIONS[action][3:]
+        bills = {}
+        for order in orders:
+            bills.setdefault(order.bill, []).append(order)
+        customers = {}
+        for bill_id, customer in BillMember.objects.filter(
+                bill__in=bills).values_list('bill_id', 'customer'):
+            customers.setdefault(bill_id, []).append(customer)
+
+        for bill, bill_orders in bills.items():
+            establishment = bill.establishment
+            # Same key and `data` as a single order, so older apps still
+            # read the first one; `orders` carries every order of the bill
+            data = {'key': key, 'data': bill_orders[0].notification_data()}
+            if len(bill_orders) == 1:
+                body_msg = f'O restaurante {establishment.name} {verb} o seu pedido'
+            else:
+                body_msg = (f'O restaurante {establishment.name} {verb} '
+                            f'{len(bill_orders)} pedidos seus')
+                data['orders'] = json.dumps(
+                    [json.loads(order.notification_data())
+                     for order in bill_orders])
+            OutboxMessage.send_fcm(customers.get(bill.id, []), title, body_msg,
+                                   icon=establishment.logo_url.url, data=data)
+
+        OutboxMessage.send_to_staff(
+            orders[0].bill.establishment_id, Employee.USER_KITCHEN,
+            'orders_updated', {'orders': [order.id for order in orders]})
 
     def send_pusher_notification(self):
-        kitchens = User.objects.filter(id__in=Employee.objects.filter(
-            establishment=self.bill.establishment,
-            user_type=Employee.USER_KITCHEN).values('user'))
-        list_kitchens = [kitchen.id for kitchen in kitchens]
-        return PusherNotification.send_notifications(
-            list_kitchens, 'kitchen', 'cancels_existing_order',
-            {'order_id': self.id})
-
-    def send_fcm_push_notifications(self, title, key, body_msg):
-        devices = FCMDevice.objects.filter(
-            user_id__in=BillMember.objects.filter(
-                bill=self.bill).values('customer'))
+        return OutboxMessage.send_to_staff(
+            self.bill.establishment_id, Employee.USER_KITCHEN,
+            'cancels_existing_order', {'order_id': self.id})
 
+    def notification_data(self):
         user_full_name = '{} {}'.format(self.user.first_name, self.user.last_name)
         order_dict = {'id': self.id, 'user': self.user.id,
                       'name': user_full_name,
@@ -1170,11 +1525,16 @@ class Order(models.Model):
                       'kitchen_accepted_at': self.kitchen_accepted_at,
                       'kitchen_finished_at': self.kitchen_finished_at,
                       'status': self.status}
-        order_dict = json.dumps(order_dict, default=objects_to_json)
-        dict_data = {'key': key, 'data': order_dict}
-        devices.send_message(title, body_msg,
-                             icon=self.bill.establishment.logo_url.url,
-                             data=dict_data)
+        return json.dumps(order_dict, default=objects_to_json)
+
+    def send_fcm_push_notifications(self, title, key, body_msg):
+        customers = BillMember.objects.filter(
+            bill=self.bill).values_list('customer', flat=True)
+
+        dict_data = {'key': key, 'data': self.notification_data()}
+        OutboxMessage.send_fcm(customers, title, body_msg,
+                               icon=self.bill.establishment.logo_url.url,
+                               data=dict_data)
 
 
 class BillPayment(models.Model):
@@ -1194,6 +1554,7 @@ class BillPayment(models.Model):
         (STATUS_OFFLINE_APPROVED, 'Offline Aprovado'),
         (STATUS_OFFLINE_CANCELLED, 'Offline Cancelado'),
     )
+    APPROVED_STATUSES = (STATUS_AUTHORIZED, STATUS_OFFLINE_APPROVED)
 
     payment_uuid = models.CharField(max_length=65, unique=True)
     establishment = models.ForeignKey(Establishment, on_delete=models.CASCADE)
@@ -1219,6 +1580,10 @@ class BillPayment(models.Model):
         max_digits=8, decimal_places=2, default=0.00)
     moip_fee = models.DecimalField(
         max_digits=8, decimal_places=2, default=0.00)
+    # When the value was added to the bill, see `settle`
+    settled_at = models.DateTimeField(null=True, blank=True)
+    # Watermark of the daily stats refresh
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     class Meta:
         verbose_name = _('Bill payment')
@@ -1262,22 +1627,18 @@ class BillPayment(models.Model):
         }
 
     def send_pusher_notification(self, bill, user):
-        waiters = User.objects.filter(id__in=Employee.objects.filter(
-            establishment=bill.establishment,
-            user_type=Employee.USER_WAITER).values('user'))
-        list_waiters = [waiter.id for waiter in waiters]
         data = {'bill_id': bill.id, 'username': user.first_name,
                 'status': BillPayment.STATUS_OFFLINE_PENDING}
-        return PusherNotification.send_notifications(
-            list_waiters, 'waiter', 'payment_verification', data)
+        return OutboxMessage.send_to_staff(
+            bill.establishment_id, Employee.USER_WAITER,
+            'payment_verification', data)
 
     def reject_offline_payment(self):
         self.status_updated = timezone.now()
         self.status_payment = BillPayment.STATUS_OFFLINE_CANCELLED
-        devices = FCMDevice.objects.filter(
-            user__in=BillMember.objects.filter(
-                bill=self.bill, leave_at__isnull=False).values('customer'))
-        self.save()
+        customers = list(BillMember.objects.filter(
+            bill=self.bill, leave_at__isnull=False).values_list(
+                'customer', flat=True))
 
         user_full_name = '{} {}'.format(self.bill_member.customer.first_name, self.bill_member.customer.last_name)
         body_msg = "O pagamento de R$" f'{self.value}' " foi recusado"
@@ -1289,82 +1650,172 @@ class BillPayment(models.Model):
         data_payment = json.dumps(data_payment, default=objects_to_json)
         payment_dict = {"key": "payment_refused", "data": data_payment}
 
-        devices.send_message("Pagamento Recusado", body_msg,
-                             icon=self.bill.establishment.logo_url.url,
-                             data=payment_dict)
-
-        noruh_firestore = NoruhFireStore()
-        data_notification = self.notification_payload(key='payment_refused')
-        noruh_firestore.add_data_on_collection(data_notification)
+        with transaction.atomic():
+            self.save()
+            OutboxMessage.send_fcm(customers, "Pagamento Recusado", body_msg,
+                                   icon=self.bill.establishment.logo_url.url,
+                                   data=payment_dict)
+            OutboxMessage.send_firestore(
+                self.notification_payload(key='payment_refused'))
 
-    def approve_offline_payment(self):
-        self.status_updated = timezone.now()
-        self.status_payment = BillPayment.STATUS_OFFLINE_APPROVED
-        devices = FCMDevice.objects.filter(
-            user__in=BillMember.objects.filter(
-                bill=self.bill, leave_at__isnull=True).values('customer'))
-        self.save()
+    def settle(self, status_payment=None, close=False, notify=None):
+        '''
+        Apply this payment to its bill, once, with the bill row locked.
 
-        bill = self.bill
-        bill.value_paid = self.bill.value_paid + self.value
-        bill.save()
+        The value is added to `value_paid` with F(), the totals are read
+        once and the bill closes when the paid value covers them (or when
+        `close` is set); otherwise only the payer leaves. `notify` gets the
+        Settlement inside the same transaction to queue its OutboxMessages,
+        so notifications never go out for a rolled back payment.
+        '''
+        with transaction.atomic():
+            bill = Bill.objects.select_for_update(of=('self',)).select_related(
+                'establishment').get(id=self.bill_id)
+            payment = BillPayment.objects.select_for_update(of=('self',)).select_related(
+                'promocode', 'bill_member').get(id=self.id)
+            now = timezone.now()
+
+            if status_payment is not None:
+                payment.status_payment = status_payment
+                payment.status_updated = now
+            applied = (payment.status_payment in BillPayment.APPROVED_STATUSES and
+                       payment.settled_at is None)
+            if applied:
+                payment.settled_at = now
+            payment.save(update_fields=[
+                'status_payment', 'status_updated', 'settled_at', 'updated_at'])
+
+            members = BillMember.objects.filter(
+                bill_id=bill.id, leave_at__isnull=True)
+            recipients = list(members.values_list('customer_id', flat=True))
+            closed = False
+
+            if applied:
+                Bill.add_to_totals(bill.id, value_paid=payment.value)
+                bill.refresh_from_db(fields=Bill.TOTAL_FIELDS)
+
+                all_value_bill = Decimal(str(bill.all_value_bill()))
+                if payment.promocode is not None:
+                    all_value_bill -= payment.promocode.value
+                closed = bill.payment_date is None and (close or (
+                    bill.all_value_bill_without_taxe_service() <=
+                    bill.value_paid <= all_value_bill))
+
+                if closed:
+                    bill.payment_date = now
+                    Bill.objects.filter(id=bill.id).update(payment_date=now)
+                elif payment.bill_member is not None:
+                    members = members.filter(
+                        customer_id=payment.bill_member.customer_id)
+                else:
+                    members = members.none()
+                members.update(leave_at=now)
+
+            settlement = Settlement(bill, payment, applied, closed, recipients)
+            if notify is not None:
+                notify(settlement)
+
+        self.refresh_from_db(fields=['status_payment', 'status_updated', 'settled_at'])
+        return settlement
 
-        user_full_name = '{} {}'.format(self.bill_member.customer.first_name, self.bill_member.customer.last_name)
-        body_msg = "O pagamento de R$" f'{self.value}' " foi aprovado"
-        data_payment = {"bill_id": self.bill.id,
+    def approve_offline_payment(self):
+        self.settle(BillPayment.STATUS_OFFLINE_APPROVED,
+                    notify=BillPayment.notify_offline_approval)
+
+    @staticmethod
+    def notify_offline_approval(settlement):
+        if not settlement.applied:
+            return
+        payment = settlement.payment
+        bill = settlement.bill
+
+        user_full_name = '{} {}'.format(payment.bill_member.customer.first_name, payment.bill_member.customer.last_name)
+        body_msg = "O pagamento de R$" f'{payment.value}' " foi aprovado"
+        data_payment = {"bill_id": bill.id,
                         "user_name": user_full_name,
-                        "user_id": self.bill_member.customer.id,
-                        "status_payment": self.status_payment,
-                        "value": self.value}
+                        "user_id": payment.bill_member.customer.id,
+                        "status_payment": payment.status_payment,
+                        "value": payment.value}
         data_payment = json.dumps(data_payment, default=objects_to_json)
         payment_dict = {"key": "payment_accepted", "data": data_payment}
 
-        devices.send_message("Pagamento Aprovado", body_msg,
-                             icon=self.bill.establishment.logo_url.url,
-                             data=payment_dict)
+        OutboxMessage.send_fcm(settlement.recipients, "Pagamento Aprovado",
+                               body_msg, icon=bill.establishment.logo_url.url,
+                               data=payment_dict)
+        OutboxMessage.send_firestore(
+            payment.notification_payload(key='payment_accepted'))
+
+        if settlement.closed:
+            data = {"bill_id": bill.id,
+                    "username": payment.bill_member.customer.first_name,
+                    "payment_status": payment.status_payment,
+                    "table": bill.table.name}
 
-        noruh_firestore = NoruhFireStore()
-        data_notification = self.notification_payload(key='payment_accepted')
-        noruh_firestore.add_data_on_collection(data_notification)
+            OutboxMessage.send_to_staff(
+                bill.establishment_id, Employee.USER_DOOR_MAN,
+                "payment_confirm", data)
+            settlement.notify_bill_closed()
 
-        if self.promocode is not None:
-            all_value_bill = (all_value_bill - self.promocode.value)
 
-        if float(bill.value_paid) >= float(bill.all_value_bill_without_taxe_service()) and float(bill.value_paid) <= bill.all_value_bill():
-            door_mans = User.objects.filter(
-                id__in=Employee.objects.filter(
-                    establishment=self.bill.establishment,
-                    user_type=Employee.USER_DOOR_MAN).values('user'))
+class Settlement:
+    '''
+    Outcome of `BillPayment.settle`: whether the payment was applied now,
+    whether it closed the bill and who was at the table before it.
+    '''
 
-            list_door_mans = [door_man.id for door_man in door_mans]
-            data = {"bill_id": self.bill.id,
-                    "username": self.bill_member.customer.first_name,
-                    "payment_status": self.status_payment,
-                    "table": self.bill.table.name}
+    def __init__(self, bill, payment, applied, closed, recipients):
+        self.bill = bill
+        self.payment = payment
+        self.applied = applied
+        self.closed = closed
+        self.recipients = recipients
 
-            PusherNotification.send_notifications(
-                list_door_mans, "door_man", "payment_confirm", data)
+    def notify_bill_closed(self):
+        OutboxMessage.send_firestore({
+            'action': 'bill_closed',
+            'billId': self.bill.id,
+            'createdAt': timezone.now().isoformat()
+        })
 
-            self.bill.payment_date = timezone.now()
-            BillMember.objects.filter(
-                bill=self.bill.id, leave_at__isnull=True).update(
-                leave_at=timezone.now())
-            self.save()
-            self.bill.save()
-            noruh_firestore = NoruhFireStore()
-            data_notification = {
-                'action': 'bill_closed',
-                'billId': bill.id,
-                'createdAt': timezone.now().isoformat()
-            }
-            noruh_firestore.add_data_on_collection(data_notification)
 
-        BillMember.objects.filter(
-            bill=self.bill, customer=self.bill_member.customer,
-            leave_at__isnull=True).update(leave_at=timezone.now())
+class UserRatingQuerySet(models.QuerySet):
+
+    def stats_by_establishment(self):
+        '''
+        Group the ratings by establishment in one query, with the same
+        totals kept by EstablishmentRatingStats. The buckets follow the rule
+        from `UserRating.evaluation_bucket`.
+        '''
+        ratings = self.filter(
+            environment__isnull=False, food__isnull=False,
+            service__isnull=False).annotate(
+                score=F('environment') + F('food') + F('service')).values(
+                    'bill__establishment').annotate(
+                        number=Count('id'),
+                        average_sum=Sum('average'),
+                        environment_sum=Sum('environment'),
+                        food_sum=Sum('food'),
+                        service_sum=Sum('service'),
+                        excellent=Count('id', filter=Q(score__gte=27)),
+                        good=Count('id', filter=Q(score__gte=18, score__lt=27)),
+                        bad=Count('id', filter=Q(score__lt=18))).order_by()
+
+        return {rating.pop('bill__establishment'): rating
+                for rating in ratings}
 
 
 class UserRating(models.Model):
+    EMPTY_SUMMARY = {
+        'number': 0,
+        'average_avg': None,
+        'average_environment': None,
+        'average_food': None,
+        'average_service': None,
+        'excellent': 0,
+        'good': 0,
+        'bad': 0,
+    }
+
     bill = models.ForeignKey(Bill, on_delete=models.CASCADE)
     user = models.ForeignKey(BillMember, on_delete=models.CASCADE)
     environment = models.PositiveSmallIntegerField(null=True, blank=True)
@@ -1373,6 +1824,9 @@ class UserRating(models.Model):
     observation = models.TextField(null=True, blank=True)
     average = models.DecimalField(
         null=True, blank=True, max_digits=5, decimal_places=1)
+    created_at = models.DateTimeField(auto_now_add=True, null=True, db_index=True)
+
+    objects = UserRatingQuerySet.as_manager()
 
     class Meta:
         verbose_name = _('User rating')
@@ -1386,6 +1840,388 @@ class UserRating(models.Model):
     def __str__(self):
         return f'{self.user}'
 
+    def evaluation_bucket(self):
+        '''
+        Excellent for a media from 9, good from 6 and bad below it. Ratings
+        without all the notes are not counted.
+        '''
+        if None in (self.environment, self.food, self.service):
+            return None
+
+        score = self.environment + self.food + self.service
+        if score >= 27:
+            return 'excellent'
+        elif score >= 18:
+            return 'good'
+        return 'bad'
+
+
+class EstablishmentRatingStats(models.Model):
+    '''
+    Running totals from the ratings of an establishment, updated on each
+    UserRating created, edited or deleted, so reads never aggregate the
+    ratings.
+    '''
+    establishment = models.OneToOneField(
+        Establishment, on_delete=models.CASCADE, related_name='rating_stats')
+    number = models.PositiveIntegerField(default=0)
+    average_sum = models.DecimalField(
+        max_digits=12, decimal_places=1, default=Decimal('0.0'))
+    environment_sum = models.PositiveIntegerField(default=0)
+    food_sum = models.PositiveIntegerField(default=0)
+    service_sum = models.PositiveIntegerField(default=0)
+    excellent = models.PositiveIntegerField(default=0)
+    good = models.PositiveIntegerField(default=0)
+    bad = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = _('Establishment rating stats')
+        verbose_name_plural = _('Establishments rating stats')
+
+    def __str__(self):
+        return f'{self.establishment}({self.number})'
+
+    def summary(self):
+        if not self.number:
+            return UserRating.EMPTY_SUMMARY
+
+        return {
+            'number': self.number,
+            'average_avg': float(self.average_sum) / self.number,
+            'average_environment': self.environment_sum / self.number,
+            'average_food': self.food_sum / self.number,
+            'average_service': self.service_sum / self.number,
+            'excellent': self.excellent,
+            'good': self.good,
+            'bad': self.bad,
+        }
+
+    @classmethod
+    def apply_rating(cls, rating, sign=1):
+        '''
+        Add (sign=1) or remove (sign=-1) a rating from the establishment
+        totals with a single UPDATE, so concurrent ratings do not overwrite
+        each other.
+        '''
+        bucket = rating.evaluation_bucket()
+        if bucket is None:
+            return
+
+        establishment_id = Bill.objects.filter(
+            id=rating.bill_id).values_list('establishment_id', flat=True).first()
+        with transaction.atomic():
+            if sign > 0:
+                cls.objects.get_or_create(establishment_id=establishment_id)
+            cls.objects.filter(establishment_id=establishment_id).update(
+                number=F('number') + sign,
+                average_sum=F('average_sum') + sign * (rating.average or 0),
+                environment_sum=F('environment_sum') + sign * rating.environment,
+                food_sum=F('food_sum') + sign * rating.food,
+                service_sum=F('service_sum') + sign * rating.service,
+                **{bucket: F(bucket) + sign})
+            Establishment.touch(id=establishment_id)
+
+    @classmethod
+    def rebuild(cls):
+        '''
+        Recreate every stats row from the ratings table.
+        '''
+        stats = UserRating.objects.all().stats_by_establishment()
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(
+                cls(establishment_id=establishment_id,
+                    **dict(values, average_sum=values['average_sum'] or 0))
+                for establishment_id, values in stats.items())
+        return len(stats)
+
+
+class StatsWatermark(models.Model):
+    '''
+    Moment up to which a rollup table has taken in the changes of its
+    source tables.
+    '''
+    name = models.CharField(max_length=64, unique=True)
+    processed_until = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.name}({self.processed_until})'
+
+
+class DailyStatsChange(models.Model):
+    '''
+    Day of the daily stats left stale by a deleted row, since deleted rows
+    leave no `updated_at` for the refresh to find. Rows from orders and
+    ratings only know their bill; its establishment is filled in when the
+    bill goes too. Plain ids, as the rows they name may be gone.
+    '''
+    establishment_id = models.IntegerField(null=True)
+    bill_id = models.IntegerField(null=True, db_index=True)
+    day = models.DateField()
+
+    def __str__(self):
+        return f'{self.establishment_id or self.bill_id}({self.day})'
+
+    @classmethod
+    def record(cls, moments, establishment_id=None, bill_id=None):
+        cls.objects.bulk_create(
+            cls(establishment_id=establishment_id, bill_id=bill_id,
+                day=timezone.localtime(moment).date())
+            for moment in moments if moment is not None)
+
+    @classmethod
+    def consume(cls):
+        '''
+        `(establishment_id, day)` of the recorded changes, deleting them.
+        '''
+        changes = list(cls.objects.values_list(
+            'id', 'establishment_id', 'bill_id', 'day'))
+        bills = dict(Bill.objects.filter(id__in={
+            bill_id for change_id, establishment_id, bill_id, day in changes
+            if establishment_id is None}).values_list('id', 'establishment_id'))
+        days = set()
+        for change_id, establishment_id, bill_id, day in changes:
+            establishment_id = establishment_id or bills.get(bill_id)
+            if establishment_id is not None:
+                days.add((establishment_id, day))
+        cls.objects.filter(id__in=[change[0] for change in changes]).delete()
+        return days
+
+
+class EstablishmentDailyStats(models.Model):
+    '''
+    Totals of one establishment on one day, so the dashboards read a row
+    per day instead of aggregating bills, orders, payments and ratings.
+    Rows are recomputed from the source tables: the ones touched since the
+    watermark by `refresh`, every row by `rebuild`.
+    '''
+    WATERMARK = 'establishment_daily_stats'
+    # Rows saved by transactions still open when the watermark was read
+    REFRESH_OVERLAP = datetime.timedelta(minutes=5)
+    COUNTERS = ('bills_opened', 'orders_placed', 'orders_cancelled',
+                'items_sold', 'payments_approved', 'revenue_online',
+                'revenue_offline', 'moip_fees', 'noruh_fees', 'rating_sum',
+                'rating_count')
+
+    establishment = models.ForeignKey(
+        Establishment, on_delete=models.CASCADE, related_name='daily_stats')
+    day = models.DateField(db_index=True)
+    bills_opened = models.PositiveIntegerField(default=0)
+    orders_placed = models.PositiveIntegerField(default=0)
+    orders_cancelled = models.PositiveIntegerField(default=0)
+    items_sold = models.PositiveIntegerField(default=0)
+    payments_approved = models.PositiveIntegerField(default=0)
+    revenue_online = models.DecimalField(
+        max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    revenue_offline = models.DecimalField(
+        max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    moip_fees = models.DecimalField(
+        max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    noruh_fees = models.DecimalField(
+        max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    rating_sum = models.DecimalField(
+        max_digits=12, decimal_places=1, default=Decimal('0.0'))
+    rating_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = _('Establishment daily stats')
+        verbose_name_plural = _('Establishments daily stats')
+        unique_together = ('establishment', 'day')
+
+    def __str__(self):
+        return f'{self.establishment}({self.day})'
+
+    @staticmethod
+    def runs(days):
+        '''
+        `(establishment_id, first_day, last_day)` of each run of consecutive
+        days in the `(establishment_id, day)` pairs of `days`.
+        '''
+        runs = []
+        for establishment_id, day in sorted(days):
+            last = runs[-1] if runs else None
+            if last is not None and last[0] == establishment_id and \
+                    last[2] == day - datetime.timedelta(days=1):
+                runs[-1] = (establishment_id, last[1], day)
+            else:
+                runs.append((establishment_id, day, day))
+        return runs
+
+    @staticmethod
+    def by_day(queryset, date_field, establishment_field, runs=None):
+        '''
+        `queryset` grouped by establishment and local day of `date_field`,
+        limited to the days of `runs` when given.
+        '''
+        if runs is not None:
+            condition = Q()
+            for establishment_id, first_day, last_day in runs:
+                condition |= Q(**{
+                    establishment_field: establishment_id,
+                    f'{date_field}__gte': timezone.make_aware(
+                        datetime.datetime.combine(first_day, datetime.time.min)),
+                    f'{date_field}__lt': timezone.make_aware(
+                        datetime.datetime.combine(
+                            last_day + datetime.timedelta(days=1),
+                            datetime.time.min))})
+            queryset = queryset.filter(condition)
+        return queryset.values(stats_establishment=F(establishment_field),
+                               stats_day=TruncDate(date_field)).order_by()
+
+    @classmethod
+    def compute(cls, runs=None):
+        '''
+        Unsaved rows for the days with activity, every day or the ones of
+        `runs`, from one grouped query per source table.
+        '''
+        approved = Q(status_payment__in=BillPayment.APPROVED_STATUSES)
+        sources = (
+            cls.by_day(Bill.objects.all(), 'opening_date', 'establishment_id',
+                       runs=runs).annotate(bills_opened=Count('id')),
+            cls.by_day(Order.objects.filter(canceled_at__isnull=True),
+                       'created_at', 'bill__establishment_id', runs=runs).annotate(
+                orders_placed=Count('id'), items_sold=Sum('quantity')),
+            cls.by_day(Order.objects.filter(canceled_at__isnull=False), 'canceled_at',
+                       'bill__establishment_id', runs=runs).annotate(
+                orders_cancelled=Count('id')),
+            cls.by_day(BillPayment.objects.all(), 'date', 'establishment_id',
+                       runs=runs).annotate(
+                payments_approved=Count('id', filter=approved),
+                revenue_online=Sum('value', filter=Q(
+                    status_payment=BillPayment.STATUS_AUTHORIZED)),
+                revenue_offline=Sum('value', filter=Q(
+                    status_payment=BillPayment.STATUS_OFFLINE_APPROVED)),
+                moip_fees=Sum('moip_fee'),
+                noruh_fees=Sum('noruh_fee', filter=approved)),
+            cls.by_day(UserRating.objects.filter(average__isnull=False),
+                       'created_at', 'bill__establishment_id', runs=runs).annotate(
+                rating_sum=Sum('average'), rating_count=Count('id')),
+        )
+
+        rows = {}
+        for source in sources:
+            for values in source:
+                key = (values.pop('stats_establishment'), values.pop('stats_day'))
+                if key[1] is None:
+                    # Rows without the date, e.g. ratings saved before it existed
+                    continue
+                if key not in rows:
+                    rows[key] = cls(establishment_id=key[0], day=key[1])
+                for counter, value in values.items():
+                    setattr(rows[key], counter, value or 0)
+        return list(rows.values())
+
+    @classmethod
+    def rebuild(cls, runs=None):
+        '''
+        Recreate the rows of the days of `runs`, by default every row.
+        '''
+        if runs is not None and not runs:
+            return 0
+        rows = cls.compute(runs)
+        stale = cls.objects.all()
+        if runs is not None:
+            condition = Q()
+            for establishment_id, first_day, last_day in runs:
+                condition |= Q(establishment_id=establishment_id,
+                               day__gte=first_day, day__lte=last_day)
+            stale = stale.filter(condition)
+        with transaction.atomic():
+            stale.delete()
+            cls.objects.bulk_create(rows)
+        return len(rows)
+
+    @classmethod
+    def changed_days(cls, since):
+        '''
+        `(establishment_id, day)` of the rows whose source changed since
+        `since`.
+        '''
+        days = set()
+        for queryset, date_field, establishment_field in (
+                (Bill.objects.filter(opening_date__gte=since),
+                 'opening_date', 'establishment_id'),
+                (Order.objects.filter(updated_at__gte=since),
+                 'created_at', 'bill__establishment_id'),
+                (Order.objects.filter(updated_at__gte=since,
+                                      canceled_at__isnull=False),
+                 'canceled_at', 'bill__establishment_id'),
+                (BillPayment.objects.filter(updated_at__gte=since),
+                 'date', 'establishment_id'),
+                (UserRating.objects.filter(created_at__gte=since),
+                 'created_at', 'bill__establishment_id')):
+            days.update(
+                (values['stats_establishment'], values['stats_day'])
+                for values in cls.by_day(
+                    queryset, date_field,
+                    establishment_field).distinct())
+        return days
+
+    @classmethod
+    def refresh(cls):
+        '''
+        Recompute the rows touched since the last refresh, or every row on
+        the first one, and move the watermark.
+        '''
+        with transaction.atomic():
+            watermark = StatsWatermark.objects.select_for_update().filter(
+                name=cls.WATERMARK).first()
+            now = timezone.now()
+            if watermark is None:
+                DailyStatsChange.objects.all().delete()
+                count = cls.rebuild()
+                StatsWatermark.objects.create(
+                    name=cls.WATERMARK, processed_until=now)
+                return count
+
+            days = cls.changed_days(watermark.processed_until - cls.REFRESH_OVERLAP)
+            days |= DailyStatsChange.consume()
+            # Only the touched days of each establishment, so the cost
+            # follows the changes and not the span between them
+            count = cls.rebuild(runs=cls.runs(days))
+            watermark.processed_until = now
+            watermark.save(update_fields=['processed_until'])
+        return count
+
+    @classmethod
+    def window(cls, start=None, end=None, **filters):
+        queryset = cls.objects.filter(**filters)
+        if start is not None:
+            queryset = queryset.filter(day__gte=start)
+        if end is not None:
+            queryset = queryset.filter(day__lte=end)
+        return queryset
+
+    @classmethod
+    def sums(cls):
+        return {counter: Sum(counter) for counter in cls.COUNTERS}
+
+    @classmethod
+    def totals(cls, start=None, end=None, **filters):
+        '''
+        Sum of the counters over the days from `start` to `end`.
+        '''
+        totals = cls.window(start, end, **filters).aggregate(**cls.sums())
+        return {counter: value or 0 for counter, value in totals.items()}
+
+    @classmethod
+    def totals_by_establishment(cls, start=None, end=None, **filters):
+        '''
+        `totals` of each establishment with activity in the window.
+        '''
+        rows = cls.window(start, end, **filters).values(
+            'establishment_id').annotate(**cls.sums()).order_by()
+        return {row.pop('establishment_id'): {
+            counter: value or 0 for counter, value in row.items()}
+            for row in rows}
+
+    @staticmethod
+    def average_ticket(totals):
+        if not totals['payments_approved']:
+            return 0
+        value = totals['revenue_online'] + totals['revenue_offline']
+        return Decimal("{0:.2f}".format(value / totals['payments_approved']))
+
 
 class AnswerEvaluation(models.Model):
     evaluation = models.OneToOneField(UserRating, on_delete=models.CASCADE,
@@ -1434,6 +2270,302 @@ class OfflineCompensations(models.Model):
         return "{} - {} - {} ".format(self.establishment, month_name, self.value)
 
 
+class OfflineMonthSnapshot(models.Model):
+    '''
+    Offline payments of an establishment in a closed month, saved by the
+    `close_offline_months` task when the month ends so the compensations
+    ledger does not aggregate it again, and built again when one of its
+    payments is saved later.
+    '''
+    WATERMARK = 'offline_month_snapshots'
+    # Payments are stamped when saved, not when committed
+    REFRESH_OVERLAP = datetime.timedelta(minutes=5)
+
+    establishment = models.ForeignKey(
+        Establishment, on_delete=models.CASCADE, related_name='offline_months')
+    year = models.IntegerField()
+    month = models.IntegerField()
+    total = models.DecimalField(max_digits=12, decimal_places=2)
+    compensation_value = models.DecimalField(max_digits=12, decimal_places=2)
+    built_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = _('Offline month snapshot')
+        verbose_name_plural = _('Offline month snapshots')
+        unique_together = ('establishment', 'year', 'month')
+
+    def __str__(self):
+        return f'{self.establishment}({self.month}/{self.year})'
+
+    @staticmethod
+    def monthly_totals(payments, *fields):
+        '''
+        Offline approved `payments` grouped by establishment, month and
+        `fields`.
+        '''
+        return payments.filter(
+            status_payment=BillPayment.STATUS_OFFLINE_APPROVED).annotate(
+                month_start=TruncMonth('date')).values(
+                    'establishment_id', 'month_start', *fields).annotate(
+                        total=Sum('value')).order_by('-month_start')
+
+    @staticmethod
+    def month_start(moment):
+        moment = timezone.localtime(moment)
+        return timezone.make_aware(datetime.datetime(moment.year, moment.month, 1))
+
+    @classmethod
+    def build(cls, payments, built_at):
+        rows = cls.monthly_totals(payments, 'establishment__offline_percentage')
+        cls.objects.bulk_create(
+            cls(establishment_id=row['establishment_id'],
+                year=row['month_start'].year, month=row['month_start'].month,
+                total=row['total'],
+                compensation_value=(
+                    row['total'] * row['establishment__offline_percentage']
+                ).quantize(Decimal('0.01')),
+                built_at=built_at)
+            for row in rows)
+        return len(rows)
+
+    @classmethod
+    def late_months(cls, closed_until, since):
+        '''
+        (establishment_id, month_start) of the months before `closed_until`
+        with payments saved after their snapshot was built, looked up among
+        the payments updated after `since`.
+        '''
+        changed = BillPayment.objects.filter(
+            date__lt=closed_until, updated_at__gt=since).annotate(
+                month_start=TruncMonth('date')).values(
+                    'establishment_id', 'month_start').annotate(
+                        updated=Max('updated_at')).order_by()
+        changed = list(changed)
+        built = {
+            (snapshot.establishment_id, snapshot.year, snapshot.month): snapshot.built_at
+            for snapshot in cls.objects.filter(establishment_id__in={
+                row['establishment_id'] for row in changed})}
+
+        late = []
+        for row in changed:
+            built_at = built.get((row['establishment_id'], row['month_start'].year,
+                                  row['month_start'].month))
+            if built_at is None or row['updated'] > built_at - cls.REFRESH_OVERLAP:
+                late.append((row['establishment_id'], row['month_start']))
+        return late
+
+    @classmethod
+    def rebuild_months(cls, months, built_at):
+        '''
+        Replace the snapshots of `months`, (establishment_id, month_start)
+        pairs, with their current payments.
+        '''
+        if not months:
+            return 0
+        snapshots = Q()
+        payments = Q()
+        for establishment_id, month_start in months:
+            month_end = cls.month_start(month_start + datetime.timedelta(days=32))
+            snapshots |= Q(establishment_id=establishment_id,
+                           year=month_start.year, month=month_start.month)
+            payments |= Q(establishment_id=establishment_id,
+                          date__gte=month_start, date__lt=month_end)
+        cls.objects.filter(snapshots).delete()
+        return cls.build(BillPayment.objects.filter(payments), built_at)
+
+    @classmethod
+    def close_months(cls):
+        '''
+        Snapshot the months ended since the last call, from one grouped
+        query over their payments, and build again the closed months whose
+        payments were saved after their snapshot, e.g. a late approval.
+        Returns the number of snapshots built.
+        '''
+        now = timezone.now()
+        open_start = cls.month_start(now)
+        with transaction.atomic():
+            watermark = StatsWatermark.objects.select_for_update().filter(
+                name=cls.WATERMARK).first()
+            count = 0
+            payments = BillPayment.objects.filter(date__lt=open_start)
+            closed_until = None
+            if watermark is not None:
+                closed_until = cls.month_start(watermark.processed_until)
+                count += cls.rebuild_months(cls.late_months(
+                    closed_until, watermark.processed_until - cls.REFRESH_OVERLAP), now)
+                payments = payments.filter(date__gte=closed_until)
+            if closed_until is None or closed_until < open_start:
+                count += cls.build(payments, now)
+            StatsWatermark.objects.update_or_create(
+                name=cls.WATERMARK, defaults={'processed_until': now})
+        return count
+
+    @classmethod
+    def rebuild(cls):
+        '''
+        Drop every snapshot and build the closed months again.
+        '''
+        with transaction.atomic():
+            cls.objects.all().delete()
+            StatsWatermark.objects.filter(name=cls.WATERMARK).delete()
+            return cls.close_months()
+
+    @classmethod
+    def ledger(cls, establishment):
+        '''
+        Offline totals and compensation of each month of `establishment`,
+        newest first, each joined with its OfflineCompensations. Months not
+        closed yet by `close_months`, the open one at least, are summed
+        from their payments; the others come from their snapshots.
+        '''
+        closed_until = StatsWatermark.objects.filter(
+            name=cls.WATERMARK).values_list('processed_until', flat=True).first()
+        payments = BillPayment.objects.filter(establishment=establishment)
+        if closed_until is not None:
+            closed_until = cls.month_start(closed_until)
+            payments = payments.filter(date__gte=closed_until)
+        live_months = list(cls.monthly_totals(payments))
+        compensations = {}
+        for year, month, date_compensation in OfflineCompensations.objects.filter(
+                establishment=establishment).order_by('-id').values_list(
+                    'year', 'month', 'date_compensation'):
+            compensations[(year, month)] = date_compensation
+
+        closed_months = cls.objects.filter(
+            establishment=establishment).order_by('-year', '-month')
+
+        months = [{'y': row['month_start'].year, 'm': row['month_start'].month,
+                   'total': row['total'],
+                   'compensation_value': row['total'] * establishment.offline_percentage}
+                  for row in live_months]
+        months += [{'y': snapshot.year, 'm': snapshot.month,
+                    'total': snapshot.total,
+                    'compensation_value': snapshot.compensation_value}
+                   for snapshot in closed_months]
+        for month in months:
+            month['establishment_id'] = establishment.id
+            month['date'] = datetime.date(month['y'], month['m'], 1)
+            month['compensation'] = compensations.get(
+                (month['y'], month['m'])) or False
+        return months
+
+    @classmethod
+    def ledger_month(cls, establishment, year, month):
+        return next((row for row in cls.ledger(establishment)
+                     if row['y'] == year and row['m'] == month), None)
+
+
+class OutboxMessage(models.Model):
+    '''
+    FCM, Pusher or Firestore notification saved in the same transaction as
+    the change it announces and delivered by the `deliver_outbox_message`
+    task after the commit, so requests don't wait for the push providers
+    and a failed push doesn't roll the change back.
+    '''
+    FCM = 'fcm'
+    PUSHER = 'pusher'
+    FIRESTORE = 'firestore'
+    KIND_CHOICES = (
+        (FCM, 'FCM'),
+        (PUSHER, 'Pusher'),
+        (FIRESTORE, 'Firestore'),
+    )
+    MAX_ATTEMPTS = 8
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    payload = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    # The next delivery attempt is not made before it
+    available_at = models.DateTimeField(default=timezone.now, db_index=True)
+    sent_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name = _('Outbox message')
+        verbose_name_plural = _('Outbox messages')
+
+    def __str__(self):
+        return f'{self.kind}({self.id})'
+
+    @classmethod
+    def enqueue(cls, kind, **payload):
+        message = cls.objects.create(
+            kind=kind, payload=json.dumps(payload, default=objects_to_json))
+        transaction.on_commit(message.dispatch)
+        return message
+
+    @classmethod
+    def send_fcm(cls, user_ids, title, body, icon=None, data=None):
+        '''
+        Queue `send_message` to the FCM devices of the users.
+        '''
+        return cls.enqueue(cls.FCM, user_ids=list(user_ids), title=title,
+                           body=body, icon=icon, data=data)
+
+    @classmethod
+    def send_pusher(cls, ids, channel, event, data):
+        '''
+        Queue `PusherNotification.send_notifications`.
+        '''
+        return cls.send_pusher_batch([(ids, channel, event, data)])
+
+    @classmethod
+    def send_pusher_batch(cls, notifications):
+        '''
+        Queue `PusherNotification.send_batch` for `(ids, channel, event,
+        data)` notifications, delivered together.
+        '''
+        return cls.enqueue(cls.PUSHER, notifications=[
+            (list(ids), channel, event, data)
+            for ids, channel, event, data in notifications])
+
+    @classmethod
+    def send_to_staff(cls, establishment_id, user_type, event, data):
+        '''
+        Queue a notification to the employees of `user_type` of the
+        establishment, on their shared channel.
+        '''
+        return cls.send_pusher_batch([Employee.staff_notification(
+            establishment_id, user_type, event, data)])
+
+    @classmethod
+    def send_firestore(cls, data):
+        '''
+        Queue a document for the Firestore notifications collection.
+        '''
+        return cls.enqueue(cls.FIRESTORE, data=data)
+
+    def dispatch(self):
+        celery_app.send_task('deliver_outbox_message', args=(self.id, ))
+
+    def deliver(self):
+        payload = json.loads(self.payload)
+        if self.kind == OutboxMessage.FCM:
+            FCMDevice.objects.filter(user_id__in=payload['user_ids']).send_message(
+                payload['title'], payload['body'], icon=payload['icon'],
+                data=payload['data'])
+        elif self.kind == OutboxMessage.PUSHER:
+            PusherNotification.send_batch(payload['notifications'])
+        elif self.kind == OutboxMessage.FIRESTORE:
+            NoruhFireStore().add_data_on_collection(payload['data'])
+
+    def backoff(self):
+        # 10s, 20s, 40s ... up to one hour between attempts
+        return min(10 * 2 ** max(self.attempts - 1, 0), 3600)
+
+    def mark_sent(self):
+        self.sent_at = timezone.now()
+        self.save(update_fields=['sent_at'])
+
+    def mark_failed(self, error):
+        self.attempts += 1
+        self.last_error = repr(error)
+        self.available_at = timezone.now() + datetime.timedelta(
+            seconds=self.backoff())
+        self.save(update_fields=['attempts', 'last_error', 'available_at'])
+
+
 @receiver(post_save, sender=BillPayment)
 def update_values_profile(sender, created, instance, **kwargs):
     if created:
@@ -1490,18 +2622,163 @@ def create_first_menu(sender, created, instance, **kwargs):
                                    name='Menu {}'.format(instance.name), enabled=True)
 
 
+@receiver(post_save, sender=EstablishmentPhoto)
+@receiver(post_delete, sender=EstablishmentPhoto)
+@receiver(post_save, sender=EstablishmentPromotions)
+@receiver(post_delete, sender=EstablishmentPromotions)
+@receiver(post_save, sender=EstablishmentEvents)
+@receiver(post_delete, sender=EstablishmentEvents)
+@receiver(post_save, sender=EstablishmentOperatingHours)
+@receiver(post_delete, sender=EstablishmentOperatingHours)
+def touch_establishment(sender, instance, **kwargs):
+    Establishment.touch(id=instance.establishment_id)
+
+
+@receiver(post_save, sender=Amenity)
+@receiver(pre_delete, sender=Amenity)
+def touch_establishments_from_amenity(sender, instance, **kwargs):
+    Establishment.touch(amenities=instance)
+
+
+@receiver(post_save, sender=CuisineType)
+@receiver(pre_delete, sender=CuisineType)
+def touch_establishments_from_cuisine_type(sender, instance, **kwargs):
+    Establishment.touch(cuisine_type=instance)
+
+
+@receiver(m2m_changed, sender=Establishment.amenities.through)
+def touch_establishment_amenities(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        Establishment.touch(id__in=pk_set or [])
+    else:
+        Establishment.touch(id=instance.id)
+
+
+@receiver(post_save, sender=MenuItem)
+@receiver(post_delete, sender=MenuItem)
+def touch_menu(sender, instance, **kwargs):
+    Menu.touch(id=instance.menu_id)
+
+
+@receiver(pre_delete, sender=Establishment)
+def mark_establishment_deleting(sender, instance, **kwargs):
+    Establishment.deleting().add(instance.id)
+
+
+@receiver(post_delete, sender=Establishment)
+def unmark_establishment_deleting(sender, instance, **kwargs):
+    Establishment.deleting().discard(instance.id)
+
+
+@receiver(post_delete, sender=MenuItem)
+def bury_menu_item(sender, instance, **kwargs):
+    establishment_id = Menu.objects.filter(id=instance.menu_id).values_list(
+        'establishment_id', flat=True).first()
+    if establishment_id is not None and establishment_id not in Establishment.deleting():
+        MenuTombstone.objects.create(
+            establishment_id=establishment_id, kind=MenuTombstone.ITEM,
+            object_id=instance.id)
+
+
+@receiver(post_save, sender=ItemCategory)
+@receiver(post_delete, sender=ItemCategory)
+@receiver(post_save, sender=ItemObservations)
+@receiver(post_delete, sender=ItemObservations)
+def touch_menus_from_establishment(sender, instance, **kwargs):
+    Menu.touch(establishment_id=instance.establishment_id)
+
+
+@receiver(post_save, sender=ItemCategory)
+@receiver(pre_delete, sender=ItemCategory)
+def touch_items_from_category(sender, instance, **kwargs):
+    MenuItem.touch(category=instance)
+
+
+@receiver(post_save, sender=ItemObservations)
+@receiver(pre_delete, sender=ItemObservations)
+def touch_items_from_observation(sender, instance, **kwargs):
+    MenuItem.touch(observations=instance)
+
+
+@receiver(post_delete, sender=ItemObservations)
+def bury_item_observation(sender, instance, **kwargs):
+    if instance.establishment_id in Establishment.deleting():
+        return
+    MenuTombstone.objects.create(
+        establishment_id=instance.establishment_id,
+        kind=MenuTombstone.OBSERVATION, object_id=instance.id)
+
+
+@receiver(post_save, sender=MenuOffer)
+@receiver(post_delete, sender=MenuOffer)
+def touch_menus_from_offer(sender, instance, **kwargs):
+    Menu.touch(establishment__category__id=instance.category_id)
+
+
+@receiver(m2m_changed, sender=MenuItem.observations.through)
+def touch_menu_observations(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        Menu.touch(items__id__in=pk_set or [])
+        MenuItem.touch(id__in=pk_set or [])
+    else:
+        Menu.touch(id=instance.menu_id)
+        MenuItem.touch(id=instance.id)
+
+
 @receiver(post_delete, sender=Employee)
 def delete_user(sender, instance, **kwargs):
     user_id = instance.user_id
     User.objects.filter(id=user_id).delete()
 
 
+@receiver(pre_save, sender=UserRating)
+def remember_previous_rating(sender, instance, **kwargs):
+    instance._previous_rating = None
+    if instance.pk is not None:
+        instance._previous_rating = sender.objects.filter(pk=instance.pk).first()
+
+    notes = (instance.food, instance.service, instance.environment)
+    if None in notes:
+        instance.average = None
+    else:
+        instance.average = Decimal(sum(notes) / 3).quantize(Decimal('0.1'))
+
+
 @receiver(post_save, sender=UserRating)
 def update_average(sender, created, instance, **kwargs):
-    if created:
-        average = (instance.food + instance.service + instance.environment) / 3
-        instance.average = average
-        instance.save()
+    # An edited rating, e.g. from the bill admin, swaps its old notes for
+    # the new ones in the establishment stats
+    previous = getattr(instance, '_previous_rating', None)
+    with transaction.atomic():
+        if previous is not None:
+            EstablishmentRatingStats.apply_rating(previous, sign=-1)
+        EstablishmentRatingStats.apply_rating(instance)
+
+
+@receiver(post_delete, sender=UserRating)
+def remove_rating_from_stats(sender, instance, **kwargs):
+    EstablishmentRatingStats.apply_rating(instance, sign=-1)
+    DailyStatsChange.record([instance.created_at], bill_id=instance.bill_id)
+
+
+@receiver(post_delete, sender=Bill)
+def record_deleted_bill(sender, instance, **kwargs):
+    DailyStatsChange.record([instance.opening_date],
+                            establishment_id=instance.establishment_id)
+    # Orders and ratings of a bill are deleted before it
+    DailyStatsChange.objects.filter(
+        bill_id=instance.id, establishment_id__isnull=True).update(
+            establishment_id=instance.establishment_id)
+
+
+@receiver(post_delete, sender=BillPayment)
+def record_deleted_payment(sender, instance, **kwargs):
+    DailyStatsChange.record([instance.date],
+                            establishment_id=instance.establishment_id)
 
 '''
 @receiver(pre_save, sender=BillMember)
@@ -1540,3 +2817,64 @@ def update_value_order(sender, created, instance, **kwargs):
 def check_can_cancel_order(sender, instance, **_):
     if instance.canceled_at is not None and instance.kitchen_finished_at:
         raise CannotCancelOrderException()
+
+
+def refresh_bill_totals(instance):
+    # keep a bill already loaded through the order/member up to date
+    if type(instance)._meta.get_field('bill').is_cached(instance):
+        instance.bill.refresh_from_db(fields=Bill.TOTAL_FIELDS)
+
+
+@receiver(pre_save, sender=Order)
+def remember_billed_value(sender, instance, **kwargs):
+    previous = None
+    if instance.pk is not None:
+        previous = sender.objects.filter(pk=instance.pk).values_list(
+            'bill_id', 'status', 'value_order').first()
+    if previous is None:
+        instance._billed = (None, Decimal('0.00'))
+    else:
+        bill_id, status, value_order = previous
+        billed = Decimal(value_order or 0) if status in Order.BILLED_STATUSES else Decimal('0.00')
+        instance._billed = (bill_id, billed)
+
+
+@receiver(post_save, sender=Order)
+def update_bill_orders_subtotal(sender, instance, **kwargs):
+    # `update_value_order` saves again from inside post_save, the nested
+    # save leaves `_billed` current so the outer one adds nothing twice
+    previous_bill_id, previous = getattr(
+        instance, '_billed', (None, Decimal('0.00')))
+    billed = instance.billed_value()
+
+    if previous_bill_id == instance.bill_id:
+        if billed != previous:
+            Bill.add_to_totals(instance.bill_id, orders_subtotal=billed - previous)
+    else:
+        if previous_bill_id is not None and previous:
+            Bill.add_to_totals(previous_bill_id, orders_subtotal=-previous)
+        if billed:
+            Bill.add_to_totals(instance.bill_id, orders_subtotal=billed)
+    instance._billed = (instance.bill_id, billed)
+    refresh_bill_totals(instance)
+
+
+@receiver(post_delete, sender=Order)
+def remove_order_from_bill(sender, instance, **kwargs):
+    billed = instance.billed_value()
+    if billed:
+        Bill.add_to_totals(instance.bill_id, orders_subtotal=-billed)
+    DailyStatsChange.record([instance.created_at, instance.canceled_at],
+                            bill_id=instance.bill_id)
+
+
+@receiver(post_save, sender=BillMember)
+def add_member_to_bill(sender, instance, created, **kwargs):
+    if created:
+        Bill.add_to_totals(instance.bill_id, members_count=1)
+        refresh_bill_totals(instance)
+
+
+@receiver(post_delete, sender=BillMember)
+def remove_member_from_bill(sender, instance, **kwargs):
+    Bill.add_to_totals(instance.bill_id, members_count=-1)
@@ -3,6 +3,7 @@ import json
 import uuid
 
 from django.contrib.auth.models import User
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 
@@ -12,10 +13,7 @@ from rest_framework.response import Response
 from rest_framework import permissions
 from rest_framework import status
 
-from fcm_django.models import FCMDevice
-
 from noruh_backend.settings import MOIP_TAX_PERCENTAGE, WEBSITE_NORUH
-from noruh_backend.firestore_connect import NoruhFireStore
 
 from register.models import (
     Bill,
@@ -24,6 +22,7 @@ from register.models import (
     EstablishmentPromotions,
     MoipWirecardAPP,
     MoipWirecardCustomer,
+    OutboxMessage,
     Profile,
     UserPayment,
     UserCreditCard,
@@ -456,29 +455,28 @@ class CreatePaymentPostOffline(APIView):
 
             payment_uuid = str('Noruh_' + str(uuid.uuid4()))
 
-            bill_payment = BillPayment.objects.create(
-                payment_uuid=payment_uuid, establishment=bill.establishment,
-                status_payment=BillPayment.STATUS_OFFLINE_PENDING,
-                date=timezone.now(), bill=bill, value=value,
-                noruh_fee=noruh_fee, bill_member=bill_member,
-                promocode=promocode_obj)
+            with transaction.atomic():
+                bill_payment = BillPayment.objects.create(
+                    payment_uuid=payment_uuid, establishment=bill.establishment,
+                    status_payment=BillPayment.STATUS_OFFLINE_PENDING,
+                    date=timezone.now(), bill=bill, value=value,
+                    noruh_fee=noruh_fee, bill_member=bill_member,
+                    promocode=promocode_obj)
 
-            data_notification = bill_payment.notification_payload(key='payment_created')
+                data_notification = bill_payment.notification_payload(key='payment_created')
 
-            devices = FCMDevice.objects.filter(
-                user__in=BillMember.objects.filter(
+                customers = BillMember.objects.filter(
                     bill=bill_payment.bill,
-                    leave_at__isnull=True).values('customer'))
-            devices.send_message(
-                "Pagamento em Analise",
-                f'Pagamento offline de {bill_payment.value} criado e em analise pelo garçom',
-                icon=bill_payment.bill.establishment.logo_url.url,
-                data=data_notification)
-
-            bill_payment.send_pusher_notification(bill, self.request.user)
-
-            noruh_firestore = NoruhFireStore()
-            noruh_firestore.add_data_on_collection(data_notification)
+                    leave_at__isnull=True).values_list('customer', flat=True)
+                OutboxMessage.send_fcm(
+                    customers,
+                    "Pagamento em Analise",
+                    f'Pagamento offline de {bill_payment.value} criado e em analise pelo garçom',
+                    icon=bill_payment.bill.establishment.logo_url.url,
+                    data=data_notification)
+
+                bill_payment.send_pusher_notification(bill, self.request.user)
+                OutboxMessage.send_firestore(data_notification)
 
             return Response(
                 'Payment under review', status=status.HTTP_201_CREATED)
@@ -0,0 +1,77 @@
+import datetime
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+from celery.decorators import task
+
+from register.models import (
+    EstablishmentDailyStats, OfflineMonthSnapshot, OutboxMessage)
+
+logger = logging.getLogger(__name__)
+
+
+@task(name="deliver_outbox_message", bind=True,
+      max_retries=OutboxMessage.MAX_ATTEMPTS)
+def deliver_outbox_message(self, message_id):
+    """
+    Deliver one outbox message, retrying with exponential backoff. The row
+    stays locked while sending so a retry and `drain_outbox` don't deliver
+    the same message together.
+    """
+    with transaction.atomic():
+        message = OutboxMessage.objects.select_for_update(
+            skip_locked=True).filter(
+                id=message_id, sent_at__isnull=True).first()
+        if message is None:
+            return False
+        try:
+            message.deliver()
+        except Exception as error:
+            message.mark_failed(error)
+        else:
+            message.mark_sent()
+            return True
+
+    if message.attempts >= OutboxMessage.MAX_ATTEMPTS:
+        logger.error('Giving up outbox message %s: %s',
+                     message.id, message.last_error)
+        return False
+    raise self.retry(countdown=message.backoff())
+
+
+@task(name="drain_outbox")
+def drain_outbox():
+    """
+    Dispatch again the messages whose task was lost (broker down, worker
+    killed) and forget the ones delivered a week ago.
+    """
+    now = timezone.now()
+    pending = OutboxMessage.objects.filter(
+        sent_at__isnull=True,
+        attempts__lt=OutboxMessage.MAX_ATTEMPTS,
+        available_at__lte=now - datetime.timedelta(minutes=1))
+    for message_id in pending.values_list('id', flat=True):
+        deliver_outbox_message.delay(message_id)
+
+    OutboxMessage.objects.filter(
+        sent_at__lt=now - datetime.timedelta(days=7)).delete()
+
+
+@task(name="refresh_daily_stats")
+def refresh_daily_stats():
+    """
+    Bring the establishments daily stats up to date with the bills, orders,
+    payments and ratings changed since the last run.
+    """
+    return EstablishmentDailyStats.refresh()
+
+
+@task(name="close_offline_months")
+def close_offline_months():
+    """
+    Snapshot the offline payments of the months ended since the last run
+    and build again the closed months with payments saved after it.
+    """
+    return OfflineMonthSnapshot.close_months()
@@ -1,14 +1,61 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import json
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+from xml.etree import ElementTree
+from decimal import Decimal
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.gis.geos import Point
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+import pusher
+from celery.exceptions import Retry
 from model_mommy import mommy
 from register.models import (
     Amenity,
+    Employee,
     Establishment,
+    EstablishmentPhoto,
+    EstablishmentEvents,
+    EstablishmentOperatingHours,
     Bill,
     BillMember,
     BillMember,
-    Order
+    BillSplit,
+    BillPayment,
+    Order,
+    OutboxMessage,
+    UserRating,
+    EstablishmentRatingStats,
+    EstablishmentDailyStats,
+    DailyStatsChange,
+    StatsWatermark,
+    Menu,
+    MenuItem,
+    MenuOffer,
+    ItemCategory,
+    ItemObservations,
+    MenuTombstone,
+    OfflineCompensations,
+    OfflineMonthSnapshot,
     )
+from noruh_backend.pusher import PusherNotification
+from noruh_backend.realtime import Gateway, GatewayClient, MemoryBroker
+from rest_framework.generics import ListAPIView
+from register.api.mixins import ConditionalGetMixin
+from register.api.serializers import OrderSerializerList
+from register.exports import XLSXExport, payments_for_export
 from register.forms import EstablishmentForm
+from register.tasks import deliver_outbox_message
+from register.utils import (
+    SYNC_OVERLAP, establishments_performance, revenues_series, to_version)
 from register.exceptions import (
     OpenBillException,
     CannotLeaveBillException,
@@ -37,6 +84,382 @@ class EstablishmentTestCase(TestCase):
         self.assertEquals(field_label, 'bar teste')
 
 
+class EstablishmentRatingSummaryTestCase(TestCase):
+    def test_calculate_evaluations_buckets(self):
+        bill = mommy.make(Bill)
+        mommy.make(UserRating, bill=bill, environment=10, food=9, service=9)
+        mommy.make(UserRating, bill=bill, environment=6, food=6, service=7)
+        mommy.make(UserRating, bill=bill, environment=2, food=3, service=5)
+
+        evaluations = bill.establishment.calculate_evaluations()
+        self.assertEqual(evaluations, {'number': 3, 'excellent': 1,
+                                       'good': 1, 'bad': 1})
+
+    def test_rating_summary_without_ratings(self):
+        establishment = mommy.make(Bill).establishment
+        summary = establishment.rating_summary()
+        self.assertEqual(summary['number'], 0)
+        self.assertIsNone(summary['average_avg'])
+
+    def test_deleted_rating_leaves_stats(self):
+        bill = mommy.make(Bill)
+        rating = mommy.make(UserRating, bill=bill, environment=10,
+                            food=10, service=10)
+        mommy.make(UserRating, bill=bill, environment=5, food=5, service=5)
+        rating.delete()
+
+        stats = EstablishmentRatingStats.objects.get(
+            establishment=bill.establishment)
+        self.assertEqual(stats.number, 1)
+        self.assertEqual(stats.excellent, 0)
+        self.assertEqual(stats.bad, 1)
+        self.assertEqual(stats.summary()['average_food'], 5)
+
+    def test_edited_rating_updates_stats(self):
+        bill = mommy.make(Bill)
+        rating = mommy.make(UserRating, bill=bill, environment=10,
+                            food=10, service=10)
+        mommy.make(UserRating, bill=bill, environment=6, food=6, service=6)
+
+        rating = UserRating.objects.get(id=rating.id)
+        rating.food = 1
+        rating.service = 2
+        rating.environment = 3
+        rating.save()
+
+        rating.refresh_from_db()
+        self.assertEqual(rating.average, Decimal('2.0'))
+        summary = bill.establishment.rating_summary()
+        self.assertEqual(summary['number'], 2)
+        self.assertEqual((summary['excellent'], summary['good'], summary['bad']),
+                         (0, 1, 1))
+        self.assertEqual(summary['average_food'], 3.5)
+        self.assertEqual(summary['average_avg'], 4.0)
+
+        EstablishmentRatingStats.rebuild()
+        establishment = Establishment.objects.get(id=bill.establishment.id)
+        self.assertEqual(establishment.rating_summary(), summary)
+
+    def test_rebuild_matches_incremental_stats(self):
+        bill = mommy.make(Bill)
+        mommy.make(UserRating, bill=bill, environment=7, food=8, service=9)
+        mommy.make(UserRating, bill=bill, environment=9, food=9, service=9)
+        before = bill.establishment.rating_summary()
+
+        EstablishmentRatingStats.rebuild()
+        establishment = Establishment.objects.get(id=bill.establishment.id)
+        self.assertEqual(establishment.rating_summary(), before)
+
+
+class EstablishmentListQueryCountTestCase(TestCase):
+    def make_establishments(self, quantity):
+        amenity = mommy.make(Amenity)
+        for establishment in mommy.make(Establishment, enabled=True,
+                                        geo_loc=Point(-35.7, -9.6),
+                                        _quantity=quantity):
+            establishment.amenities.add(amenity)
+            mommy.make(EstablishmentPhoto, establishment=establishment)
+            mommy.make(EstablishmentEvents, establishment=establishment)
+            mommy.make(EstablishmentOperatingHours,
+                       establishment=establishment)
+
+    def count_list_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(
+                reverse('register-api:api_establishment_list'))
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        self.make_establishments(2)
+        small_page = self.count_list_queries()
+        self.make_establishments(8)
+        self.assertEqual(self.count_list_queries(), small_page)
+
+    def test_sparse_fieldset_skips_relations(self):
+        self.make_establishments(3)
+        url = reverse('register-api:api_establishment_list')
+
+        with CaptureQueriesContext(connection) as sparse:
+            response = self.client.get(url, {'fields': 'id,name,geo_loc'})
+        self.assertEqual(set(response.data['results'][0]),
+                         {'id', 'name', 'geo_loc'})
+        self.assertLess(len(sparse), self.count_list_queries())
+
+    def test_cursor_pagination(self):
+        self.make_establishments(3)
+        url = reverse('register-api:api_establishment_list')
+        response = self.client.get(url, {'pagination': 'cursor', 'limit': 2})
+
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIn('cursor=', response.data['next'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_unknown_sparse_fields_render_all_fields(self):
+        self.make_establishments(1)
+        url = reverse('register-api:api_establishment_list')
+        response = self.client.get(url, {'fields': 'nome,endereco'})
+        self.assertIn('amenities', response.data['results'][0])
+        self.assertIn('name', response.data['results'][0])
+
+
+class EstablishmentRadiusTestCase(TestCase):
+    def setUp(self):
+        self.url = reverse('register-api:api_establishment_list')
+        self.center = {'lat': -9.6, 'lng': -35.7}
+        # about 5km, 30km and 110km north of the center
+        self.near, self.far, self.farthest = [
+            mommy.make(Establishment, enabled=True,
+                       geo_loc=Point(-35.7, -9.6 + degrees))
+            for degrees in (0.045, 0.27, 1)]
+
+    def results(self, **params):
+        response = self.client.get(self.url, dict(self.center, **params))
+        self.assertEqual(response.status_code, 200)
+        return response.data['results']
+
+    def test_default_radius(self):
+        results = self.results()
+        self.assertEqual([result['id'] for result in results], [self.near.id])
+        self.assertAlmostEqual(results[0]['distance'], 5, delta=0.1)
+
+    def test_radius_param_orders_by_distance(self):
+        results = self.results(radius=50)
+        self.assertEqual([result['id'] for result in results],
+                         [self.near.id, self.far.id])
+        self.assertLess(results[0]['distance'], results[1]['distance'])
+
+    def test_nearest_ignores_radius(self):
+        results = self.results(nearest=2)
+        self.assertEqual([result['id'] for result in results],
+                         [self.near.id, self.far.id])
+
+        results = self.results(nearest=5)
+        self.assertEqual([result['id'] for result in results],
+                         [self.near.id, self.far.id, self.farthest.id])
+        self.assertAlmostEqual(results[2]['distance'], 110.6, delta=0.5)
+
+    def test_cursor_is_refused_with_distance_ordering(self):
+        response = self.client.get(
+            self.url, dict(self.center, pagination='cursor'))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('cursor', response.json())
+
+        results = self.results(pagination='cursor', nearest=1)
+        self.assertEqual([result['id'] for result in results], [self.near.id])
+
+    def test_invalid_numbers(self):
+        for name, value in (('radius', 'abc'), ('radius', 'nan'),
+                            ('radius', 'inf'), ('radius', '0'),
+                            ('nearest', '-1'), ('nearest', 'NaN')):
+            response = self.client.get(
+                self.url, dict(self.center, **{name: value}))
+            self.assertEqual(response.status_code, 400, (name, value))
+            self.assertIn(name, response.json())
+
+    def test_invalid_coordinates(self):
+        for name, value in (('lat', 'abc'), ('lat', 'nan'), ('lng', 'inf'),
+                            ('lat', '91'), ('lng', '-180.5'), ('lng', '')):
+            response = self.client.get(
+                self.url, dict(self.center, **{name: value}))
+            self.assertEqual(response.status_code, 400, (name, value))
+            self.assertIn(name, response.json())
+
+
+class EstablishmentConditionalGetTestCase(TestCase):
+    def test_not_modified_until_establishment_changes(self):
+        establishment = mommy.make(Establishment, enabled=True,
+                                   geo_loc=Point(-35.7, -9.6))
+        url = reverse('register-api:api_establishment_list_detail',
+                      args=(establishment.id,))
+        etag = self.client.get(url)['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        mommy.make(EstablishmentEvents, establishment=establishment)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_list_revalidates_with_one_query(self):
+        establishments = mommy.make(Establishment, enabled=True,
+                                    geo_loc=Point(-35.7, -9.6), _quantity=3)
+        url = reverse('register-api:api_establishment_list')
+        params = {'lat': -9.6, 'lng': -35.7}
+        etag = self.client.get(url, params)['ETag']
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        establishments[1].name = 'Renamed'
+        establishments[1].save()
+        response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+class ConditionalGetMixinTestCase(SimpleTestCase):
+    def test_view_without_get_etag_is_refused(self):
+        with self.assertRaises(ImproperlyConfigured):
+            class View(ConditionalGetMixin, ListAPIView):
+                pass
+
+
+class MenuResponseCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = mommy.make(User)
+        self.menu = mommy.make(Menu)
+        mommy.make(MenuItem, menu=self.menu, _quantity=3)
+        self.url = reverse('register-api:api_menu_list',
+                           args=(self.menu.establishment_id,))
+
+    def test_cached_until_menu_item_changes(self):
+        self.client.force_login(self.user)
+        first = self.client.get(self.url)
+
+        with CaptureQueriesContext(connection) as cached:
+            second = self.client.get(self.url)
+        with CaptureQueriesContext(connection) as uncached:
+            cache.clear()
+            self.client.get(self.url)
+        self.assertEqual(first.json(), second.json())
+        self.assertLess(len(cached), len(uncached))
+
+        mommy.make(MenuItem, menu=self.menu)
+        response = self.client.get(self.url)
+        self.assertEqual(response.json()['count'], 1)
+        self.assertEqual(len(response.json()['results'][0]['items']), 4)
+
+
+class MenuQueryCountTestCase(TestCase):
+    def setUp(self):
+        self.user = mommy.make(User)
+        self.menu = mommy.make(Menu)
+        self.category = mommy.make(
+            ItemCategory, establishment=self.menu.establishment)
+        self.url = reverse('register-api:api_menu_list',
+                           args=(self.menu.establishment_id,))
+
+    def make_items(self, quantity):
+        observations = mommy.make(
+            ItemObservations, establishment=self.menu.establishment,
+            _quantity=2)
+        for item in mommy.make(MenuItem, menu=self.menu,
+                               category=self.category, _quantity=quantity):
+            item.observations.set(observations)
+
+    def count_queries(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_items(self):
+        self.client.force_login(self.user)
+        self.make_items(2)
+        few = self.count_queries()
+        self.make_items(10)
+        self.assertEqual(self.count_queries(), few)
+
+    def test_observations_and_category_are_serialized(self):
+        self.client.force_login(self.user)
+        self.make_items(1)
+        cache.clear()
+        item = self.client.get(self.url).json()['results'][0]['items'][0]
+        self.assertEqual(len(item['observations']), 2)
+        self.assertEqual(item['category']['id'], self.category.id)
+
+
+class MenuChangesTestCase(TestCase):
+    def setUp(self):
+        self.menu = mommy.make(Menu)
+        self.items = mommy.make(MenuItem, menu=self.menu, _quantity=3)
+        self.url = reverse('register-api:api_menu_changes',
+                           args=(self.menu.establishment_id,))
+        self.client.force_login(mommy.make(User))
+
+    def test_only_changes_since_version_are_returned(self):
+        response = self.client.get(self.url).json()
+        self.assertEqual(len(response['items']), 3)
+        version = response['version']
+
+        self.items[0].available = False
+        self.items[0].save()
+        deleted_id = self.items[1].id
+        self.items[1].delete()
+        response = self.client.get(self.url, {'since': version}).json()
+
+        self.assertEqual([item['id'] for item in response['items']],
+                         [self.items[0].id])
+        self.assertEqual(response['deleted']['items'], [deleted_id])
+        self.assertGreater(response['version'], version)
+
+        # still inside the overlap window, so read again
+        response = self.client.get(
+            self.url, {'since': response['version']}).json()
+        self.assertEqual([item['id'] for item in response['items']],
+                         [self.items[0].id])
+        self.assertEqual(response['deleted']['items'], [deleted_id])
+
+    def test_version_stays_behind_the_overlap_window(self):
+        before = timezone.now() - SYNC_OVERLAP
+        response = self.client.get(self.url).json()
+        self.assertLessEqual(
+            response['version'], to_version(timezone.now() - SYNC_OVERLAP))
+        self.assertGreaterEqual(response['version'], to_version(before))
+
+        MenuItem.objects.update(updated_at=before - SYNC_OVERLAP)
+        response = self.client.get(
+            self.url, {'since': to_version(before)}).json()
+        self.assertEqual(response['items'], [])
+        self.assertEqual(response['deleted']['items'], [])
+
+    def test_deleted_observation_is_tombstoned_and_touches_items(self):
+        observation = mommy.make(ItemObservations,
+                                 establishment=self.menu.establishment)
+        self.items[2].observations.add(observation)
+        version = self.client.get(self.url).json()['version']
+
+        deleted_id = observation.id
+        observation.delete()
+        response = self.client.get(self.url, {'since': version}).json()
+
+        self.assertEqual([item['id'] for item in response['items']],
+                         [self.items[2].id])
+        self.assertEqual(response['deleted']['observations'], [deleted_id])
+        self.assertTrue(MenuTombstone.objects.filter(
+            kind=MenuTombstone.OBSERVATION).exists())
+
+    def test_invalid_since(self):
+        response = self.client.get(self.url, {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+
+class EstablishmentDeleteTestCase(TransactionTestCase):
+    def test_cascaded_menu_rows_leave_no_tombstones(self):
+        establishment = mommy.make(Establishment, geo_loc=Point(-35.7, -9.6))
+        menu = mommy.make(Menu, establishment=establishment)
+        observation = mommy.make(ItemObservations, establishment=establishment)
+        item = mommy.make(MenuItem, menu=menu)
+        item.observations.add(observation)
+
+        # Runs in autocommit, so the deferred foreign keys are checked
+        establishment.delete()
+
+        self.assertFalse(Establishment.objects.filter(id=establishment.id).exists())
+        self.assertFalse(MenuTombstone.objects.exists())
+        self.assertEqual(Establishment.deleting(), set())
+
+        other = mommy.make(Menu, establishment=mommy.make(
+            Establishment, geo_loc=Point(-35.7, -9.6)))
+        mommy.make(MenuItem, menu=other).delete()
+        self.assertEqual(MenuTombstone.objects.count(), 1)
+
+
 class BillMemberTestCase(TestCase):
     def test_open_bill_twice_with_differente_bills_is_not_permited(self):
         '''
@@ -120,6 +543,896 @@ class OrderTestCase(TestCase):
         with self.assertRaises(CannotCancelOrderException):
             order.cancel()
 
+
+class OrderTransitionTestCase(TestCase):
+    def setUp(self):
+        self.bill = mommy.make(Bill, establishment__logo_url='logo.png')
+        self.customer = mommy.make(BillMember, bill=self.bill).customer
+
+    def make_order(self, status=Order.STATUS_PENDING):
+        return mommy.make(Order, bill=self.bill, user=self.customer,
+                          status=status, value_order=Decimal('10.00'))
+
+    def test_orders_are_accepted_with_one_notification_per_bill(self):
+        pending = [self.make_order(), self.make_order()]
+        preparing = self.make_order(Order.STATUS_PREPARING)
+        other = mommy.make(Order, status=Order.STATUS_PENDING)
+
+        orders = Order.transition(
+            self.bill.establishment_id,
+            [order.id for order in pending] + [preparing.id, other.id], 'accept')
+
+        self.assertEqual({order.id for order in orders},
+                         {order.id for order in pending})
+        for order in pending:
+            order.refresh_from_db()
+            self.assertEqual(order.status, Order.STATUS_PREPARING)
+            self.assertIsNotNone(order.kitchen_accepted_at)
+        other.refresh_from_db()
+        self.assertEqual(other.status, Order.STATUS_PENDING)
+
+        message = OutboxMessage.objects.get(kind=OutboxMessage.FCM)
+        data = json.loads(message.payload)['data']
+        self.assertEqual(data['key'], 'order_accepted')
+        self.assertIn(json.loads(data['data'])['id'],
+                      {order.id for order in pending})
+        self.assertEqual({order['id'] for order in json.loads(data['orders'])},
+                         {order.id for order in pending})
+
+    def test_cancel_removes_orders_from_bill_total(self):
+        orders = [self.make_order(), self.make_order(Order.STATUS_PREPARING)]
+        self.make_order()
+
+        Order.transition(self.bill.establishment_id,
+                         [order.id for order in orders], 'cancel')
+        self.bill.refresh_from_db()
+        self.assertEqual(self.bill.orders_total(), Decimal('10.00'))
+
+    def test_transition_view_reports_rejected_ids(self):
+        self.client.force_login(mommy.make(User, is_superuser=True))
+        url = reverse('register:orders_kitchen_transition',
+                      args=[self.bill.establishment_id])
+        order = self.make_order()
+        done = self.make_order(Order.STATUS_DONE)
+
+        response = self.client.post(
+            url, {'action': 'done', 'order': [order.id, done.id]})
+        self.assertEqual(response.json(), {'updated': [], 'rejected': sorted(
+            [order.id, done.id])})
+        response = self.client.post(url, {'action': 'accept', 'order': [order.id]})
+        self.assertEqual(response.json(), {'updated': [order.id], 'rejected': []})
+        response = self.client.post(url, {'action': 'serve', 'order': [order.id]})
+        self.assertEqual(response.status_code, 400)
+
+
+class OrderBulkCreateTestCase(TestCase):
+    def setUp(self):
+        self.bill = mommy.make(Bill)
+        self.user = mommy.make(BillMember, bill=self.bill).customer
+        self.items = mommy.make(MenuItem, menu__establishment=self.bill.establishment,
+                                price=Decimal('4.50'), _quantity=5)
+        self.url = reverse('register-api:api_order_post')
+        self.client.force_login(self.user)
+
+    def post(self, items):
+        return self.client.post(self.url, json.dumps({'items': [
+            {'bill': self.bill.id, 'item': item.id, 'quantity': 2}
+            for item in items]}), content_type='application/json')
+
+    def count_queries(self, items):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post(items)
+        self.assertEqual(response.status_code, 201)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_items(self):
+        one = self.count_queries(self.items[:1])
+        self.assertEqual(self.count_queries(self.items), one)
+
+    def test_orders_are_valued_and_added_to_bill(self):
+        response = self.post(self.items[:2])
+        self.assertEqual([order['total_price'] for order in response.json()],
+                         [9.0, 9.0])
+        self.bill.refresh_from_db()
+        self.assertEqual(self.bill.orders_total(), Decimal('18.00'))
+
+    def test_item_from_other_establishment_is_refused(self):
+        response = self.post([mommy.make(MenuItem)])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+
+
+class OfferEngineTestCase(TestCase):
+    def setUp(self):
+        self.bill = mommy.make(Bill, establishment__offer_range_value=Decimal('20.00'))
+        self.user = mommy.make(BillMember, bill=self.bill).customer
+        offer = mommy.make(MenuOffer, discount=Decimal('0.10'))
+        self.item = mommy.make(MenuItem, price=Decimal('15.00'), offer=offer)
+
+    def place(self):
+        return Order.create_orders(
+            [{'bill': self.bill, 'item': self.item, 'quantity': 1}], self.user)[0]
+
+    def test_offer_is_granted_once_the_range_is_reached(self):
+        first = self.place()
+        second = self.place()
+        self.assertIsNone(first.granted_offer_id)
+        self.assertEqual(second.granted_offer_id, self.item.offer_id)
+
+        self.bill.refresh_from_db()
+        self.assertEqual(
+            (self.bill.offers_made_count, self.bill.last_offer_used), (1, 20))
+
+    def test_listing_orders_does_not_write(self):
+        self.place()
+        self.place()
+        orders = Order.objects.filter(bill=self.bill).order_by('id')
+        with CaptureQueriesContext(connection) as queries:
+            data = OrderSerializerList(orders, many=True).data
+        self.assertFalse([query for query in queries
+                          if not query['sql'].startswith('SELECT')])
+        self.assertIsNone(data[0]['offer'])
+        self.assertEqual(data[1]['offer']['id'], self.item.offer_id)
+
+    def test_offer_is_used_only_once(self):
+        self.place()
+        self.place()
+        self.assertTrue(self.bill.use_offer())
+        self.assertFalse(self.bill.use_offer())
+
+    def test_dashboard_order_is_granted_offer(self):
+        self.place()
+        self.client.force_login(mommy.make(User, is_superuser=True))
+        url = reverse('register:order_create', args=[self.bill.establishment_id])
+        response = self.client.post(url, {
+            'menu_item': self.item.name, 'bill': self.bill.id,
+            'user': self.user.id, 'quantity': 1})
+        self.assertEqual(response.status_code, 302)
+
+        order = Order.objects.filter(bill=self.bill).latest('id')
+        self.assertEqual(order.granted_offer_id, self.item.offer_id)
+
+
+class RevenuesSeriesTestCase(TestCase):
+    def setUp(self):
+        self.establishment = mommy.make(Establishment)
+
+    def pay(self, date, value, establishment=None,
+            status=BillPayment.STATUS_AUTHORIZED):
+        payment = mommy.make(BillPayment, establishment=establishment or self.establishment,
+                             value=Decimal(value), status_payment=status)
+        BillPayment.objects.filter(id=payment.id).update(date=timezone.make_aware(date))
+
+    def test_calendar_months_are_zero_filled(self):
+        self.pay(datetime.datetime(2019, 3, 10), '10.00')
+        self.pay(datetime.datetime(2019, 3, 11), '3.00',
+                 status=BillPayment.STATUS_CANCELLED)
+        self.pay(datetime.datetime(2019, 1, 31, 23), '5.00')
+        self.pay(datetime.datetime(2018, 10, 1), '7.00')
+        self.pay(datetime.datetime(2018, 9, 30), '1.00')
+        EstablishmentDailyStats.rebuild()
+
+        with self.assertNumQueries(1):
+            series = revenues_series(datetime.date(2019, 3, 31), 'revenue')
+        self.assertEqual([month['month'] for month in series],
+                         ['10', '11', '12', '1', '2', '3'])
+        self.assertEqual([month['value'] for month in series],
+                         [Decimal('7.00'), 0, 0, Decimal('5.00'), 0, Decimal('10.00')])
+
+    def test_establishment_filter(self):
+        self.pay(datetime.datetime(2019, 3, 10), '10.00')
+        self.pay(datetime.datetime(2019, 3, 10), '4.00',
+                 establishment=mommy.make(Establishment))
+        EstablishmentDailyStats.rebuild()
+
+        series = revenues_series(datetime.date(2019, 3, 1), 'payment_online',
+                                 self.establishment)
+        self.assertEqual(series[-1], {'month': '3', 'value': Decimal('10.00')})
+        series = revenues_series(datetime.date(2019, 3, 1), 'payment_online')
+        self.assertEqual(series[-1]['value'], Decimal('14.00'))
+
+
+class DailyStatsTestCase(TestCase):
+    def setUp(self):
+        self.establishment = mommy.make(Establishment)
+        self.bill = mommy.make(Bill, establishment=self.establishment)
+        self.today = timezone.localtime().date()
+
+    def test_rebuild_counts_each_source(self):
+        mommy.make(Order, bill=self.bill, quantity=2)
+        mommy.make(Order, bill=self.bill, quantity=1,
+                   canceled_at=timezone.now())
+        mommy.make(BillPayment, establishment=self.establishment, bill=self.bill,
+                   value=Decimal('10.00'), moip_fee=Decimal('0.50'),
+                   noruh_fee=Decimal('1.00'),
+                   status_payment=BillPayment.STATUS_AUTHORIZED)
+        mommy.make(BillPayment, establishment=self.establishment, bill=self.bill,
+                   value=Decimal('4.00'),
+                   status_payment=BillPayment.STATUS_OFFLINE_APPROVED)
+        mommy.make(BillPayment, establishment=self.establishment, bill=self.bill,
+                   value=Decimal('9.00'),
+                   status_payment=BillPayment.STATUS_CANCELLED)
+        mommy.make(UserRating, bill=self.bill, environment=6, food=6, service=9)
+
+        self.assertEqual(EstablishmentDailyStats.rebuild(), 1)
+        stats = EstablishmentDailyStats.objects.get(establishment=self.establishment)
+        self.assertEqual(stats.day, self.today)
+        self.assertEqual((stats.bills_opened, stats.orders_placed,
+                          stats.orders_cancelled, stats.items_sold), (1, 1, 1, 2))
+        self.assertEqual(stats.payments_approved, 2)
+        self.assertEqual(stats.revenue_online, Decimal('10.00'))
+        self.assertEqual(stats.revenue_offline, Decimal('4.00'))
+        self.assertEqual(stats.moip_fees, Decimal('0.50'))
+        self.assertEqual(stats.noruh_fees, Decimal('1.00'))
+        self.assertEqual((stats.rating_sum, stats.rating_count), (Decimal('7.0'), 1))
+        self.assertEqual(self.establishment.average_bills(self.today), Decimal('7.00'))
+
+    def test_refresh_takes_changes_since_watermark(self):
+        self.assertEqual(EstablishmentDailyStats.refresh(), 1)
+        watermark = StatsWatermark.objects.get(name=EstablishmentDailyStats.WATERMARK)
+
+        other = mommy.make(Establishment)
+        old_bill = mommy.make(Bill, establishment=other)
+        Bill.objects.filter(id=old_bill.id).update(
+            opening_date=timezone.now() - datetime.timedelta(days=30))
+        order = mommy.make(Order, bill=self.bill, quantity=3)
+        # Changed before the watermark, minus the overlap: not picked up
+        StatsWatermark.objects.filter(id=watermark.id).update(
+            processed_until=timezone.now() + EstablishmentDailyStats.REFRESH_OVERLAP)
+        EstablishmentDailyStats.refresh()
+        self.assertEqual(EstablishmentDailyStats.objects.get(
+            establishment=self.establishment).orders_placed, 0)
+
+        StatsWatermark.objects.filter(id=watermark.id).update(
+            processed_until=watermark.processed_until)
+        order.status = Order.STATUS_REJECTED
+        order.canceled_at = timezone.now()
+        order.save()
+        EstablishmentDailyStats.refresh()
+        stats = EstablishmentDailyStats.objects.get(establishment=self.establishment)
+        self.assertEqual((stats.orders_placed, stats.orders_cancelled), (0, 1))
+        self.assertFalse(EstablishmentDailyStats.objects.filter(
+            establishment=other).exists())
+
+    def test_refresh_takes_deleted_rows(self):
+        EstablishmentDailyStats.refresh()
+        other_bill = mommy.make(Bill, establishment=self.establishment)
+        mommy.make(Order, bill=other_bill, quantity=2)
+        mommy.make(UserRating, bill=other_bill, environment=6, food=6, service=9)
+        EstablishmentDailyStats.refresh()
+        stats = EstablishmentDailyStats.objects.get(establishment=self.establishment)
+        self.assertEqual((stats.bills_opened, stats.orders_placed, stats.rating_count),
+                         (2, 1, 1))
+
+        other_bill.delete()
+        self.assertFalse(DailyStatsChange.objects.filter(
+            establishment_id__isnull=True).exists())
+        EstablishmentDailyStats.refresh()
+        stats = EstablishmentDailyStats.objects.get(establishment=self.establishment)
+        self.assertEqual((stats.bills_opened, stats.orders_placed, stats.rating_count),
+                         (1, 0, 0))
+        self.assertFalse(DailyStatsChange.objects.exists())
+
+    def test_refresh_rebuilds_only_touched_days(self):
+        busy, quiet = mommy.make(Establishment, _quantity=2)
+        Bill.objects.filter(id=self.bill.id).update(
+            opening_date=timezone.now() - datetime.timedelta(days=1))
+        for days_ago in range(1, 32):
+            bill = mommy.make(Bill, establishment=busy)
+            Bill.objects.filter(id=bill.id).update(
+                opening_date=timezone.now() - datetime.timedelta(days=days_ago))
+        old_payment = mommy.make(BillPayment, establishment=busy, bill=bill,
+                                 value=Decimal('5.00'))
+        BillPayment.objects.filter(id=old_payment.id).update(
+            date=timezone.now() - datetime.timedelta(days=31))
+        EstablishmentDailyStats.refresh()
+        untouched = set(EstablishmentDailyStats.objects.filter(
+            establishment=busy).values_list('id', flat=True))
+        self.assertEqual(len(untouched), 31)
+
+        # an old deleted payment on one establishment, today's bill on another
+        BillPayment.objects.get(id=old_payment.id).delete()
+        mommy.make(Bill, establishment=quiet)
+        # one row each, not the 31 days between them
+        self.assertEqual(EstablishmentDailyStats.refresh(), 2)
+        self.assertEqual(len(untouched & set(EstablishmentDailyStats.objects.filter(
+            establishment=busy).values_list('id', flat=True))), 30)
+
+    def test_dashboard_totals(self):
+        mommy.make(BillPayment, establishment=self.establishment, bill=self.bill,
+                   value=Decimal('50.00'),
+                   status_payment=BillPayment.STATUS_OFFLINE_APPROVED)
+        EstablishmentDailyStats.rebuild()
+
+        self.assertEqual(EstablishmentDailyStats.totals(
+            self.today, self.today)['revenue_offline'], Decimal('50.00'))
+        self.assertEqual(Establishment.report_offline_all_establishments(self.today),
+                         Decimal('50.00') * self.establishment.offline_percentage)
+
+
+class EstablishmentsPerformanceTestCase(TestCase):
+    def setUp(self):
+        self.establishments = [
+            mommy.make(Establishment, name=f'Establishment {index}',
+                       noruh_fee=Decimal('2.00'))
+            for index in range(3)]
+        day = datetime.date(2019, 3, 1)
+        for index, establishment in enumerate(self.establishments):
+            for offset in range(2):
+                mommy.make(EstablishmentDailyStats, establishment=establishment,
+                           day=day + datetime.timedelta(days=offset),
+                           payments_approved=2, orders_placed=index,
+                           orders_cancelled=1, revenue_online=Decimal(index * 10),
+                           revenue_offline=Decimal('5.00'),
+                           rating_sum=Decimal('9.0'), rating_count=index)
+
+    def test_totals_in_constant_queries(self):
+        with self.assertNumQueries(2):
+            page = establishments_performance('-all_billing', per_page=2)
+            rows = list(page)
+        self.assertEqual(page.paginator.num_pages, 2)
+        self.assertEqual([row['id'] for row in rows],
+                         [self.establishments[2].id, self.establishments[1].id])
+        first = rows[0]
+        self.assertEqual(first['all_billing'], Decimal('50.00'))
+        self.assertEqual(first['all_orders'], 6)
+        self.assertEqual(first['noruh_tax_to_super_admin'], Decimal('8.00'))
+        self.assertEqual(first['average_bills'], Decimal('12.5'))
+        self.assertEqual(first['evaluation_average'], Decimal('4.5'))
+
+    def test_unknown_order_falls_back_to_name(self):
+        page = establishments_performance('-average_bills; drop', per_page=2)
+        self.assertEqual([row['name'] for row in page],
+                         ['Establishment 0', 'Establishment 1'])
+        self.assertEqual(list(page)[0]['evaluation_average'], 0)
+
+
+class OfflineLedgerTestCase(TestCase):
+    def setUp(self):
+        self.establishment = mommy.make(Establishment,
+                                        offline_percentage=Decimal('0.10'))
+        self.month_start = timezone.localtime().replace(
+            day=1, hour=12, minute=0, second=0, microsecond=0)
+        self.last_month = (self.month_start - datetime.timedelta(days=1)).replace(day=1)
+
+    def pay(self, date, value, status=BillPayment.STATUS_OFFLINE_APPROVED):
+        payment = mommy.make(BillPayment, establishment=self.establishment,
+                             value=Decimal(value), status_payment=status)
+        BillPayment.objects.filter(id=payment.id).update(date=date, updated_at=date)
+        return payment
+
+    def test_closed_months_are_snapshotted_once(self):
+        self.pay(self.month_start, '30.00')
+        old_payment = self.pay(self.last_month, '20.00')
+        self.pay(self.last_month, '7.00', status=BillPayment.STATUS_OFFLINE_CANCELLED)
+        mommy.make(OfflineCompensations, establishment=self.establishment,
+                   year=self.last_month.year, month=self.last_month.month,
+                   value=Decimal('2.00'))
+
+        expected = [(self.month_start.year, self.month_start.month, Decimal('30.00')),
+                    (self.last_month.year, self.last_month.month, Decimal('20.00'))]
+        # before the task closes the last month, it is summed from payments
+        ledger = self.establishment.report_offline_payment()
+        self.assertEqual([(month['y'], month['m'], month['total'])
+                          for month in ledger], expected)
+        self.assertEqual(OfflineMonthSnapshot.close_months(), 1)
+
+        with CaptureQueriesContext(connection) as queries:
+            ledger = self.establishment.report_offline_payment()
+        self.assertFalse([query for query in queries
+                          if not query['sql'].startswith('SELECT')])
+        self.assertEqual([(month['y'], month['m'], month['total'])
+                          for month in ledger], expected)
+        self.assertEqual(ledger[0]['compensation_value'], Decimal('3.00'))
+        self.assertFalse(ledger[0]['compensation'])
+        self.assertEqual(ledger[1]['compensation_value'], Decimal('2.00'))
+        self.assertEqual(ledger[1]['compensation'], timezone.localdate())
+
+        BillPayment.objects.filter(id=old_payment.id).update(value=Decimal('99.00'))
+        self.assertEqual(OfflineMonthSnapshot.close_months(), 0)
+        self.assertEqual(OfflineMonthSnapshot.ledger_month(
+            self.establishment, self.last_month.year, self.last_month.month)['total'],
+            Decimal('20.00'))
+        self.assertEqual(OfflineMonthSnapshot.objects.count(), 1)
+
+    def test_late_approval_builds_the_month_again(self):
+        self.pay(self.last_month, '20.00')
+        late = self.pay(self.last_month, '5.00',
+                        status=BillPayment.STATUS_OFFLINE_PENDING)
+        self.assertEqual(OfflineMonthSnapshot.close_months(), 1)
+        snapshot = OfflineMonthSnapshot.objects.get()
+
+        late.status_payment = BillPayment.STATUS_OFFLINE_APPROVED
+        late.save()
+        self.assertEqual(OfflineMonthSnapshot.close_months(), 1)
+        month = OfflineMonthSnapshot.ledger_month(
+            self.establishment, self.last_month.year, self.last_month.month)
+        self.assertEqual(month['total'], Decimal('25.00'))
+        self.assertGreater(OfflineMonthSnapshot.objects.get().built_at,
+                           snapshot.built_at)
+
+    def test_rebuild(self):
+        payment = self.pay(self.last_month, '20.00')
+        OfflineMonthSnapshot.close_months()
+        BillPayment.objects.filter(id=payment.id).update(value=Decimal('8.00'))
+
+        self.assertEqual(OfflineMonthSnapshot.rebuild(), 1)
+        self.assertEqual(OfflineMonthSnapshot.objects.get().total, Decimal('8.00'))
+
+
+class ExportTestCase(TestCase):
+    def test_xlsx_is_a_valid_workbook(self):
+        chunks = list(XLSXExport().stream(
+            iter([['Conta', 'a < b'], ['#1', Decimal('2.50'), None]])))
+        workbook = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+        self.assertIsNone(workbook.testzip())
+        sheet = workbook.read('xl/worksheets/sheet1.xml').decode()
+        self.assertIn('<t>a &lt; b</t>', sheet)
+        self.assertIn('<c><v>2.50</v></c><c/>', sheet)
+
+    def test_xlsx_drops_control_characters(self):
+        chunks = list(XLSXExport().stream(iter([['Mesa\x01 1\x1f', 'a\tb']])))
+        workbook = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+        sheet = workbook.read('xl/worksheets/sheet1.xml').decode()
+        ElementTree.fromstring(sheet)
+        self.assertIn('<t>Mesa 1</t>', sheet)
+        self.assertIn('<t>a\tb</t>', sheet)
+
+    def test_payments_are_read_in_one_query(self):
+        bill = mommy.make(Bill)
+        mommy.make(BillMember, bill=bill, _quantity=2)
+        mommy.make(BillPayment, bill=bill, establishment=bill.establishment,
+                   _quantity=3)
+        with self.assertNumQueries(1):
+            payments = list(payments_for_export())
+        self.assertEqual([payment.member_count for payment in payments],
+                         [bill.customers.count()] * 3)
+
+    def test_payments_export_streams_csv(self):
+        bill = mommy.make(Bill)
+        payment = mommy.make(BillPayment, bill=bill, establishment=bill.establishment,
+                             value=Decimal('12.00'))
+        self.client.force_login(mommy.make(User, is_superuser=True))
+
+        response = self.client.get(reverse('register:payments_export'))
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(',')[0], 'Pagamento')
+        self.assertEqual(lines[1].split(',')[0], f'#{payment.id}')
+        self.assertIn('12.00', lines[1])
+
+
+class BillTotalsTestCase(TestCase):
+    def test_orders_subtotal_follows_order_status(self):
+        bill = mommy.make(Bill)
+        first = mommy.make(Order, bill=bill, value_order=Decimal('10.00'))
+        mommy.make(Order, bill=bill, value_order=Decimal('5.50'))
+        self.assertEqual(bill.orders_total(), Decimal('15.50'))
+
+        first.status = Order.STATUS_REJECTED
+        first.save()
+        bill.refresh_from_db()
+        self.assertEqual(bill.orders_total(), Decimal('5.50'))
+
+    def test_value_order_filled_from_item_is_counted_once(self):
+        bill = mommy.make(Bill)
+        order = mommy.make(Order, bill=bill, value_order=None, quantity=2)
+        bill.refresh_from_db()
+        self.assertEqual(bill.orders_total(), order.item.price * 2)
+
+    def test_members_count_and_stale_bill_save(self):
+        bill = mommy.make(Bill)
+        stale = Bill.objects.get(id=bill.id)
+        mommy.make(BillMember, bill=bill, _quantity=3)
+        stale.offers_made_count = 1
+        stale.save()
+
+        bill.refresh_from_db()
+        self.assertEqual(bill.number_of_customers(), bill.customers.count())
+        self.assertEqual(bill.offers_made_count, 1)
+
+    def test_rebuild_matches_running_totals(self):
+        bill = mommy.make(Bill)
+        mommy.make(BillMember, bill=bill, _quantity=2)
+        mommy.make(Order, bill=bill, value_order=Decimal('7.25'), _quantity=2)
+        bill.refresh_from_db()
+        totals = (bill.orders_subtotal, bill.members_count)
+
+        Bill.objects.update(orders_subtotal=0, members_count=0)
+        Bill.rebuild_totals()
+        bill.refresh_from_db()
+        self.assertEqual((bill.orders_subtotal, bill.members_count), totals)
+
+
+class BillSplitTestCase(TestCase):
+    def test_split_matches_each_member(self):
+        bill = mommy.make(Bill)
+        members = mommy.make(BillMember, bill=bill, _quantity=4)
+        for value, member in zip(('10.00', '2.50'), members):
+            mommy.make(Order, bill=bill, user=member.customer,
+                       value_order=Decimal(value), _quantity=2)
+        mommy.make(Order, bill=bill, user=members[0].customer,
+                   value_order=Decimal('99.00'),
+                   status=Order.STATUS_REJECTED)
+
+        with CaptureQueriesContext(connection) as queries:
+            split_members = BillSplit(bill).attach(
+                BillMember.objects.filter(bill=bill).order_by('id'))
+            totals = [member.value_consumed() for member in split_members]
+        self.assertEqual(len(queries), 2)
+
+        fresh = [BillMember.objects.get(id=member.id).value_consumed()
+                 for member in split_members]
+        self.assertEqual(totals, fresh)
+        self.assertEqual(split_members[0].value_consumed_without_taxes(),
+                         Decimal('20.00'))
+        self.assertEqual(split_members[3].value_consumed_without_taxes(), 0)
+
+
+class BillSettlementTestCase(TestCase):
+    def setUp(self):
+        establishment = mommy.make(
+            Establishment, geo_loc=Point(-35.7, -9.6), noruh_fee=0,
+            taxe_couvert=0, taxe_service=Decimal('0.10'))
+        self.bill = mommy.make(Bill, establishment=establishment)
+        self.members = mommy.make(BillMember, bill=self.bill, _quantity=2)
+        mommy.make(Order, bill=self.bill, value_order=Decimal('100.00'))
+
+    def make_payment(self, member, value):
+        return mommy.make(
+            BillPayment, bill=self.bill, establishment=self.bill.establishment,
+            bill_member=member, value=Decimal(value), promocode=None,
+            status_payment=BillPayment.STATUS_OFFLINE_PENDING)
+
+    def test_payment_is_applied_once(self):
+        payment = self.make_payment(self.members[0], '40.00')
+        settlement = payment.settle(BillPayment.STATUS_OFFLINE_APPROVED)
+        self.assertTrue(settlement.applied)
+        self.assertFalse(settlement.closed)
+
+        settlement = payment.settle(BillPayment.STATUS_OFFLINE_APPROVED)
+        self.assertFalse(settlement.applied)
+        self.bill.refresh_from_db()
+        self.assertEqual(self.bill.value_paid, Decimal('40.00'))
+        self.assertEqual(BillMember.objects.filter(
+            bill=self.bill, leave_at__isnull=True).get(), self.members[1])
+
+    def test_bill_closes_when_paid(self):
+        self.make_payment(self.members[0], '40.00').settle(
+            BillPayment.STATUS_OFFLINE_APPROVED)
+        settlement = self.make_payment(self.members[1], '70.00').settle(
+            BillPayment.STATUS_OFFLINE_APPROVED)
+
+        self.assertTrue(settlement.closed)
+        self.bill.refresh_from_db()
+        self.assertIsNotNone(self.bill.payment_date)
+        self.assertFalse(BillMember.objects.filter(
+            bill=self.bill, leave_at__isnull=True).exists())
+
+
+class BillSettlementConcurrencyTestCase(TransactionTestCase):
+    def test_parallel_payments_are_all_applied(self):
+        establishment = mommy.make(Establishment, geo_loc=Point(-35.7, -9.6))
+        bill = mommy.make(Bill, establishment=establishment)
+        mommy.make(Order, bill=bill, value_order=Decimal('999.00'))
+        payments = [
+            mommy.make(BillPayment, bill=bill, establishment=establishment,
+                       bill_member=mommy.make(BillMember, bill=bill),
+                       value=Decimal('10.00'), promocode=None,
+                       status_payment=BillPayment.STATUS_OFFLINE_PENDING)
+            for _ in range(5)]
+
+        def settle(payment_id):
+            try:
+                BillPayment.objects.get(id=payment_id).settle(
+                    BillPayment.STATUS_OFFLINE_APPROVED)
+            finally:
+                connection.close()
+
+        # the first payment twice, it must still be applied only once
+        ids = [payment.id for payment in payments] + [payments[0].id]
+        threads = [threading.Thread(target=settle, args=(payment_id,))
+                   for payment_id in ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        bill.refresh_from_db()
+        self.assertEqual(bill.value_paid, Decimal('50.00'))
+        self.assertEqual(BillPayment.objects.filter(
+            bill=bill, settled_at__isnull=False).count(), 5)
+
+
+class OutboxTestCase(TestCase):
+    def test_refused_member_notification_is_queued(self):
+        bill_member = mommy.make(BillMember)
+        BillMember.answer_to_bill_member(bill_member, False)
+
+        message = OutboxMessage.objects.get(kind=OutboxMessage.FCM)
+        self.assertEqual(json.loads(message.payload)['user_ids'],
+                         [bill_member.customer_id])
+        self.assertIsNone(message.sent_at)
+
+    def test_failed_delivery_is_retried_later(self):
+        message = OutboxMessage.send_firestore({'action': 'bill_closed'})
+
+        with mock.patch.object(OutboxMessage, 'deliver',
+                               side_effect=RuntimeError('unavailable')):
+            with self.assertRaises(Retry):
+                deliver_outbox_message.run(message.id)
+        message.refresh_from_db()
+        self.assertEqual(message.attempts, 1)
+        self.assertIsNone(message.sent_at)
+        self.assertGreater(message.available_at, message.created_at)
+
+        with mock.patch.object(OutboxMessage, 'deliver'):
+            self.assertTrue(deliver_outbox_message.run(message.id))
+        message.refresh_from_db()
+        self.assertIsNotNone(message.sent_at)
+        self.assertFalse(deliver_outbox_message.run(message.id))
+
+
+class FakePusherServer:
+    '''
+    Local HTTP endpoint answering like the Pusher API and recording the
+    path and body of every request.
+    '''
+
+    def __init__(self):
+        self.requests = []
+        requests = self.requests
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                requests.append((self.path.split('?')[0],
+                                 json.loads(self.rfile.read(length))))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def client(self):
+        return pusher.Pusher(app_id='1', key='key', secret='secret',
+                             host='127.0.0.1', port=self.httpd.server_port,
+                             ssl=False)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def calls(self, path):
+        return [body for request_path, body in self.requests
+                if request_path == path]
+
+
+class PusherNotificationTestCase(SimpleTestCase):
+    def setUp(self):
+        self.server = FakePusherServer()
+        self.addCleanup(self.server.stop)
+        patcher = mock.patch.object(
+            PusherNotification, 'pusher_client', self.server.client())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_channels_are_triggered_in_chunks(self):
+        PusherNotification.send_notifications(
+            range(250), 'kitchen', 'makes_new_order', {'order_id': 1})
+
+        triggers = self.server.calls('/apps/1/events')
+        self.assertEqual([len(body['channels']) for body in triggers],
+                         [100, 100, 50])
+
+    def test_single_channel_events_are_batched(self):
+        notifications = [([id], 'waiter', 'request_for_waiter', {})
+                         for id in range(12)]
+        notifications.append((range(16), 'kitchen', 'makes_new_order', {}))
+        PusherNotification.send_batch(notifications)
+
+        self.assertEqual(len(self.server.calls('/apps/1/events')), 1)
+        batches = self.server.calls('/apps/1/batch_events')
+        self.assertEqual([len(body['batch']) for body in batches], [10, 2])
+
+
+class RealtimeGatewayTestCase(SimpleTestCase):
+    def setUp(self):
+        self.broker = MemoryBroker()
+        self.client = GatewayClient(key='key', secret='secret',
+                                    broker=self.broker)
+        self.gateway = Gateway(key='key', secret='secret', broker=self.broker)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def connect(self, path='/app/key'):
+        received = asyncio.Queue()
+        sent = asyncio.Queue()
+        task = asyncio.ensure_future(self.gateway(
+            {'type': 'websocket', 'path': path}, received.get, sent.put))
+        received.put_nowait({'type': 'websocket.connect'})
+        return task, received, sent
+
+    async def next_frame(self, sent):
+        message = await asyncio.wait_for(sent.get(), 1)
+        return json.loads(message['text'])
+
+    def test_private_channel_receives_published_events(self):
+        async def scenario():
+            task, received, sent = self.connect()
+            self.assertEqual((await sent.get())['type'], 'websocket.accept')
+            frame = await self.next_frame(sent)
+            socket_id = json.loads(frame['data'])['socket_id']
+
+            channel = 'private-kitchen-est-1'
+            auth = self.client.authenticate(channel, socket_id)['auth']
+            received.put_nowait({'type': 'websocket.receive', 'text': json.dumps(
+                {'event': 'pusher:subscribe',
+                 'data': {'channel': channel, 'auth': auth}})})
+            frame = await self.next_frame(sent)
+            self.assertEqual(frame['event'],
+                             'pusher_internal:subscription_succeeded')
+
+            self.client.trigger_batch([
+                {'channel': channel, 'name': 'makes_new_order',
+                 'data': {'id': 1}},
+                {'channel': 'private-waiter-est-1', 'name': 'makes_new_order',
+                 'data': {'id': 1}}])
+            frame = await self.next_frame(sent)
+            self.assertEqual(frame, {'event': 'makes_new_order',
+                                     'channel': channel,
+                                     'data': json.dumps({'id': 1})})
+            self.assertTrue(sent.empty())
+
+            received.put_nowait({'type': 'websocket.disconnect'})
+            await task
+            self.assertEqual(self.gateway.channels, {})
+
+        self.loop.run_until_complete(scenario())
+
+    def test_private_channel_needs_valid_auth(self):
+        async def scenario():
+            task, received, sent = self.connect()
+            await sent.get()
+            await self.next_frame(sent)
+            received.put_nowait({'type': 'websocket.receive', 'text': json.dumps(
+                {'event': 'pusher:subscribe',
+                 'data': {'channel': 'private-kitchen-est-1',
+                          'auth': 'key:forged'}})})
+            frame = await self.next_frame(sent)
+            self.assertEqual(frame['event'], 'pusher:subscription_error')
+            self.assertEqual(self.gateway.channels, {})
+            received.put_nowait({'type': 'websocket.disconnect'})
+            await task
+
+        self.loop.run_until_complete(scenario())
+
+    def test_unknown_app_key_is_refused(self):
+        async def scenario():
+            task, received, sent = self.connect('/app/other')
+            await task
+            self.assertEqual(await sent.get(),
+                             {'type': 'websocket.close', 'code': 4001})
+
+        self.loop.run_until_complete(scenario())
+
+    def test_invalid_frame_gets_an_error(self):
+        async def scenario():
+            task, received, sent = self.connect()
+            await sent.get()
+            await self.next_frame(sent)
+            for text in ('not json', '[]', json.dumps({'data': 'nope'})):
+                received.put_nowait({'type': 'websocket.receive', 'text': text})
+                frame = await self.next_frame(sent)
+                self.assertEqual(frame['event'], 'pusher:error')
+
+            received.put_nowait({'type': 'websocket.receive', 'text': json.dumps(
+                {'event': 'pusher:ping', 'data': {}})})
+            frame = await self.next_frame(sent)
+            self.assertEqual(frame['event'], 'pusher:pong')
+            received.put_nowait({'type': 'websocket.disconnect'})
+            await task
+
+        self.loop.run_until_complete(scenario())
+
+    def test_messages_after_stop_are_dropped(self):
+        self.gateway.start()
+        receive = self.gateway.receive_threadsafe
+        self.gateway.stop()
+        receive({'channel': 'kitchen', 'event': 'makes_new_order', 'data': '{}'})
+        self.assertIsNone(self.gateway.loop)
+
+
+class StaffChannelTestCase(TestCase):
+    def setUp(self):
+        self.employee = mommy.make(Employee, user_type=Employee.USER_KITCHEN)
+        self.channel = 'private-kitchen-est-%s' % self.employee.establishment_id
+
+    def test_employee_subscribes_only_to_own_role_and_establishment(self):
+        other = mommy.make(Establishment)
+        self.assertTrue(self.employee.can_subscribe(self.channel))
+        self.assertFalse(self.employee.can_subscribe(
+            'private-waiter-est-%s' % self.employee.establishment_id))
+        self.assertFalse(self.employee.can_subscribe(
+            'private-kitchen-est-%s' % other.id))
+        self.assertFalse(self.employee.can_subscribe(
+            'kitchen-%s' % self.employee.user_id))
+
+    def test_order_cancel_notifies_establishment_channel(self):
+        order = mommy.make(Order, bill__establishment=self.employee.establishment)
+        order.send_pusher_notification()
+
+        message = OutboxMessage.objects.get(kind=OutboxMessage.PUSHER)
+        self.assertEqual(json.loads(message.payload)['notifications'], [[
+            [self.employee.establishment_id], 'private-kitchen-est',
+            'cancels_existing_order', {'order_id': order.id}]])
+
+    def test_auth_endpoint_checks_employee_role(self):
+        url = reverse('register:pusher_auth')
+        self.client.force_login(self.employee.user)
+
+        response = self.client.post(
+            url, {'channel_name': self.channel, 'socket_id': '1234.5678'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('auth', response.json())
+
+        response = self.client.post(url, {
+            'channel_name': 'private-door_man-est-%s' % self.employee.establishment_id,
+            'socket_id': '1234.5678'})
+        self.assertEqual(response.status_code, 403)
+
+
+class KitchenOrdersFeedTestCase(TestCase):
+    def setUp(self):
+        self.establishment = mommy.make(Establishment)
+        self.client.force_login(mommy.make(User, is_superuser=True))
+        self.url = reverse('register:orders_kitchen_feed',
+                           args=[self.establishment.id])
+        self.cursor = to_version(timezone.now())
+
+    def make_order(self, **kwargs):
+        return mommy.make(Order, bill__establishment=self.establishment,
+                          status=Order.STATUS_PENDING, **kwargs)
+
+    def test_only_orders_changed_after_cursor_are_sent(self):
+        old = self.make_order()
+        self.cursor = to_version(timezone.now())
+        new = self.make_order()
+
+        response = self.client.get(self.url, {'since': self.cursor})
+        data = response.json()
+        self.assertEqual([order['id'] for order in data['orders']], [new.id])
+        self.assertIn('data-order-id="%s"' % new.id, data['orders'][0]['html'])
+
+        # the cursor stays behind the overlap window, so both come again
+        response = self.client.get(self.url, {'since': data['cursor']})
+        self.assertEqual(
+            [order['id'] for order in response.json()['orders']],
+            [old.id, new.id])
+
+        Order.objects.update(updated_at=timezone.now() - 2 * SYNC_OVERLAP)
+        response = self.client.get(self.url, {'since': data['cursor']})
+        self.assertEqual(response.json()['orders'], [])
+
+    def test_order_leaving_the_screen_has_no_card(self):
+        order = self.make_order()
+        order.status = Order.STATUS_PREPARING
+        order.save()
+
+        response = self.client.get(self.url, {'since': self.cursor,
+                                              'status': Order.STATUS_PENDING})
+        self.assertEqual(response.json()['orders'], [
+            {'id': order.id, 'status': Order.STATUS_PREPARING, 'html': None}])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
 # Forms Tests
 
 
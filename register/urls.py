@@ -16,6 +16,7 @@ urlpatterns = [
 
      path('', Home.as_view(), name='home'),
      path('terms_and_conditions/', TermsAndContions.as_view(), name='terms_and_conditions'),
+     path('pusher/auth/', PusherAuth.as_view(), name='pusher_auth'),
 
      # Url's for Establishments and configurations
      path('establishment/create/', CreateEstablishment.as_view(),
@@ -155,6 +156,10 @@ urlpatterns = [
           ListOrdersPreparingKitchen.as_view(), name='orders_list_kitchen_preparing'),
      path('orders/list/kitchen/done/<int:establishment_id>/',
           ListOrdersDoneKitchen.as_view(), name='orders_list_kitchen_done'),
+     path('orders/kitchen/feed/<int:establishment_id>/',
+          KitchenOrdersFeed.as_view(), name='orders_kitchen_feed'),
+     path('orders/kitchen/transition/<int:establishment_id>/',
+          KitchenOrdersTransition.as_view(), name='orders_kitchen_transition'),
 
      # Cancel Orders Button
      path('order/cancel_from_list_orders/<int:order_id>/',
@@ -265,6 +270,7 @@ urlpatterns = [
           CreateCompensation.as_view(), name='offline_compensations_check_month'),    
      path('offline/compensations/generate_report/<int:month>/<int:year>/<int:establishment_id>/', GenerateCSVReport.as_view(),
           name='offline_compensations_generate_report'),
+     path('payments/export/', PaymentsExport.as_view(), name='payments_export'),
            
 ]
 
@@ -1,245 +1,79 @@
 import datetime
-from django.db.models import Sum, Avg
-from .models import Bill, Establishment, Order, UserRating, BillPayment
+from django.core.paginator import Paginator
+from django.db.models import (
+    Case, DecimalField, ExpressionWrapper, F, Sum, Value, When)
+from django.db.models.functions import Coalesce, TruncMonth
+from django.utils import timezone
+from .models import Establishment, EstablishmentDailyStats, month_days
 
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
 
-def all_establishments_revenues(current_month, type_filter):
-    current_month = current_month.replace(day=1)
-    values = []
 
-    if type_filter == 'all_bills':
-        for iteration in range(6, 0, -1):
-            value_query = Bill.objects.filter(
-                opening_date__year=current_month.year,
-                opening_date__month=current_month.month).count()
-            month_dict = {}
-            number_month = str(current_month.month)
-            month_dict['month'] = number_month
-            month_dict['value'] = value_query
-            values.append(month_dict)
-            current_month = current_month - datetime.timedelta(weeks=4)
+def to_version(moment):
+    # microseconds since the epoch, safe to send back in a query string
+    return (moment - EPOCH) // datetime.timedelta(microseconds=1)
 
-    elif type_filter == 'all_orders':
-        for iteration in range(6, 0, -1):
-            value_query = Order.objects.filter(
-                created_at__year=current_month.year,
-                created_at__month=current_month.month,
-                canceled_at__isnull=True).count()
-
-            month_dict = {}
-            number_month = str(current_month.month)
-            month_dict['month'] = number_month
-            month_dict['value'] = value_query
-            values.append(month_dict)
-            current_month = current_month - datetime.timedelta(weeks=4)
 
-    elif type_filter == 'payment_online':
-        for iteration in range(6, 0, -1):
-            value_query = BillPayment.objects.filter(
-                date__year=current_month.year,
-                date__month=current_month.month,
-                status_payment=BillPayment.STATUS_AUTHORIZED).aggregate(
-                    Sum('value'))
-            month_dict = {}
-            number_month = str(current_month.month)
-            month_dict['month'] = number_month
-            if not value_query.get('value__sum'):
-                month_dict['value'] = 0
-            else:
-                month_dict['value'] = value_query.get('value__sum')
-            values.append(month_dict)
-            current_month = current_month - datetime.timedelta(weeks=4)
+def from_version(version):
+    return EPOCH + datetime.timedelta(microseconds=version)
 
-    elif type_filter == 'payment_offline':
-        for iteration in range(6, 0, -1):
-            value_query = BillPayment.objects.filter(
-                date__year=current_month.year,
-                date__month=current_month.month,
-                status_payment=BillPayment.STATUS_OFFLINE_APPROVED).aggregate(
-                    Sum('value'))
-            month_dict = {}
-            number_month = str(current_month.month)
-            month_dict['month'] = number_month
-            if not value_query.get('value__sum'):
-                month_dict['value'] = 0
-            else:
-                month_dict['value'] = value_query.get('value__sum')
-            values.append(month_dict)
-            current_month = current_month - datetime.timedelta(weeks=4)
 
-    elif type_filter == 'evaluation_average':
-        for iteration in range(6, 0, -1):
-            value_query = UserRating.objects.filter(
-                bill__payment_date__year=current_month.year,
-                bill__payment_date__month=current_month.month).aggregate(
-                    Avg('average'))
-            month_dict = {}
-            number_month = str(current_month.month)
-            month_dict['month'] = number_month
-            if not value_query.get('average__avg'):
-                month_dict['value'] = 0
-            else:
-                month_dict['value'] = value_query.get('average__avg')
-            values.append(month_dict)
-            current_month = current_month - datetime.timedelta(weeks=4)
+# Rows are stamped when saved, not when committed, so a sync never moves
+# past this window behind now and reads it again on the next call
+SYNC_OVERLAP = datetime.timedelta(seconds=30)
 
-    elif type_filter == 'moip_taxe':
-        for iteration in range(6, 0, -1):
-            value_query = BillPayment.objects.filter(
-                date__year=current_month.year,
-                date__month=current_month.month).aggregate(
-                    Sum('moip_fee'))
-            month_dict = {}
-            number_month = str(current_month.month)
-            month_dict['month'] = number_month
-            if not value_query.get('moip_fee__sum'):
-                month_dict['value'] = 0
-            else:
-                month_dict['value'] = value_query.get('moip_fee__sum')
-            values.append(month_dict)
-            current_month = current_month - datetime.timedelta(weeks=4)
 
-    else:
-        for iteration in range(6, 0, -1):
-            value_query = BillPayment.objects.filter(
-                date__month=current_month.month,
-                date__year=current_month.year).aggregate(
-                    Sum('value'))
-            month_dict = {}
-            number_month = str(current_month.month)
-            month_dict['month'] = number_month
-            if not value_query.get('value__sum'):
-                month_dict['value'] = 0
-            else:
-                month_dict['value'] = value_query.get('value__sum')
-            values.append(month_dict)
-            current_month = current_month - datetime.timedelta(weeks=4)
-    return reversed(values)
-
-
-def establishment_revenues(current_month, type_filter, establishment):
-    current_month = current_month.replace(day=1)
-    values = []
+def sync_version(moments, since=None):
+    newest = max([to_version(moment) for moment in moments] + [since or 0])
+    return min(newest, to_version(timezone.now() - SYNC_OVERLAP))
 
-    if type_filter == 'all_bills':
-        for iteration in range(6, 0, -1):
-            value_query = Bill.objects.filter(
-                establishment=establishment,
-                opening_date__year=current_month.year,
-                opening_date__month=current_month.month).count()
-            month_dict = {}
-            number_month = str(current_month.month)
-            month_dict['month'] = number_month
-            month_dict['value'] = value_query
-            values.append(month_dict)
-            current_month = current_month - datetime.timedelta(weeks=4)
 
-    elif type_filter == 'all_orders':
-        for iteration in range(6, 0, -1):
-            value_query = Order.objects.filter(
-                bill__establishment=establishment,
-                created_at__year=current_month.year,
-                created_at__month=current_month.month,
-                canceled_at__isnull=True).count()
-
-            month_dict = {}
-            number_month = str(current_month.month)
-            month_dict['month'] = number_month
-            month_dict['value'] = value_query
-            values.append(month_dict)
-            current_month = current_month - datetime.timedelta(weeks=4)
+# Chart metrics from the month totals of the daily stats; `revenue` is
+# used for any other type_filter
+SERIES_METRICS = {
+    'all_bills': lambda totals: totals['bills_opened'],
+    'all_orders': lambda totals: totals['orders_placed'],
+    'payment_online': lambda totals: totals['revenue_online'],
+    'payment_offline': lambda totals: totals['revenue_offline'],
+    'evaluation_average': lambda totals: (
+        totals['rating_sum'] / totals['rating_count']
+        if totals['rating_count'] else 0),
+    'moip_taxe': lambda totals: totals['moip_fees'],
+    'revenue': lambda totals: totals['revenue_online'] + totals['revenue_offline'],
+}
 
-    elif type_filter == 'payment_online':
-        for iteration in range(6, 0, -1):
-            value_query = BillPayment.objects.filter(
-                establishment=establishment,
-                date__year=current_month.year,
-                date__month=current_month.month,
-                status_payment=BillPayment.STATUS_AUTHORIZED).aggregate(
-                    Sum('value'))
-            month_dict = {}
-            number_month = str(current_month.month)
-            month_dict['month'] = number_month
-            if not value_query.get('value__sum'):
-                month_dict['value'] = 0
-            else:
-                month_dict['value'] = value_query.get('value__sum')
-            values.append(month_dict)
-            current_month = current_month - datetime.timedelta(weeks=4)
 
-    elif type_filter == 'payment_offline':
-        for iteration in range(6, 0, -1):
-            value_query = BillPayment.objects.filter(
-                establishment=establishment,
-                date__year=current_month.year,
-                date__month=current_month.month,
-                status_payment=BillPayment.STATUS_OFFLINE_APPROVED).aggregate(
-                    Sum('value'))
-            month_dict = {}
-            number_month = str(current_month.month)
-            month_dict['month'] = number_month
-            if not value_query.get('value__sum'):
-                month_dict['value'] = 0
-            else:
-                month_dict['value'] = value_query.get('value__sum')
-            values.append(month_dict)
-            current_month = current_month - datetime.timedelta(weeks=4)
+def month_starts(current_month, months):
+    year, month = current_month.year, current_month.month
+    starts = []
+    for iteration in range(months):
+        starts.append(datetime.date(year, month, 1))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return list(reversed(starts))
 
-    elif type_filter == 'evaluation_average':
-        for iteration in range(6, 0, -1):
-            value_query = UserRating.objects.filter(
-                bill__establishment=establishment,
-                bill__payment_date__year=current_month.year,
-                bill__payment_date__month=current_month.month).aggregate(
-                    Avg('average'))
-            month_dict = {}
-            number_month = str(current_month.month)
-            month_dict['month'] = number_month
-            if not value_query.get('average__avg'):
-                month_dict['value'] = 0
-            else:
-                month_dict['value'] = value_query.get('average__avg')
-            values.append(month_dict)
-            current_month = current_month - datetime.timedelta(weeks=4)
 
-    elif type_filter == 'moip_taxe':
-        for iteration in range(6, 0, -1):
-            value_query = BillPayment.objects.filter(
-                establishment=establishment,
-                date__year=current_month.year,
-                date__month=current_month.month).aggregate(
-                    Sum('moip_fee'))
-            month_dict = {}
-            number_month = str(current_month.month)
-            month_dict['month'] = number_month
-            if not value_query.get('moip_fee__sum'):
-                month_dict['value'] = 0
-            else:
-                month_dict['value'] = value_query.get('moip_fee__sum')
-            values.append(month_dict)
-            current_month = current_month - datetime.timedelta(weeks=4)
+def revenues_series(current_month, type_filter, establishment=None, months=6):
+    '''
+    Monthly values of a dashboard metric for the calendar months up to
+    `current_month`, oldest first, from one grouped query on the daily
+    stats. Months without data are 0.
+    '''
+    metric = SERIES_METRICS.get(type_filter, SERIES_METRICS['revenue'])
+    starts = month_starts(current_month, months)
 
-    else:
-        for iteration in range(6, 0, -1):
-            value_query = BillPayment.objects.filter(
-                date__month=current_month.month,
-                date__year=current_month.year,
-                establishment=establishment,
-                status_payment__in=[
-                    BillPayment.STATUS_OFFLINE_APPROVED,
-                    BillPayment.STATUS_AUTHORIZED]).aggregate(
-                        Sum('value'))
-            month_dict = {}
-            number_month = str(current_month.month)
-            month_dict['month'] = number_month
-            if not value_query.get('value__sum'):
-                month_dict['value'] = 0
-            else:
-                month_dict['value'] = value_query.get('value__sum')
-            values.append(month_dict)
-            current_month = current_month - datetime.timedelta(weeks=4)
-
-    return reversed(values)
+    queryset = EstablishmentDailyStats.window(*month_days(starts[-1]))
+    queryset = queryset.filter(day__gte=starts[0])
+    if establishment is not None:
+        queryset = queryset.filter(establishment=establishment)
+    rows = queryset.annotate(month=TruncMonth('day')).values(
+        'month').annotate(**EstablishmentDailyStats.sums()).order_by()
+    values = {(row['month'].year, row['month'].month): metric(
+        {counter: value or 0 for counter, value in row.items()})
+        for row in rows}
+
+    return [{'month': str(start.month),
+             'value': values.get((start.year, start.month)) or 0}
+            for start in starts]
 
 
 def get_variable_name_filter(type_filter):
@@ -265,52 +99,70 @@ def get_variable_name_filter(type_filter):
         return 'Faturamento Total'
 
 
-def establishments_performance():
-    establishments = Establishment.objects.all()
-    list_establishments = []
-
-    for establishment in establishments:
-        payment_online = BillPayment.objects.filter(
-            establishment=establishment,
-            status_payment=BillPayment.STATUS_AUTHORIZED).aggregate(
-                Sum('value')).get('value__sum')
-        if not payment_online:
-            payment_online = 0.0
-
-        payment_offline = BillPayment.objects.filter(
-            establishment=establishment,
-            status_payment=BillPayment.STATUS_OFFLINE_APPROVED).aggregate(
-                Sum('value')).get('value__sum')
-        if not payment_offline:
-            payment_offline = 0.0
-
-        evaluation_average = UserRating.objects.filter(
-            bill__establishment=establishment).aggregate(Avg('average')).get('average__avg')
-        if not evaluation_average:
-            evaluation_average = 0.0
-
-        moip_taxe = BillPayment.objects.filter(establishment=establishment).aggregate(
-            Sum('moip_fee')).get('moip_fee__sum')
-        if not moip_taxe:
-            moip_taxe = 0.0
-
-        all_billing = Bill.objects.filter(establishment=establishment).aggregate(
-            Sum('value_paid')).get('value_paid__sum')
-        if not all_billing:
-            all_billing = 0.0
-
-        dict_establishment = {
-            'name': establishment.name,
-            'average_bills': establishment.average_bills(),
-            'noruh_tax_to_super_admin': establishment.noruh_tax_to_super_admin(),
-            'all_bills': Bill.objects.filter(establishment=establishment).count(),
-            'all_orders':  Order.objects.filter(bill__establishment=establishment).count(),
-            'payment_online': payment_online,
-            'payment_offline': payment_offline,
-            'evaluation_average': evaluation_average,
-            'moip_taxe': moip_taxe,
-            'all_billing': all_billing
-        }
-        list_establishments.append(dict_establishment)
-
-    return list_establishments
+# Columns of the establishments ranking, in the order of the table
+PERFORMANCE_COLUMNS = (
+    ('name', 'Estabelecimentos'),
+    ('average_bills', 'Ticket Médio'),
+    ('noruh_tax_to_super_admin', 'Taxa Noruh'),
+    ('all_bills', 'Total de Contas'),
+    ('all_orders', 'Total de Pedidos'),
+    ('payment_online', 'Pagamentos Online'),
+    ('payment_offline', 'Pagamento Offline'),
+    ('evaluation_average', 'Media das avaliações'),
+    ('moip_taxe', 'Taxa Moip'),
+    ('all_billing', 'Faturamento Total'),
+)
+PERFORMANCE_PAGE_SIZE = 25
+
+
+def stats_sum(counter):
+    return Coalesce(Sum(f'daily_stats__{counter}'), 0)
+
+
+def ratio(dividend, divisor):
+    return Case(
+        When(**{f'{divisor}__gt': 0}, then=ExpressionWrapper(
+            F(dividend) / F(divisor), output_field=DecimalField())),
+        default=Value(0), output_field=DecimalField())
+
+
+def performance_order(order_by):
+    '''
+    `order_by` when it is a column of PERFORMANCE_COLUMNS, optionally with
+    `-` for descending, otherwise the name.
+    '''
+    if order_by and order_by.lstrip('-') in dict(PERFORMANCE_COLUMNS):
+        return order_by
+    return 'name'
+
+
+def establishments_performance(order_by='name', page=1,
+                               per_page=PERFORMANCE_PAGE_SIZE):
+    '''
+    Page of the establishments ranking with their lifetime totals, summed
+    from the daily stats in one grouped query and sorted by
+    `performance_order(order_by)`.
+    '''
+    columns = [column for column, label in PERFORMANCE_COLUMNS]
+
+    establishments = Establishment.objects.annotate(
+        payments_approved=stats_sum('payments_approved'),
+        all_bills=stats_sum('bills_opened'),
+        placed=stats_sum('orders_placed'),
+        cancelled=stats_sum('orders_cancelled'),
+        payment_online=stats_sum('revenue_online'),
+        payment_offline=stats_sum('revenue_offline'),
+        moip_taxe=stats_sum('moip_fees'),
+        rating_sum=stats_sum('rating_sum'),
+        rating_count=stats_sum('rating_count'),
+    ).annotate(
+        all_orders=F('placed') + F('cancelled'),
+        all_billing=F('payment_online') + F('payment_offline'),
+        noruh_tax_to_super_admin=ExpressionWrapper(
+            F('payments_approved') * F('noruh_fee'), output_field=DecimalField()),
+    ).annotate(
+        average_bills=ratio('all_billing', 'payments_approved'),
+        evaluation_average=ratio('rating_sum', 'rating_count'),
+    ).values('id', *columns).order_by(performance_order(order_by), 'id')
+
+    return Paginator(establishments, per_page).get_page(page)
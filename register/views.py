@@ -1,15 +1,16 @@
 import json
 import datetime
 import uuid
-import csv
 import re
 
 from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
+from django.db import transaction
 from django.db.models import Q, Sum
 from django.views import generic, View
 from django.views.generic.base import TemplateView
 from django.urls import reverse, reverse_lazy
 from django.shortcuts import redirect, render
+from django.template.loader import render_to_string
 from django.utils import timezone
 from django.contrib.auth.models import User
 from django.contrib.auth.mixins import (
@@ -18,11 +19,13 @@ from django.contrib.auth.mixins import (
 )
 from django.contrib.auth.views import LoginView
 from django.core.exceptions import PermissionDenied
-from fcm_django.models import FCMDevice
+from noruh_backend.pusher import PusherNotification
 from .models import (
     Establishment,
+    EstablishmentDailyStats,
     EstablishmentManager,
     EstablishmentPhoto,
+    month_days,
 )
 from .models import (
     Menu,
@@ -35,16 +38,29 @@ from .models import (
     Order,
     Bill,
     BillMember,
+    BillSplit,
     BillPayment,
     Table,
     TableZone,
-    Request
+    Request,
+    OutboxMessage
+)
+from .exports import (
+    compensation_rows,
+    export_response,
+    parse_day,
+    payment_rows,
+    payments_for_export,
+    start_of_day,
 )
 from .utils import (
-    all_establishments_revenues,
-    establishment_revenues,
+    PERFORMANCE_COLUMNS,
     establishments_performance,
-    get_variable_name_filter
+    from_version,
+    get_variable_name_filter,
+    performance_order,
+    revenues_series,
+    sync_version
 )
 from .models import MoipWirecardCustomer, MoipWirecardAPP
 from .models import EstablishmentOperatingHours
@@ -52,7 +68,7 @@ from .models import EstablishmentEvents
 from .models import UserRating, AnswerEvaluation
 from .models import Employee, Profile
 from .models import EstablishmentPromotions
-from .models import OfflineCompensations
+from .models import OfflineCompensations, OfflineMonthSnapshot
 from .models import TokenRecoverPassword
 from .forms import (
     AnswerToEvaluationForm,
@@ -82,7 +98,6 @@ from .forms import (
     TableZoneForm,
     UserEmployeeForm,
 )
-from noruh_backend.firestore_connect import NoruhFireStore
 from .mixin import PassRequestUserMixin, checker_permissions
 from .payment.utils import (
     create_wirecard_personal_establishment, 
@@ -137,6 +152,27 @@ class TermsAndContions(TemplateView):
     template_name = 'terms_and_conditions.html'
 
 
+class PusherAuth(LoginRequiredMixin, View):
+    """
+    Authorizes the subscription of an employee to the private staff
+    channel of their establishment and role
+    """
+    raise_exception = True
+
+    def post(self, request, *args, **kwargs):
+        channel_name = request.POST.get('channel_name', '')
+        employee = getattr(request.user, 'employee', None)
+        if employee is None or not employee.can_subscribe(channel_name):
+            raise PermissionDenied
+
+        try:
+            auth = PusherNotification.pusher_client.authenticate(
+                channel=channel_name, socket_id=request.POST.get('socket_id', ''))
+        except ValueError:
+            raise PermissionDenied
+        return JsonResponse(auth)
+
+
 class Home(LoginRequiredMixin, View):
 
     def get(self, request, *args, **kwargs):
@@ -563,27 +599,14 @@ class DashboardEstablishment(LoginRequiredMixin, PermissionRequiredMixin, Templa
 
         type_filter = self.request.GET.get('type_filter')
 
-        data['revenues'] = establishment_revenues(current_month, type_filter, establishment)
+        data['revenues'] = revenues_series(current_month, type_filter, establishment)
         data['variable_name_filter'] = get_variable_name_filter(type_filter)
 
-        billing = BillPayment.objects.filter(
-            date__month=current_month.month,
-            date__year=current_month.year,
-            establishment__id=self.kwargs['establishment_id'],
-            status_payment__in=[
-                BillPayment.STATUS_OFFLINE_APPROVED,
-                BillPayment.STATUS_AUTHORIZED])
-
-        data['billing'] = billing.aggregate(Sum('value')).get('value__sum')
-
-        n_all_orders = Order.objects.filter(
-            bill__establishment__id=self.kwargs['establishment_id'],
-            created_at__year=current_month.year,
-            created_at__month=current_month.month,
-            canceled_at__isnull=True).count()
-        data['n_all_orders'] = n_all_orders
-
-        data['average_ticket'] = establishment.average_bills(current_month)
+        totals = EstablishmentDailyStats.totals(
+            *month_days(current_month), establishment=establishment)
+        data['billing'] = totals['revenue_online'] + totals['revenue_offline']
+        data['n_all_orders'] = totals['orders_placed']
+        data['average_ticket'] = EstablishmentDailyStats.average_ticket(totals)
 
         data['more_requested'] = Order.objects.filter(
             bill__establishment_id=self.kwargs['establishment_id'],
@@ -673,7 +696,7 @@ class DashboardAllEstablishments(LoginRequiredMixin, PermissionRequiredMixin, Te
         data['filter_date'] = current_month
 
         type_filter = self.request.GET.get('type_filter')
-        data['revenues'] = all_establishments_revenues(current_month, type_filter)
+        data['revenues'] = revenues_series(current_month, type_filter)
         data['variable_name_filter'] = get_variable_name_filter(type_filter)
 
         users = User.objects.filter(employee__isnull=True)
@@ -682,26 +705,22 @@ class DashboardAllEstablishments(LoginRequiredMixin, PermissionRequiredMixin, Te
         data['customers_female'] = users.filter(profile__gender=Profile.GENDER_FEMALE).count()
         data['customers_other'] = users.filter(profile__gender=Profile.GENDER_OTHER).count()
 
-        all_billing = BillPayment.objects.filter(
-            date__month=current_month.month,
-            date__year=current_month.year).aggregate(Sum('value'))
-        data['all_billing'] = all_billing.get('value__sum')
-
-        all_bills = Bill.objects.filter(
-            opening_date__month__gte=current_month.month,
-            opening_date__year=current_month.year).count()
-        data['all_bills'] = all_bills
-
-        all_orders = Order.objects.filter(
-            created_at__year=current_month.year,
-            created_at__month=current_month.month,
-            canceled_at__isnull=True).count()
-
-        data['all_orders'] = all_orders
+        totals = EstablishmentDailyStats.totals(*month_days(current_month))
+        data['all_billing'] = totals['revenue_online'] + totals['revenue_offline']
+        data['all_bills'] = totals['bills_opened']
+        data['all_orders'] = totals['orders_placed']
         data['all_compensations'] = Establishment.report_offline_all_establishments(current_month)
 
         data['customers_count'] = User.objects.filter(employee__isnull=True).count()
-        data['all_establishments'] = establishments_performance()
+        order_by = performance_order(self.request.GET.get('order'))
+        data['all_establishments'] = establishments_performance(
+            order_by, self.request.GET.get('page'))
+        data['performance_columns'] = PERFORMANCE_COLUMNS
+        data['performance_order'] = order_by
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        query.pop('order', None)
+        data['performance_query'] = query.urlencode()
 
         return data
 
@@ -1909,6 +1928,8 @@ class ListOrdersPendingKitchen(LoginRequiredMixin, PermissionRequiredMixin, gene
         data['establishment'] = Establishment.objects.get(pk=self.kwargs['establishment_id'])
         data['categories'] = ItemCategory.objects.filter(establishment__id=self.kwargs['establishment_id'])
         data['tables'] = Table.objects.filter(establishment__id=self.kwargs['establishment_id'])
+        data['status'] = Order.STATUS_PENDING
+        data['cursor'] = sync_version([timezone.now()])
         return data
 
     def get_queryset(self):
@@ -1937,6 +1958,8 @@ class ListOrdersPreparingKitchen(LoginRequiredMixin, PermissionRequiredMixin, ge
         data = super().get_context_data(**kwargs)
         data['establishment'] = Establishment.objects.get(pk = self.kwargs['establishment_id'])
         data['tables'] = Table.objects.filter(establishment__id=self.kwargs['establishment_id'])
+        data['status'] = Order.STATUS_PREPARING
+        data['cursor'] = sync_version([timezone.now()])
         return data
 
     def get_queryset(self):
@@ -1955,6 +1978,54 @@ class ListOrdersPreparingKitchen(LoginRequiredMixin, PermissionRequiredMixin, ge
             return True
 
 
+class KitchenOrdersFeed(LoginRequiredMixin, PermissionRequiredMixin, View):
+    """
+    Orders of the establishment changed after the `since` cursor, with the
+    card to show on the kitchen screen of `status`. Orders that are no
+    longer on that screen come without html, so their card is removed.
+    The cursor stays SYNC_OVERLAP behind now, so orders of the last seconds
+    come again and their card is replaced by id.
+    """
+    permission_required = "register.can_view_order"
+    raise_exception = True
+
+    def get(self, request, *args, **kwargs):
+        try:
+            since = int(request.GET['since'])
+            changed_after = from_version(since)
+        except (KeyError, ValueError, OverflowError):
+            return JsonResponse({'since': 'A valid cursor is required.'}, status=400)
+        status = request.GET.get('status', Order.STATUS_PENDING)
+        categories = [int(category) for category in request.GET.getlist('category')
+                      if category.isdigit()]
+
+        orders = Order.objects.filter(
+            bill__establishment__id=self.kwargs['establishment_id'],
+            updated_at__gt=changed_after).select_related(
+                'user', 'item', 'bill__table').order_by('updated_at')
+
+        cards = []
+        for order in orders:
+            html = None
+            if order.status == status and (
+                    not categories or order.item.category_id in categories):
+                html = render_to_string('./components/kitchen/orders_card.html',
+                                        {'order': order}, request=request)
+            cards.append({'id': order.id, 'status': order.status, 'html': html})
+        cursor = sync_version([order.updated_at for order in orders], since)
+        return JsonResponse({'cursor': cursor, 'orders': cards})
+
+    def has_permission(self):
+        user = self.request.user
+        if user.is_superuser:
+            return True
+
+        est_employee = Employee.objects.filter(establishment__id=self.kwargs['establishment_id'],
+                                               establishment=user.employee.establishment)
+        if checker_permissions(user, self.permission_required, est_employee.exists()):
+            return True
+
+
 class ListOrdersDoneKitchen(LoginRequiredMixin, PermissionRequiredMixin, generic.ListView):
     permission_required = "register.can_view_order"
     template_name = './components/kitchen/order_list_kitchen_done.html'
@@ -2097,6 +2168,7 @@ class CreateOrder(LoginRequiredMixin, PermissionRequiredMixin, TemplateView):
             obj = form.save(commit=False)
             obj.save()
             form.save()
+            obj.bill.grant_offer([obj])
             return redirect('register:list_items_to_order', **{'establishment_id': obj.bill.establishment.id})
         else:
             context = self.get_context_data()
@@ -2177,6 +2249,36 @@ class UpdateOrder(LoginRequiredMixin, PermissionRequiredMixin, generic.UpdateVie
             return True
 
 
+class KitchenOrdersTransition(LoginRequiredMixin, PermissionRequiredMixin, View):
+    """
+    Accept, finish or cancel a list of orders of the establishment at once
+    """
+    permission_required = "register.can_change_order_status"
+    raise_exception = True
+
+    def post(self, request, *args, **kwargs):
+        action = request.POST.get('action')
+        if action not in Order.KITCHEN_TRANSITIONS:
+            return JsonResponse({'action': 'A valid action is required.'}, status=400)
+        order_ids = {int(order_id) for order_id in request.POST.getlist('order')
+                     if order_id.isdigit()}
+
+        orders = Order.transition(self.kwargs['establishment_id'], order_ids, action)
+        updated = sorted(order.id for order in orders)
+        return JsonResponse({'updated': updated,
+                             'rejected': sorted(order_ids.difference(updated))})
+
+    def has_permission(self):
+        user = self.request.user
+        if user.is_superuser:
+            return True
+
+        est_employee = Employee.objects.filter(establishment__id=self.kwargs['establishment_id'],
+                                               establishment=user.employee.establishment)
+        if checker_permissions(user, self.permission_required, est_employee.exists()):
+            return True
+
+
 class KitchenAcceptOrder(LoginRequiredMixin, PermissionRequiredMixin, View):
     permission_required = "register.can_change_order_status"
 
@@ -2184,9 +2286,10 @@ class KitchenAcceptOrder(LoginRequiredMixin, PermissionRequiredMixin, View):
         order = Order.objects.get(id=self.kwargs['order_id'])
         order.status = Order.STATUS_PREPARING
         order.kitchen_accepted_at = timezone.now()
-        order.save()
         body_msg = "O restaurante " f'{order.bill.establishment.name}' " aceitou o seu pedido"
-        order.send_fcm_push_notifications('Pedido Aceito', 'order_accepted', body_msg)
+        with transaction.atomic():
+            order.save()
+            order.send_fcm_push_notifications('Pedido Aceito', 'order_accepted', body_msg)
         return redirect('register:orders_list_kitchen_preparing', **{'establishment_id': order.bill.establishment.id})
 
     def has_permission(self):
@@ -2208,8 +2311,9 @@ class KitchenDoneOrder(LoginRequiredMixin, PermissionRequiredMixin, View):
         order.status = Order.STATUS_DONE
         order.kitchen_finished_at = timezone.now()
         body_msg = "O restaurante " f'{order.bill.establishment.name}' " finalizou o seu pedido"
-        order.send_fcm_push_notifications('Pedido Pronto', 'order_ready', body_msg)
-        order.save()
+        with transaction.atomic():
+            order.save()
+            order.send_fcm_push_notifications('Pedido Pronto', 'order_ready', body_msg)
         return redirect('register:orders_list_kitchen_done', **{'establishment_id': order.bill.establishment.id})
 
     def has_permission(self):
@@ -2348,11 +2452,13 @@ class ListBillMembersOnBill(LoginRequiredMixin, PermissionRequiredMixin, generic
         context['bill'] = bill
         context['orders_total_couvert_service'] = bill.all_value_bill()
         context['still_have_to_pay'] = bill.still_have_to_pay()
+        context['all_items'] = BillSplit(bill).attach(context['all_items'])
 
         return context
 
     def get_queryset(self):
-        return BillMember.objects.filter(bill__id=self.kwargs['bill_id'])
+        return BillMember.objects.filter(
+            bill__id=self.kwargs['bill_id']).select_related('customer__profile')
 
 
 class ListOrdersFromBill(LoginRequiredMixin, PermissionRequiredMixin, generic.ListView):
@@ -2801,24 +2907,16 @@ class CreatePaymentOnBillMember(LoginRequiredMixin, PermissionRequiredMixin, Tem
             bill_member=bill_member, value=value,
             status_updated=timezone.now())
 
-        value_paid_and_value = value + float(bill.value_paid)
-        if value_paid_and_value > bill.all_value_bill_without_taxe_service() and value_paid_and_value <= bill.all_value_bill():
-            BillMember.objects.filter(bill=bill).update(leave_at=timezone.now())
-            bill.payment_date = timezone.now()
-            noruh_firestore = NoruhFireStore()
-            data_notification = {'ḱey': 'bill_closed', 'billId': bill.id}
-            noruh_firestore.add_data_on_collection(data_notification)
-
-        bill.value_paid = value_paid_and_value
-        bill.save()
-        bill_member.leave_at = timezone.now()
-        bill_member.save()
-
-        noruh_firestore = NoruhFireStore()
-        data_notification = bill_payment.notification_payload(key='payment_accepted')
-        noruh_firestore.add_data_on_collection(data_notification)
+        bill_payment.settle(notify=self.notify)
         return HttpResponse(200)
 
+    @staticmethod
+    def notify(settlement):
+        if settlement.closed:
+            settlement.notify_bill_closed()
+        OutboxMessage.send_firestore(
+            settlement.payment.notification_payload(key='payment_accepted'))
+
 
 class ApproveOrRejectPayment(LoginRequiredMixin, PermissionRequiredMixin, TemplateView):
     permission_required = "register.can_accept_payment"
@@ -2910,25 +3008,10 @@ class CreatePaymentAllBill(LoginRequiredMixin, PermissionRequiredMixin, Template
             obj.bill = bill
             obj.status_payment = BillPayment.STATUS_OFFLINE_APPROVED
             obj.status_updated = timezone.now()
+            obj.save()
 
-            bill.payment_date = timezone.now()
-            bill.value_paid = bill.value_paid + form.clean_value()
-            BillMember.objects.filter(bill=bill).update(leave_at=timezone.now())
-
-            noruh_firestore = NoruhFireStore()
-            data_notification = {
-                'action': 'bill_closed',
-                'billId': bill.id,
-                'createdAt': timezone.now().isoformat()
-            }
-            noruh_firestore.add_data_on_collection(data_notification)
-
-            devices = FCMDevice.objects.filter(
-                user__in=BillMember.objects.filter(
-                    bill=self.bill, leave_at__isnull=True).values('customer'))
-
-            bill.save()
-            form.save()
+            # The whole bill is paid at once, so it closes
+            obj.settle(close=True, notify=lambda settlement: settlement.notify_bill_closed())
             return redirect('register:bill_member_on_bill_list', **{'bill_id': bill.id})
         else:
             context = self.get_context_data()
@@ -2968,15 +3051,15 @@ class CreateCompensation(LoginRequiredMixin, PermissionRequiredMixin, TemplateVi
     def get(self, request, *args, **kwargs):
         establishments = Establishment.objects.all()
         establishment = Establishment.objects.get(id=self.kwargs['establishment_id'])
-        reports = establishment.report_offline_payment()
+        report = OfflineMonthSnapshot.ledger_month(
+            establishment, self.kwargs['year'], self.kwargs['month'])
 
-        for report in reports:
-            if report.get('m') == self.kwargs['month'] and report.get('y') == self.kwargs['year']:
-                OfflineCompensations.objects.create(
-                    establishment=establishment,
-                    value=report.get('compensation_value'),
-                    month=self.kwargs['month'],
-                    year=self.kwargs['year'])
+        if report is not None:
+            OfflineCompensations.objects.create(
+                establishment=establishment,
+                value=report.get('compensation_value'),
+                month=self.kwargs['month'],
+                year=self.kwargs['year'])
 
         return redirect('register:offline_compensations')
 
@@ -2993,36 +3076,47 @@ class GenerateCSVReport(LoginRequiredMixin, PermissionRequiredMixin, TemplateVie
     def get(self, request, *args, **kwargs):
         month_year = '{}/{}'.format(self.kwargs['month'], self.kwargs['year'])
         establishment = Establishment.objects.get(id=self.kwargs['establishment_id'])
-        payments = BillPayment.objects.filter(
+        first_day, last_day = month_days(
+            datetime.date(self.kwargs['year'], self.kwargs['month'], 1))
+        payments = payments_for_export(
             establishment=establishment,
             status_payment=BillPayment.STATUS_OFFLINE_APPROVED,
-            status_updated__month=self.kwargs['month'],
-            status_updated__year=self.kwargs['year'])
-
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="{}-{}-compensation_details.csv"'.format(establishment.name, month_year)
-        writer = csv.writer(response)
-
-        writer.writerow([establishment.name, month_year])
-        writer.writerow([''])
-        writer.writerow(['Conta', 'Mesa', 'Membros', 'Data Pagamento', 'Valor', 'Repasse'])
-        for payment in payments:
-            bill_id = '#{}'.format(payment.id)
-            date_time = '{}:{}'.format(payment.status_updated.hour, payment.status_updated.minute)
-            date_payment = '{} {}'.format(payment.status_updated.date(), date_time)
-            value_compensation = payment.value * establishment.offline_percentage
-            writer.writerow([
-                bill_id, payment.bill.table.name,
-                payment.bill.customers.count(), date_payment,
-                payment.value, "%.2f" % value_compensation])
-
-        reports = establishment.report_offline_payment()
-        for report in reports:
-            if report.get('m') == self.kwargs['month'] and report.get('y') == self.kwargs['year']:
-                compensation_value = "%.2f" % report.get('compensation_value')
-                writer.writerow(['TOTAL', '', '', '', report.get('total'), compensation_value])
-
-        return response
+            status_updated__gte=start_of_day(first_day),
+            status_updated__lt=start_of_day(last_day + datetime.timedelta(days=1)))
+        report = OfflineMonthSnapshot.ledger_month(
+            establishment, self.kwargs['year'], self.kwargs['month'])
+
+        return export_response(
+            '{}-{}-compensation_details'.format(establishment.name, month_year),
+            compensation_rows(establishment, month_year, payments, report),
+            self.request.GET.get('format'))
+
+    def has_permission(self):
+        user = self.request.user
+        if not user.is_superuser:
+            raise PermissionDenied
+        return True
+
+
+class PaymentsExport(LoginRequiredMixin, PermissionRequiredMixin, View):
+    """
+    Payments created from `start` to `end` (YYYY-MM-DD, the current month by
+    default), of one establishment or all of them, as csv or xlsx.
+    """
+
+    def get(self, request, *args, **kwargs):
+        today = timezone.localdate()
+        start = parse_day(request.GET.get('start'), today.replace(day=1))
+        end = parse_day(request.GET.get('end'), today)
+        filters = {'date__gte': start_of_day(start),
+                   'date__lt': start_of_day(end + datetime.timedelta(days=1))}
+        if request.GET.get('establishment', '').isdigit():
+            filters['establishment_id'] = request.GET['establishment']
+
+        return export_response(
+            'payments-{}-{}'.format(start, end),
+            payment_rows(payments_for_export(**filters)),
+            request.GET.get('format'))
 
     def has_permission(self):
         user = self.request.user